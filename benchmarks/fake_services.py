@@ -0,0 +1,229 @@
+import argparse
+import asyncio
+from fastapi import FastAPI, Form, Request, UploadFile
+from fastapi.responses import JSONResponse, Response
+import json
+import math
+import random
+import time
+import uuid
+import uvicorn
+
+WORDS = ('лес', 'река', 'город', 'свет', 'ветер', 'дорога', 'утро', 'поле',
+         'книга', 'окно', 'море', 'гора', 'время', 'голос', 'сад', 'дом')
+
+
+def sample_latency(median: float, sigma: float):
+    # log-normal, most calls are close to the median with a long tail
+    if median <= 0:
+        return 0.0
+    return random.lognormvariate(math.log(median), sigma)
+
+
+def random_text(length: int):
+    words = []
+    size = 0
+    while size < length:
+        word = random.choice(WORDS)
+        words.append(word)
+        size += len(word) + 1
+    return ' '.join(words).capitalize() + '.'
+
+
+def create_app(config):
+    app = FastAPI()
+    checks = {}
+    files = {}
+    batches = {}
+    tasks = set()
+    stats = {'batches': 0, 'completions': 0, 'rate_limited': 0, 'failed': 0,
+             'submits': 0, 'polls': 0}
+
+    def failure_response():
+        if random.random() < config.rate_limit_rate:
+            stats['rate_limited'] += 1
+            return JSONResponse(
+                {'error': {'message': 'Rate limit reached',
+                           'type': 'requests', 'code': 'rate_limit_exceeded'}},
+                status_code=429, headers={'retry-after': '1'})
+        if random.random() < config.failure_rate:
+            stats['failed'] += 1
+            return JSONResponse(
+                {'error': {'message': 'The server had an error',
+                           'type': 'server_error'}}, status_code=500)
+        return None
+
+    def completion(body):
+        prompt = ''.join(message['content'] for message in body['messages'])
+        content = random_text(config.completion_chars)
+        finish_reason = 'stop'
+        if body.get('max_tokens') and len(content) > body['max_tokens'] * 2:
+            content = content[:body['max_tokens'] * 2]
+            finish_reason = 'length'
+        prompt_tokens = len(prompt) // 2 + 1
+        completion_tokens = len(content) // 2 + 1
+        return {
+            'id': f'chatcmpl-{uuid.uuid4().hex}',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': body.get('model', 'gpt-3.5-turbo'),
+            'choices': [{'index': 0,
+                         'message': {'role': 'assistant',
+                                     'content': content},
+                         'finish_reason': finish_reason}],
+            'usage': {'prompt_tokens': prompt_tokens,
+                      'completion_tokens': completion_tokens,
+                      'total_tokens': prompt_tokens + completion_tokens},
+        }
+
+    @app.post('/v1/chat/completions')
+    async def chat_completions(request: Request):
+        body = await request.json()
+        await asyncio.sleep(sample_latency(config.openai_latency,
+                                           config.openai_sigma))
+        failure = failure_response()
+        if failure is not None:
+            return failure
+        stats['completions'] += 1
+        return JSONResponse(completion(body), headers={
+            'x-ratelimit-limit-requests': str(config.openai_rpm),
+            'x-ratelimit-limit-tokens': str(config.openai_tpm),
+        })
+
+    @app.post('/v1/files')
+    async def upload_file(file: UploadFile, purpose: str = Form(...)):
+        file_id = f'file-{uuid.uuid4().hex}'
+        files[file_id] = await file.read()
+        return {'id': file_id, 'object': 'file', 'bytes': len(files[file_id]),
+                'purpose': purpose}
+
+    @app.get('/v1/files/{file_id}/content')
+    async def file_content(file_id: str):
+        if file_id not in files:
+            return JSONResponse({'error': {'message': 'No such file'}},
+                                status_code=404)
+        return Response(files[file_id], media_type='application/jsonl')
+
+    async def run_batch(batch):
+        await asyncio.sleep(sample_latency(config.batch_time,
+                                           config.openai_sigma))
+        if batch['status'] == 'cancelled':
+            return
+        output = []
+        for line in files[batch['input_file_id']].decode().splitlines():
+            request = json.loads(line)
+            if random.random() < config.failure_rate:
+                response = {'status_code': 500, 'body': {
+                    'error': {'message': 'The server had an error'}}}
+                batch['request_counts']['failed'] += 1
+            else:
+                response = {'status_code': 200,
+                            'body': completion(request['body'])}
+                batch['request_counts']['completed'] += 1
+            output.append(json.dumps({'custom_id': request['custom_id'],
+                                      'response': response, 'error': None},
+                                     ensure_ascii=False))
+        batch['output_file_id'] = f'file-{uuid.uuid4().hex}'
+        files[batch['output_file_id']] = '\n'.join(output).encode()
+        batch['status'] = 'completed'
+        stats['batches'] += 1
+
+    @app.post('/v1/batches')
+    async def create_batch(request: Request):
+        body = await request.json()
+        if body['input_file_id'] not in files:
+            return JSONResponse({'error': {'message': 'No such file'}},
+                                status_code=400)
+        batch_id = f'batch_{uuid.uuid4().hex}'
+        total = len(files[body['input_file_id']].splitlines())
+        batches[batch_id] = {
+            'id': batch_id, 'object': 'batch', 'status': 'in_progress',
+            'input_file_id': body['input_file_id'], 'output_file_id': None,
+            'error_file_id': None,
+            'request_counts': {'total': total, 'completed': 0, 'failed': 0},
+        }
+        task = asyncio.create_task(run_batch(batches[batch_id]))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        return batches[batch_id]
+
+    @app.get('/v1/batches/{batch_id}')
+    async def get_batch(batch_id: str):
+        if batch_id not in batches:
+            return JSONResponse({'error': {'message': 'No such batch'}},
+                                status_code=404)
+        return batches[batch_id]
+
+    @app.post('/v1/batches/{batch_id}/cancel')
+    async def cancel_batch(batch_id: str):
+        if batch_id not in batches:
+            return JSONResponse({'error': {'message': 'No such batch'}},
+                                status_code=404)
+        if batches[batch_id]['status'] == 'in_progress':
+            batches[batch_id]['status'] = 'cancelled'
+        return batches[batch_id]
+
+    @app.post('/textru')
+    async def textru(request: Request):
+        body = await request.json()
+        await asyncio.sleep(sample_latency(config.textru_latency,
+                                           config.textru_sigma))
+        if random.random() < config.failure_rate:
+            stats['failed'] += 1
+            return JSONResponse({'error_code': 140,
+                                 'error_desc': 'Server error'})
+        if 'uid' in body:
+            stats['polls'] += 1
+            ready_at, uniqueness = checks.get(body['uid'], (None, None))
+            if ready_at is None:
+                return JSONResponse({'error_code': 180,
+                                     'error_desc': 'Unknown uid'})
+            if time.monotonic() < ready_at:
+                return JSONResponse({'error_code': 181,
+                                     'error_desc': 'Check is not ready'})
+            return JSONResponse({'text_unique': f'{uniqueness:.2f}'})
+        stats['submits'] += 1
+        uid = uuid.uuid4().hex
+        checks[uid] = (
+            time.monotonic() + sample_latency(config.textru_check_time,
+                                              config.textru_sigma),
+            random.uniform(config.min_uniqueness, 100))
+        return JSONResponse({'text_uid': uid})
+
+    @app.get('/stats')
+    async def get_stats():
+        return stats
+
+    return app
+
+
+def add_arguments(parser):
+    parser.add_argument('--batch-time', type=float, default=10.0,
+                        help='median seconds until a batch is completed')
+    parser.add_argument('--completion-chars', type=int, default=1200)
+    parser.add_argument('--failure-rate', type=float, default=0.01)
+    parser.add_argument('--min-uniqueness', type=float, default=60)
+    parser.add_argument('--openai-latency', type=float, default=2.0,
+                        help='median seconds per completion')
+    parser.add_argument('--openai-sigma', type=float, default=0.5)
+    parser.add_argument('--openai-rpm', type=int, default=10000)
+    parser.add_argument('--openai-tpm', type=int, default=2000000)
+    parser.add_argument('--rate-limit-rate', type=float, default=0.02)
+    parser.add_argument('--textru-check-time', type=float, default=5.0,
+                        help='median seconds until a check is ready')
+    parser.add_argument('--textru-latency', type=float, default=0.05)
+    parser.add_argument('--textru-sigma', type=float, default=0.5)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Local stand-ins for the OpenAI and text.ru APIs')
+    parser.add_argument('--port', type=int, default=8900)
+    add_arguments(parser)
+    config = parser.parse_args()
+    uvicorn.run(create_app(config), host='127.0.0.1', port=config.port,
+                log_level='warning')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,279 @@
+import argparse
+import asyncio
+from benchmarks.fake_services import add_arguments
+from datetime import datetime, timezone
+import json
+import os
+import platform
+import psutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+FAKE_SERVICE_OPTIONS = ('batch_time', 'completion_chars', 'failure_rate',
+                        'min_uniqueness', 'openai_latency', 'openai_sigma',
+                        'openai_rpm', 'openai_tpm', 'rate_limit_rate',
+                        'textru_check_time', 'textru_latency', 'textru_sigma')
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def start_fake_services(config, port):
+    command = [sys.executable, '-m', 'benchmarks.fake_services',
+               '--port', str(port)]
+    for option in FAKE_SERVICE_OPTIONS:
+        command += [f"--{option.replace('_', '-')}",
+                    str(getattr(config, option))]
+    process = subprocess.Popen(command)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('fake services did not start')
+
+
+def configure_environment(config, port, work_dir):
+    # the application reads its settings when its modules are imported
+    os.environ.update({
+        'ARTIFACT_DIR': os.path.join(work_dir, 'artifacts'),
+        'DATABASE_URL': config.database_url or
+        f"sqlite+aiosqlite:///{os.path.join(work_dir, 'benchmark.db')}",
+        'OPENAI_API': 'benchmark',
+        'OPENAI_BASE_URL': f'http://127.0.0.1:{port}/v1',
+        'OPENAI_BATCH_POLL_INTERVAL': str(config.poll_delay),
+        'OPENAI_RPM': str(config.openai_rpm),
+        'OPENAI_TPM': str(config.openai_tpm),
+        'TEXTRU_FIRST_POLL_DELAY': str(config.poll_delay),
+        'TEXTRU_KEY': 'benchmark',
+        'TEXTRU_MAX_POLL_INTERVAL': str(config.poll_delay * 4),
+        'TEXTRU_URL': f'http://127.0.0.1:{port}/textru',
+    })
+    os.environ.setdefault('LOG_LEVEL', 'ERROR')
+
+
+def percentile(values, share):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+
+class PeakRss:
+    def __init__(self, interval=0.1):
+        self.process = psutil.Process()
+        self.interval = interval
+        self.peak = 0
+        self._task = None
+
+    async def _run(self):
+        while True:
+            self.peak = max(self.peak, self.process.memory_info().rss)
+            await asyncio.sleep(self.interval)
+
+    def __enter__(self):
+        self.peak = self.process.memory_info().rss
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    def __exit__(self, *exc_info):
+        self._task.cancel()
+        self.peak = max(self.peak, self.process.memory_info().rss)
+
+
+async def run_size(size, author_id, config, round_trips):
+    from chatgpt_fastapi.database import async_session_maker
+    from chatgpt_fastapi.models import TextOutcome
+    from chatgpt_fastapi.services import (create_text_set, generate_texts,
+                                          stream_text_set_zip)
+    from sqlalchemy import func, select
+
+    task_strings = '\n'.join(
+        f'Напиши текст про тему номер {line}||Заголовок {line}'
+        for line in range(size))
+    async with async_session_maker() as session:
+        text_set = await create_text_set(
+            author=author_id, generation_mode=config.generation_mode,
+            rewriting_task='Перепиши текст своими словами',
+            required_uniqueness=config.required_uniqueness,
+            set_name=f'benchmark {size}', task_strings=task_strings,
+            temperature=1, text_len=config.text_len, session=session)
+        await session.refresh(text_set)
+        text_set_id = text_set.id
+
+    round_trips['count'] = 0
+    started = time.monotonic()
+    with PeakRss() as peak_rss:
+        async with async_session_maker() as session:
+            await generate_texts(
+                session=session, text_set_id=text_set_id,
+                rewriting_task='Перепиши текст своими словами',
+                required_uniqueness=config.required_uniqueness,
+                text_len=config.text_len)
+        seconds = time.monotonic() - started
+        generation_round_trips = round_trips['count']
+
+        zip_started = time.monotonic()
+        zip_bytes = 0
+        async for chunk in stream_text_set_zip(text_set_id):
+            zip_bytes += len(chunk)
+        zip_seconds = time.monotonic() - zip_started
+
+    async with async_session_maker() as session:
+        durations = (await session.execute(
+            select(TextOutcome.duration)
+            .where(TextOutcome.parsing_set_id == text_set_id,
+                   TextOutcome.duration.is_not(None)))).scalars().all()
+        outcomes = dict((await session.execute(
+            select(TextOutcome.status, func.count())
+            .where(TextOutcome.parsing_set_id == text_set_id)
+            .group_by(TextOutcome.status))).all())
+
+    return {
+        'db_round_trips': generation_round_trips,
+        'latency_mean': statistics.fmean(durations) if durations else None,
+        'latency_p50': percentile(durations, 0.5),
+        'latency_p95': percentile(durations, 0.95),
+        'latency_p99': percentile(durations, 0.99),
+        'lines': size,
+        'outcomes': outcomes,
+        'peak_rss_bytes': peak_rss.peak,
+        'seconds': seconds,
+        'texts_per_minute': size / seconds * 60,
+        'zip_bytes': zip_bytes,
+        'zip_seconds': zip_seconds,
+    }
+
+
+async def run_benchmarks(config):
+    from chatgpt_fastapi.api_utils import textru_poller
+    from chatgpt_fastapi.clients import (close_openai_batch_client,
+                                         close_openai_client,
+                                         close_textru_client)
+    from chatgpt_fastapi.database import (async_session_maker,
+                                          create_db_and_tables, engine)
+    from chatgpt_fastapi.models import User
+    from chatgpt_fastapi.services import text_pipeline
+    from sqlalchemy import event
+
+    round_trips = {'count': 0}
+
+    def count_round_trip(*args):
+        round_trips['count'] += 1
+
+    event.listen(engine.sync_engine, 'before_cursor_execute',
+                 count_round_trip)
+    event.listen(engine.sync_engine, 'commit', count_round_trip)
+
+    await create_db_and_tables()
+    async with async_session_maker() as session:
+        author = User(email=f'benchmark-{time.time_ns()}@example.com',
+                      hashed_password='-', is_active=True,
+                      is_superuser=False, is_verified=True)
+        session.add(author)
+        await session.flush()
+        author_id = author.id
+        await session.commit()
+
+    results = []
+    try:
+        for size in config.sizes:
+            result = await run_size(size, author_id, config, round_trips)
+            print(f"{size} lines: {result['texts_per_minute']:.1f} texts/min, "
+                  f"p95 {result['latency_p95']} s, "
+                  f"{result['db_round_trips']} round trips", flush=True)
+            results.append(result)
+    finally:
+        await text_pipeline.close()
+        await textru_poller.close()
+        await close_openai_client()
+        await close_openai_batch_client()
+        await close_textru_client()
+        await engine.dispose()
+    return results
+
+
+def find_regressions(results, baseline, tolerance):
+    previous = {result['lines']: result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        before = previous.get(result['lines'])
+        if before is None:
+            continue
+        if result['texts_per_minute'] < before['texts_per_minute'] * (
+                1 - tolerance):
+            regressions.append(
+                f"{result['lines']} lines: texts_per_minute "
+                f"{result['texts_per_minute']:.1f} < "
+                f"{before['texts_per_minute']:.1f}")
+        for key in ('latency_p95', 'peak_rss_bytes', 'zip_seconds'):
+            if before.get(key) and result.get(key) and (
+                    result[key] > before[key] * (1 + tolerance)):
+                regressions.append(
+                    f"{result['lines']} lines: {key} {result[key]} > "
+                    f"{before[key]}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run generate_texts end to end against fake services')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10, 100, 1000, 10000])
+    parser.add_argument('--database-url',
+                        help='defaults to a temporary SQLite database')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--baseline',
+                        help='earlier results to compare with, the exit '
+                             'code is 1 on a regression')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--poll-delay', type=float, default=1.0)
+    parser.add_argument('--required-uniqueness', type=float, default=70)
+    parser.add_argument('--text-len', type=int, default=1000)
+    parser.add_argument('--generation-mode', choices=('online', 'batch'),
+                        default='online')
+    add_arguments(parser)
+    config = parser.parse_args()
+
+    port = free_port()
+    fake_services = start_fake_services(config, port)
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            configure_environment(config, port, work_dir)
+            results = asyncio.run(run_benchmarks(config))
+    finally:
+        fake_services.terminate()
+        fake_services.wait()
+
+    report = {
+        'config': vars(config),
+        'finished_at': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'results': results,
+    }
+    with open(config.output, 'w') as output:
+        json.dump(report, output, indent=2)
+    print(f'Results saved to {config.output}')
+
+    if config.baseline:
+        with open(config.baseline) as baseline:
+            regressions = find_regressions(results, json.load(baseline),
+                                           config.tolerance)
+        for regression in regressions:
+            print(f'Regression: {regression}')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+import argparse
+import asyncio
+from benchmarks.run import percentile
+from datetime import datetime, timezone
+import json
+import os
+import platform
+import statistics
+import tempfile
+import time
+
+
+async def run_lookups(user_id, cache, lookups, round_trips):
+    from chatgpt_fastapi.database import async_session_maker
+    from chatgpt_fastapi.models import User
+    from chatgpt_fastapi.user_cache import CachedUserDatabase
+
+    round_trips['count'] = 0
+    durations = []
+    started = time.monotonic()
+    for _ in range(lookups):
+        # a session per lookup, as every request gets its own
+        async with async_session_maker() as session:
+            lookup_started = time.perf_counter()
+            user = await CachedUserDatabase(session, User, cache).get(
+                user_id)
+            durations.append(time.perf_counter() - lookup_started)
+            assert user.id == user_id
+    seconds = time.monotonic() - started
+    return {
+        'db_round_trips': round_trips['count'],
+        'hit_rate': cache.as_dict()['hit_rate'],
+        'latency_mean': statistics.fmean(durations),
+        'latency_p50': percentile(durations, 0.5),
+        'latency_p95': percentile(durations, 0.95),
+        'lookups': lookups,
+        'lookups_per_second': lookups / seconds,
+    }
+
+
+async def run_benchmarks(config):
+    from chatgpt_fastapi.database import (async_session_maker,
+                                          create_db_and_tables, engine)
+    from chatgpt_fastapi.models import User
+    from chatgpt_fastapi.user_cache import UserCache
+    from sqlalchemy import event
+
+    round_trips = {'count': 0}
+
+    def count_round_trip(*args):
+        round_trips['count'] += 1
+
+    event.listen(engine.sync_engine, 'before_cursor_execute',
+                 count_round_trip)
+
+    await create_db_and_tables()
+    async with async_session_maker() as session:
+        user = User(email=f'benchmark-{time.time_ns()}@example.com',
+                    hashed_password='-', is_active=True,
+                    is_superuser=False, is_verified=True)
+        session.add(user)
+        await session.flush()
+        user_id = user.id
+        await session.commit()
+
+    results = {}
+    try:
+        for name, ttl in (('uncached', 0), ('cached', config.ttl)):
+            result = await run_lookups(user_id, UserCache(ttl=ttl),
+                                       config.lookups, round_trips)
+            print(f"{name}: {result['lookups_per_second']:.0f} lookups/s, "
+                  f"p95 {result['latency_p95'] * 1000:.3f} ms, "
+                  f"{result['db_round_trips']} round trips", flush=True)
+            results[name] = result
+    finally:
+        await engine.dispose()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare cached and uncached user lookups')
+    parser.add_argument('--lookups', type=int, default=5000)
+    parser.add_argument('--ttl', type=float, default=30)
+    parser.add_argument('--database-url',
+                        help='defaults to a temporary SQLite database')
+    parser.add_argument('--output', default='user_cache_results.json')
+    config = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        # the application reads its settings when its modules are imported
+        os.environ['DATABASE_URL'] = config.database_url or (
+            f"sqlite+aiosqlite:///{os.path.join(work_dir, 'benchmark.db')}")
+        results = asyncio.run(run_benchmarks(config))
+
+    report = {
+        'config': vars(config),
+        'finished_at': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'results': results,
+        'speedup': results['cached']['lookups_per_second']
+        / results['uncached']['lookups_per_second'],
+    }
+    with open(config.output, 'w') as output:
+        json.dump(report, output, indent=2)
+    print(f"Cached lookups are {report['speedup']:.1f} times faster, "
+          f"results saved to {config.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,114 +1,234 @@
 import asyncio
+from chatgpt_fastapi.clients import get_openai_client, textru_post
+from chatgpt_fastapi.hedging import openai_hedger
+from chatgpt_fastapi.length_planner import length_planner, trim_to_sentence
+from chatgpt_fastapi.metrics import (Gauge, openai_request_seconds,
+                                     textru_check_seconds, textru_poll_seconds,
+                                     textru_submit_seconds)
 from chatgpt_fastapi.randomizer import RANDOMIZER_STRINGS
+from chatgpt_fastapi.rate_limiter import openai_limiter
+from chatgpt_fastapi.resilience import (RetryableError, classify_http_error,
+                                        get_breaker, parse_retry_after)
+from chatgpt_fastapi.textru_poller import TextruPoller
+from chatgpt_fastapi.uniqueness_cache import uniqueness_cache
 from dotenv import load_dotenv
-from httpx import AsyncClient
+from functools import partial
 import openai
 import os
 import random
 import time
 
 load_dotenv()
-OPENAI_API_KEY = os.getenv("OPENAI_API")
+OPENAI_EXPECTED_COMPLETION_TOKENS = int(
+    os.getenv("OPENAI_EXPECTED_COMPLETION_TOKENS", 1500))
 TEXTRU_KEY = os.getenv("TEXTRU_KEY")
 TEXTRU_URL = os.getenv("TEXTRU_URL")
+TEXTRU_HEADERS = {
+    "Content-Type": "application/json"
+}
+
+openai_breaker = get_breaker('openai')
+textru_breaker = get_breaker('textru')
 
 
 async def add_randomize_task(randomize_strings):
     return '\n'.join([random.choice(strings) for strings in randomize_strings])
 
 
+async def checked_textru_post(*args, **kwargs):
+    response = await textru_post(*args, **kwargs)
+    if response.status_code == 429 or response.status_code >= 500:
+        raise RetryableError(
+            f'text.ru answered {response.status_code}',
+            parse_retry_after(response.headers.get('retry-after')))
+    return response
+
+
 async def make_async_textru_call(*args, **kwargs):
-    async with AsyncClient() as client:
-        result = await client.post(*args, **kwargs)
-    return result
+    return await textru_breaker.call(
+        partial(checked_textru_post, *args, **kwargs),
+        classify_http_error)
+
+
+def classify_openai_error(error):
+    # (retryable, retry after, counts against the circuit breaker)
+    if isinstance(error, openai.RateLimitError):
+        return True, parse_retry_after(
+            error.response.headers.get('retry-after')), True
+    if isinstance(error, (openai.APIConnectionError,
+                          openai.InternalServerError)):
+        return True, None, True
+    if isinstance(error, openai.APIStatusError) and (
+            error.status_code in (408, 409) or error.status_code >= 500):
+        return True, None, True
+    return False, None, False
+
+
+async def create_completion(full_task, temperature, max_tokens=None):
+    started = time.monotonic()
+    try:
+        raw_response = await (get_openai_client().chat.completions
+                              .with_raw_response.create(
+                                  messages=[
+                                      {
+                                          "role": "user",
+                                          "content": full_task,
+                                      }
+                                  ],
+                                  model="gpt-3.5-turbo",
+                                  temperature=float(temperature),
+                                  max_tokens=max_tokens or openai.NOT_GIVEN
+                              ))
+    except asyncio.CancelledError:
+        # the other request of a hedged pair answered first
+        openai_request_seconds.observe_since(started, outcome='cancelled')
+        raise
+    except Exception as e:
+        if isinstance(e, openai.RateLimitError):
+            openai_limiter.update_from_headers(e.response.headers)
+        openai_request_seconds.observe_since(started, outcome='error',
+                                             error_class=type(e).__name__)
+        raise
+    openai_request_seconds.observe_since(started, outcome='ok')
+    return raw_response
 
 
-async def get_text_from_openai(task, temperature):
-    await asyncio.sleep(5)
+async def request_completion(full_task, temperature, reserved_tokens,
+                             max_tokens=None):
+    await openai_limiter.acquire(reserved_tokens)
+    # a hedge is a real request too, it waits for its own limiter tokens
+    raw_response = await openai_hedger.run(
+        partial(create_completion, full_task, temperature, max_tokens),
+        before_hedge=partial(openai_limiter.acquire, reserved_tokens))
+    openai_limiter.update_from_headers(raw_response.headers)
+    return raw_response.parse()
+
+
+async def get_text_from_openai(task, temperature, max_tokens=None):
     local_time = time.localtime(time.time())
     formatted_time = time.strftime("%Y-%m-%d %H:%M:%S", local_time)
     print(f'send_to_openai, time: {formatted_time}')
     randomize_string = await add_randomize_task(RANDOMIZER_STRINGS)
     full_task = task + '\n' + randomize_string
-    client = openai.AsyncOpenAI(
-        api_key=OPENAI_API_KEY,
-    )
+    # callers plan the length of the completion, the room left next to the
+    # prompt is only known with the randomizer string added
+    max_tokens = length_planner.fit_context(max_tokens, full_task)
+    reserved_tokens = (length_planner.count_tokens(full_task)
+                       + (max_tokens or OPENAI_EXPECTED_COMPLETION_TOKENS))
     try:
-        text_request = await client.chat.completions.create(
-            messages=[
-                {
-                    "role": "user",
-                    "content": full_task,
-                }
-            ],
-            model="gpt-3.5-turbo",
-            temperature=float(temperature)
-        )
+        # transient errors are retried with backoff here, the text only
+        # fails once the retries are used up
+        text_request = await openai_breaker.call(
+            partial(request_completion, full_task, temperature,
+                    reserved_tokens, max_tokens),
+            classify_openai_error)
+        if text_request.usage:
+            openai_limiter.reconcile(reserved_tokens,
+                                     text_request.usage.total_tokens)
         text = str(text_request.choices[0].message.content)
+        usage = text_request.usage
+        if usage:
+            length_planner.observe(text, usage.completion_tokens)
+        if text_request.choices[0].finish_reason == 'length':
+            text = trim_to_sentence(text)
         return {
+            'completion_tokens': usage.completion_tokens if usage else 0,
+            'prompt_tokens': usage.prompt_tokens if usage else 0,
             'text': text,
             'status': 'ok'
         }
     except openai.RateLimitError as e:
+        error = e
         error_details = f'Rate limit error: {e}'
     except openai.AuthenticationError as e:
+        error = e
         error_details = f'Authentication token error: {e}'
     except openai.APIConnectionError as e:
+        error = e
         error_details = f'Unable to connect to OpenAI server: {e}'
     except Exception as e:
+        error = e
         error_details = f'General OpenAI error: {e}'
     return {
+        'error_class': type(error).__name__,
         'text': None,
         'status': error_details
     }
 
 
-async def add_text(text, text_len):
-    task = (f'Допиши пожалуйста следующий текст,'
-            f'что бы его длина составила {text_len}'
-            f' символов или больше:\n{text}')
-    return await get_text_from_openai(task, temperature=1)
+async def continue_text(text, missing_chars):
+    # only the end of the text is sent and only the continuation comes back
+    task = (f'Продолжи следующий текст, не повторяя уже написанное. '
+            f'Напиши только продолжение длиной примерно {missing_chars} '
+            f'символов:\n{length_planner.tail(text)}')
+    return await get_text_from_openai(
+        task, temperature=1,
+        max_tokens=length_planner.max_tokens(missing_chars))
 
 
 async def raise_uniqueness(text, rewriting_task):
     task = f'{rewriting_task}\n{text}'
-    return await get_text_from_openai(task, temperature=1)
+    return await get_text_from_openai(
+        task, temperature=1,
+        max_tokens=length_planner.max_tokens(len(text)))
+
+
+async def poll_text_uniqueness(uid):
+    uid_data = {
+        "uid": uid,
+        "userkey": TEXTRU_KEY
+    }
+    started = time.monotonic()
+    try:
+        response = await make_async_textru_call(TEXTRU_URL,
+                                                json=uid_data,
+                                                headers=TEXTRU_HEADERS)
+        data = response.json()
+    except Exception as e:
+        textru_poll_seconds.observe_since(started, outcome='error',
+                                          error_class=type(e).__name__)
+        raise
+    textru_poll_seconds.observe_since(
+        started, outcome='ready' if 'text_unique' in data else 'pending')
+    return data
+
+
+textru_poller = TextruPoller(poll_text_uniqueness)
+Gauge('textru_pending_checks', 'Texts waiting for their text.ru result',
+      callback=lambda: {(): textru_poller.as_dict()['pending']})
 
 
 async def get_text_uniqueness(text):
-    await asyncio.sleep(10)
+    cached_uniqueness = await uniqueness_cache.get(text)
+    if cached_uniqueness is not None:
+        return cached_uniqueness
+    started = time.monotonic()
     local_time = time.localtime(time.time())
     formatted_time = time.strftime("%Y-%m-%d %H:%M:%S", local_time)
     print(f'send_to_text.ru, time: {formatted_time}')
-    headers = {
-        "Content-Type": "application/json"
-    }
     text_data = {
         "text": text,
         "userkey": TEXTRU_KEY
     }
-    response = await make_async_textru_call(TEXTRU_URL,
-                                            json=text_data,
-                                            headers=headers)
-    uid = response.json().get('text_uid')
+    try:
+        response = await make_async_textru_call(TEXTRU_URL,
+                                                json=text_data,
+                                                headers=TEXTRU_HEADERS)
+        uid = response.json().get('text_uid')
+    except Exception as e:
+        textru_submit_seconds.observe_since(started, outcome='error',
+                                            error_class=type(e).__name__)
+        raise
+    textru_submit_seconds.observe_since(
+        started, outcome='ok' if uid else 'rejected')
     if not uid:
         return 0
-    attempts = 0
-    uid_data = {
-        "uid": uid,
-        "userkey": TEXTRU_KEY
-    }
-    while attempts < 10:
-        # due to the slow work of text.ru api, we wait and periodically send
-        # request to server until we get right response
-        attempts += 1
-        if attempts <= 5:
-            # first five attempts have longer time intervals
-            await asyncio.sleep(20)
-        await asyncio.sleep(60)
-        response = await make_async_textru_call(TEXTRU_URL,
-                                                json=uid_data,
-                                                headers=headers)
-        if 'text_unique' in response.json():
-            return float(response.json()["text_unique"])
-    return 0
+    # due to the slow work of text.ru api, the result is collected by the
+    # shared poller, which resolves it as soon as the server has it ready
+    uniqueness = await textru_poller.wait_for(uid)
+    textru_check_seconds.observe_since(
+        started, outcome='ok' if uniqueness else 'timeout')
+    if uniqueness:
+        await uniqueness_cache.put(text, uniqueness,
+                                   time.monotonic() - started)
+    return uniqueness
@@ -0,0 +1,140 @@
+import asyncio
+from dotenv import load_dotenv
+from fastapi import Request
+from fastapi.responses import FileResponse, Response, StreamingResponse
+import hashlib
+import logging
+import os
+import re
+import tempfile
+
+load_dotenv()
+ARTIFACT_DIR = os.getenv("ARTIFACT_DIR", "artifacts")
+ARTIFACT_MAX_BYTES = int(os.getenv("ARTIFACT_MAX_BYTES", 5 * 1024 ** 3))
+ARTIFACT_READ_CHUNK_SIZE = 64 * 1024
+
+
+def artifact_path(digest: str):
+    return os.path.join(ARTIFACT_DIR, f'{digest}.zip')
+
+
+async def store_artifact(chunks):
+    # the file is named after the sha256 of its content, so identical
+    # archives are kept once and a name never points to changed bytes
+    os.makedirs(ARTIFACT_DIR, exist_ok=True)
+    digest = hashlib.sha256()
+    file_descriptor, temp_path = tempfile.mkstemp(dir=ARTIFACT_DIR,
+                                                  suffix='.part')
+    try:
+        with os.fdopen(file_descriptor, 'wb') as artifact:
+            async for chunk in chunks:
+                digest.update(chunk)
+                await asyncio.to_thread(artifact.write, chunk)
+        os.replace(temp_path, artifact_path(digest.hexdigest()))
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    evict_artifacts(keep=digest.hexdigest())
+    return digest.hexdigest()
+
+
+def remove_artifact(digest: str):
+    try:
+        os.remove(artifact_path(digest))
+    except FileNotFoundError:
+        pass
+
+
+def evict_artifacts(keep: str = None, max_bytes: int = None):
+    max_bytes = max_bytes or ARTIFACT_MAX_BYTES
+    artifacts = []
+    with os.scandir(ARTIFACT_DIR) as entries:
+        for entry in entries:
+            if entry.name.endswith('.zip'):
+                stat = entry.stat()
+                artifacts.append((stat.st_mtime, stat.st_size, entry.name))
+    total_size = sum(size for _, size, _ in artifacts)
+    # served artifacts get their mtime renewed, the least recently used
+    # ones go first
+    for _, size, name in sorted(artifacts):
+        if total_size <= max_bytes:
+            break
+        if name == f'{keep}.zip':
+            continue
+        try:
+            os.remove(os.path.join(ARTIFACT_DIR, name))
+        except FileNotFoundError:
+            pass
+        total_size -= size
+        logging.info(f"Artifact {name} evicted")
+
+
+def parse_range(range_header: str, size: int):
+    match = re.fullmatch(r'bytes=(\d*)-(\d*)', range_header.strip())
+    if not match or match.groups() == ('', ''):
+        return None
+    start, end = match.groups()
+    if not start:
+        # suffix range, the last N bytes
+        length = int(end)
+        if not length:
+            return None
+        return max(0, size - length), size - 1
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start > end:
+        return None
+    return start, end
+
+
+async def iter_file_range(path: str, start: int, end: int):
+    with open(path, 'rb') as artifact:
+        artifact.seek(start)
+        remaining = end - start + 1
+        while remaining:
+            chunk = await asyncio.to_thread(
+                artifact.read, min(ARTIFACT_READ_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def artifact_response(request: Request, digest: str, filename: str):
+    path = artifact_path(digest)
+    try:
+        stat_result = os.stat(path)
+        os.utime(path)
+    except FileNotFoundError:
+        # evicted since the caller looked it up
+        return None
+    size = stat_result.st_size
+    etag = f'"{digest}"'
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'Content-Disposition': f'attachment; filename="{filename}"',
+        'ETag': etag,
+    }
+
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match and (if_none_match.strip() == '*' or etag in [
+            tag.strip().removeprefix('W/')
+            for tag in if_none_match.split(',')]):
+        return Response(status_code=304, headers={'ETag': etag})
+
+    range_header = request.headers.get('range')
+    if_range = request.headers.get('if-range')
+    if range_header and (not if_range or if_range.strip() == etag):
+        byte_range = parse_range(range_header, size)
+        if byte_range is None:
+            return Response(status_code=416,
+                            headers={'Content-Range': f'bytes */{size}'})
+        start, end = byte_range
+        headers['Content-Length'] = str(end - start + 1)
+        headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+        return StreamingResponse(iter_file_range(path, start, end),
+                                 status_code=206, headers=headers,
+                                 media_type='application/zip')
+
+    return FileResponse(path, headers=headers, media_type='application/zip',
+                        stat_result=stat_result)
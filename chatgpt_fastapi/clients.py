@@ -0,0 +1,170 @@
+from dotenv import load_dotenv
+from httpx import AsyncClient, Limits, Timeout
+import importlib.util
+import logging
+import openai
+import os
+import time
+
+load_dotenv()
+OPENAI_API_KEY = os.getenv("OPENAI_API")
+# point it at a compatible server, e.g. the fake one of the benchmarks
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL")
+# the file and batch endpoints are called with plain httpx, they are not
+# in every version of the openai package
+OPENAI_BATCH_TIMEOUT = float(os.getenv("OPENAI_BATCH_TIMEOUT", 300))
+TEXTRU_MAX_CONNECTIONS = int(os.getenv("TEXTRU_MAX_CONNECTIONS", 20))
+TEXTRU_MAX_KEEPALIVE_CONNECTIONS = int(
+    os.getenv("TEXTRU_MAX_KEEPALIVE_CONNECTIONS", 10))
+TEXTRU_KEEPALIVE_EXPIRY = float(os.getenv("TEXTRU_KEEPALIVE_EXPIRY", 30))
+TEXTRU_CONNECT_TIMEOUT = float(os.getenv("TEXTRU_CONNECT_TIMEOUT", 10))
+TEXTRU_READ_TIMEOUT = float(os.getenv("TEXTRU_READ_TIMEOUT", 30))
+TEXTRU_POOL_TIMEOUT = float(os.getenv("TEXTRU_POOL_TIMEOUT", 60))
+TEXTRU_HTTP2 = os.getenv("TEXTRU_HTTP2", "false").lower() == "true"
+
+
+class PoolWaitStats:
+    def __init__(self):
+        self.requests = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.last_wait = 0.0
+
+    def record(self, wait):
+        self.requests += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        self.last_wait = wait
+
+    def as_dict(self):
+        return {
+            'requests': self.requests,
+            'avg_wait': self.total_wait / self.requests if self.requests
+            else 0.0,
+            'max_wait': self.max_wait,
+            'last_wait': self.last_wait,
+        }
+
+
+openai_client: openai.AsyncOpenAI | None = None
+openai_batch_client: AsyncClient | None = None
+textru_client: AsyncClient | None = None
+textru_pool_wait_stats = PoolWaitStats()
+
+
+def get_openai_client() -> openai.AsyncOpenAI:
+    global openai_client
+    if openai_client is None:
+        # retries are done by the shared resilience layer, which also
+        # feeds the circuit breaker
+        openai_client = openai.AsyncOpenAI(api_key=OPENAI_API_KEY,
+                                           base_url=OPENAI_BASE_URL,
+                                           max_retries=0)
+    return openai_client
+
+
+async def close_openai_client():
+    global openai_client
+    if openai_client is not None:
+        await openai_client.close()
+        openai_client = None
+
+
+def get_openai_batch_client() -> AsyncClient:
+    global openai_batch_client
+    if openai_batch_client is None or openai_batch_client.is_closed:
+        openai_batch_client = AsyncClient(
+            base_url=OPENAI_BASE_URL or 'https://api.openai.com/v1',
+            headers={'Authorization': f'Bearer {OPENAI_API_KEY}'},
+            timeout=OPENAI_BATCH_TIMEOUT
+        )
+    return openai_batch_client
+
+
+async def close_openai_batch_client():
+    global openai_batch_client
+    if openai_batch_client is not None:
+        await openai_batch_client.aclose()
+        openai_batch_client = None
+
+
+def _http2_available():
+    if not TEXTRU_HTTP2:
+        return False
+    if importlib.util.find_spec('h2') is None:
+        logging.warning("TEXTRU_HTTP2 is set, but the h2 package is not "
+                        "installed, falling back to HTTP/1.1")
+        return False
+    return True
+
+
+def get_textru_client() -> AsyncClient:
+    global textru_client
+    if textru_client is None or textru_client.is_closed:
+        textru_client = AsyncClient(
+            http2=_http2_available(),
+            limits=Limits(
+                max_connections=TEXTRU_MAX_CONNECTIONS,
+                max_keepalive_connections=TEXTRU_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=TEXTRU_KEEPALIVE_EXPIRY
+            ),
+            timeout=Timeout(
+                TEXTRU_READ_TIMEOUT,
+                connect=TEXTRU_CONNECT_TIMEOUT,
+                pool=TEXTRU_POOL_TIMEOUT
+            )
+        )
+    return textru_client
+
+
+async def close_textru_client():
+    global textru_client
+    if textru_client is not None:
+        await textru_client.aclose()
+        textru_client = None
+
+
+async def textru_post(*args, **kwargs):
+    started = time.monotonic()
+    acquired = None
+
+    async def trace(event_name, info):
+        # the first trace event is emitted right after the pool handed a
+        # connection to the request, everything before it is pool waiting
+        nonlocal acquired
+        if acquired is None:
+            acquired = time.monotonic()
+
+    try:
+        return await get_textru_client().post(*args,
+                                              extensions={'trace': trace},
+                                              **kwargs)
+    finally:
+        textru_pool_wait_stats.record((acquired or time.monotonic())
+                                      - started)
+
+
+def get_textru_pool_stats():
+    stats = {
+        'connections': 0,
+        'in_use': 0,
+        'idle': 0,
+        'queued_requests': 0,
+        'http2': TEXTRU_HTTP2,
+        'max_connections': TEXTRU_MAX_CONNECTIONS,
+        'max_keepalive_connections': TEXTRU_MAX_KEEPALIVE_CONNECTIONS,
+    }
+    stats.update(textru_pool_wait_stats.as_dict())
+    if textru_client is None:
+        return stats
+    pool = getattr(textru_client._transport, '_pool', None)
+    if pool is None:
+        return stats
+    connections = pool.connections
+    stats['connections'] = len(connections)
+    stats['idle'] = sum(1 for conn in connections if conn.is_idle())
+    stats['in_use'] = stats['connections'] - stats['idle']
+    stats['queued_requests'] = sum(
+        1 for request in getattr(pool, '_requests', [])
+        if request.is_queued())
+    return stats
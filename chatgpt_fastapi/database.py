@@ -1,7 +1,7 @@
 from chatgpt_fastapi.models import Base, User
+from chatgpt_fastapi.user_cache import CachedUserDatabase
 from dotenv import load_dotenv
 from fastapi import Depends
-from fastapi_users.db import SQLAlchemyUserDatabase
 import os
 from sqlalchemy.ext.asyncio import (AsyncSession, async_sessionmaker,
                                     create_async_engine)
@@ -27,4 +27,4 @@ async def get_async_session() -> typing.AsyncGenerator[AsyncSession, None]:
 
 
 async def get_user_db(session: AsyncSession = Depends(get_async_session)):
-    yield SQLAlchemyUserDatabase(session, User)
+    yield CachedUserDatabase(session, User)
@@ -0,0 +1,107 @@
+import asyncio
+from chatgpt_fastapi.metrics import Counter, Gauge
+from collections import deque
+from dotenv import load_dotenv
+import os
+import time
+
+load_dotenv()
+OPENAI_HEDGING = os.getenv("OPENAI_HEDGING", "false").lower() == "true"
+OPENAI_HEDGE_PERCENTILE = float(os.getenv("OPENAI_HEDGE_PERCENTILE", 0.95))
+OPENAI_HEDGE_MAX_RATE = float(os.getenv("OPENAI_HEDGE_MAX_RATE", 0.05))
+OPENAI_HEDGE_MIN_SAMPLES = int(os.getenv("OPENAI_HEDGE_MIN_SAMPLES", 50))
+HEDGE_WINDOW = 500
+
+hedges_total = Counter('hedged_requests_total',
+                       'Duplicate requests sent for slow calls',
+                       ('upstream', 'result'))
+
+
+class Hedger:
+    # when a call is slower than the given percentile of recent calls, a
+    # duplicate is sent and the first answer wins. The share of hedged calls
+    # among recent ones is capped, so a slow upstream does not double the
+    # quota spent on it
+
+    def __init__(self, name, enabled=OPENAI_HEDGING,
+                 percentile=OPENAI_HEDGE_PERCENTILE,
+                 max_rate=OPENAI_HEDGE_MAX_RATE,
+                 min_samples=OPENAI_HEDGE_MIN_SAMPLES, window=HEDGE_WINDOW):
+        self.name = name
+        self.enabled = enabled
+        self.percentile = percentile
+        self.max_rate = max_rate
+        self.min_samples = min_samples
+        self._latencies = deque(maxlen=window)
+        self._hedged = deque(maxlen=window)
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def delay(self):
+        if len(self._latencies) < self.min_samples:
+            return None
+        latencies = sorted(self._latencies)
+        return latencies[min(len(latencies) - 1,
+                             int(self.percentile * len(latencies)))]
+
+    def _may_hedge(self):
+        return sum(self._hedged) < self.max_rate * max(len(self._hedged), 1)
+
+    async def _timed(self, call, before=None):
+        if before is not None:
+            await before()
+        started = time.monotonic()
+        result = await call()
+        self._latencies.append(time.monotonic() - started)
+        return result
+
+    async def run(self, call, before_hedge=None):
+        self.requests += 1
+        delay = self.delay() if self.enabled else None
+        primary = asyncio.create_task(self._timed(call))
+        if delay is None:
+            self._hedged.append(False)
+            return await primary
+        tasks = {primary}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if done or not self._may_hedge():
+                self._hedged.append(False)
+                return await primary
+            self._hedged.append(True)
+            self.hedges += 1
+            hedge = asyncio.create_task(self._timed(call, before_hedge))
+            tasks.add(hedge)
+            while True:
+                done, _ = await asyncio.wait(
+                    tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    tasks.discard(task)
+                    if task.exception() is None or not tasks:
+                        won = task is hedge and task.exception() is None
+                        self.hedge_wins += won
+                        hedges_total.inc(upstream=self.name,
+                                         result='won' if won else 'lost')
+                        return task.result()
+                # the first answer was an error, wait for the other one
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def as_dict(self):
+        return {
+            'delay': self.delay(),
+            'enabled': self.enabled,
+            'hedge_rate': self.hedges / self.requests if self.requests
+            else 0,
+            'hedge_wins': self.hedge_wins,
+            'hedges': self.hedges,
+            'requests': self.requests,
+        }
+
+
+openai_hedger = Hedger('openai')
+Gauge('hedged_request_rate', 'Share of calls that were hedged',
+      ('upstream',),
+      callback=lambda: {('openai',): openai_hedger.as_dict()['hedge_rate']})
@@ -0,0 +1,156 @@
+from chatgpt_fastapi.metrics import Gauge, db_commit_seconds
+from chatgpt_fastapi.models import TextJob
+from datetime import datetime, timedelta, timezone
+from dotenv import load_dotenv
+import os
+from sqlalchemy import and_, func, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+import time
+
+load_dotenv()
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", 60))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", 3))
+ACTIVE_JOB_STATUSES = ('queued', 'running')
+# the job stopped before every line of the set had an outcome
+RESUMABLE_JOB_STATUSES = ('cancelled', 'failed')
+JOB_STATUSES = ('cancelled', 'done', 'failed', 'queued', 'running')
+
+
+def utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+async def enqueue_text_set_job(session: AsyncSession, parsing_set_id: int,
+                               parameters: dict, priority: int = 0):
+    job = TextJob(
+        parameters=parameters,
+        parsing_set_id=parsing_set_id,
+        priority=priority,
+        status='queued'
+    )
+    session.add(job)
+    return job
+
+
+async def claim_job(session: AsyncSession, worker_id: str):
+    # queued jobs and jobs whose worker stopped sending heartbeats are both
+    # claimable, SKIP LOCKED lets concurrent workers pass over each other
+    while True:
+        now = utcnow()
+        job_query = (
+            select(TextJob)
+            .where(or_(TextJob.status == 'queued',
+                       and_(TextJob.status == 'running',
+                            TextJob.locked_until < now)))
+            .order_by(TextJob.priority.desc(), TextJob.id)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+        )
+        result = await session.execute(job_query)
+        job = result.scalars().first()
+        if job is None:
+            await session.rollback()
+            return None
+        if job.attempts >= JOB_MAX_ATTEMPTS:
+            job.status = 'failed'
+            job.error = f'Lease expired {job.attempts} times: {job.error}'
+            job.finished_at = now
+            await session.commit()
+            continue
+        job.attempts += 1
+        job.heartbeat_at = now
+        job.locked_by = worker_id
+        job.locked_until = now + timedelta(seconds=JOB_LEASE_SECONDS)
+        job.status = 'running'
+        claimed = {
+            'attempts': job.attempts,
+            'id': job.id,
+            'parameters': dict(job.parameters or {}),
+            'parsing_set_id': job.parsing_set_id,
+        }
+        started = time.monotonic()
+        await session.commit()
+        db_commit_seconds.observe_since(started, operation='job_claim')
+        return claimed
+
+
+async def heartbeat_job(session: AsyncSession, job_id: int, worker_id: str):
+    now = utcnow()
+    result = await session.execute(
+        update(TextJob)
+        .where(TextJob.id == job_id, TextJob.locked_by == worker_id,
+               TextJob.status == 'running')
+        .values(heartbeat_at=now,
+                locked_until=now + timedelta(seconds=JOB_LEASE_SECONDS))
+    )
+    started = time.monotonic()
+    await session.commit()
+    db_commit_seconds.observe_since(started, operation='job_heartbeat')
+    # no row means another worker took the job over after our lease
+    # expired, or the set was cancelled
+    return result.rowcount == 1
+
+
+async def finish_job(session: AsyncSession, job_id: int, worker_id: str,
+                     error: str = None):
+    await session.execute(
+        update(TextJob)
+        .where(TextJob.id == job_id, TextJob.locked_by == worker_id)
+        .values(error=error or '',
+                finished_at=utcnow(),
+                locked_by=None,
+                locked_until=None,
+                status='failed' if error else 'done')
+    )
+    await session.commit()
+
+
+async def release_job(session: AsyncSession, job_id: int, worker_id: str):
+    await session.execute(
+        update(TextJob)
+        .where(TextJob.id == job_id, TextJob.locked_by == worker_id,
+               TextJob.status == 'running')
+        .values(attempts=TextJob.attempts - 1, locked_by=None,
+                locked_until=None, status='queued')
+    )
+    await session.commit()
+
+
+async def get_set_jobs(session: AsyncSession, parsing_set_id: int):
+    # the latest job first
+    result = await session.execute(
+        select(TextJob)
+        .where(TextJob.parsing_set_id == parsing_set_id)
+        .order_by(TextJob.id.desc())
+    )
+    return result.scalars().all()
+
+
+async def cancel_set_jobs(session: AsyncSession, parsing_set_id: int):
+    # the worker of a running job notices it with its next heartbeat
+    result = await session.execute(
+        update(TextJob)
+        .where(TextJob.parsing_set_id == parsing_set_id,
+               TextJob.status.in_(ACTIVE_JOB_STATUSES))
+        .values(finished_at=utcnow(), locked_by=None, locked_until=None,
+                status='cancelled')
+    )
+    await session.commit()
+    return result.rowcount
+
+
+job_queue_jobs = Gauge('job_queue_jobs', 'Text set jobs by status',
+                       ('status',))
+
+
+async def get_queue_stats(session: AsyncSession):
+    result = await session.execute(
+        select(TextJob.status, func.count()).group_by(TextJob.status))
+    stats = dict(result.all())
+    # a status without jobs is missing from the result, its gauge goes
+    # back to 0 instead of keeping the last count
+    for status in JOB_STATUSES:
+        job_queue_jobs.set(stats.get(status, 0), status=status)
+    for status, count in stats.items():
+        job_queue_jobs.set(count, status=status)
+    return stats
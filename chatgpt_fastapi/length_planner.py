@@ -0,0 +1,121 @@
+from dotenv import load_dotenv
+import logging
+import math
+import os
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+load_dotenv()
+OPENAI_CHARS_PER_TOKEN = float(os.getenv("OPENAI_CHARS_PER_TOKEN", 2))
+OPENAI_CONTEXT_TOKENS = int(os.getenv("OPENAI_CONTEXT_TOKENS", 4096))
+# planned completions get this much room above the requested length, so the
+# model finishes its last sentence instead of being cut off
+LENGTH_HEADROOM = float(os.getenv("LENGTH_HEADROOM", 1.5))
+# how much of the end of a text is sent with a request for its continuation
+CONTINUATION_CONTEXT_TOKENS = int(
+    os.getenv("CONTINUATION_CONTEXT_TOKENS", 600))
+MIN_COMPLETION_TOKENS = 256
+
+
+def _load_encoding():
+    if tiktoken is None:
+        logging.info("tiktoken is not installed, tokens are estimated by "
+                     "the length of the text")
+        return None
+    try:
+        return tiktoken.encoding_for_model('gpt-3.5-turbo')
+    except Exception as e:
+        # the encodings are downloaded on first use, offline hosts fall
+        # back to the estimate
+        logging.warning(f"Can't load the tokenizer: {e}")
+        return None
+
+
+def trim_to_sentence(text):
+    # a completion that ran into max_tokens is cut at its last full sentence
+    end = max(text.rfind(mark) for mark in ('.', '!', '?', '…'))
+    if end <= 0:
+        return text
+    return text[:end + 1]
+
+
+def append_continuation(text, continuation):
+    separator = '\n\n' if continuation.startswith('\n') else ' '
+    return text.rstrip() + separator + continuation.strip()
+
+
+class LengthPlanner:
+    # completions are planned in tokens, but the length of a text is asked
+    # for in characters. The characters per token ratio of the completions
+    # we got so far converts between the two
+
+    def __init__(self, chars_per_token=OPENAI_CHARS_PER_TOKEN,
+                 headroom=LENGTH_HEADROOM,
+                 context_tokens=OPENAI_CONTEXT_TOKENS):
+        self.chars_per_token = chars_per_token
+        self.headroom = headroom
+        self.context_tokens = context_tokens
+        self._encoding = None
+        self._encoding_loaded = False
+        self.observed_chars = 0
+        self.observed_tokens = 0
+
+    @property
+    def encoding(self):
+        if not self._encoding_loaded:
+            self._encoding = _load_encoding()
+            self._encoding_loaded = True
+        return self._encoding
+
+    def count_tokens(self, text):
+        if self.encoding is not None:
+            return len(self.encoding.encode(text))
+        return int(len(text) / self.chars_per_token) + 1
+
+    def tail(self, text, tokens=CONTINUATION_CONTEXT_TOKENS):
+        # the last tokens of a text, cut at a word boundary
+        if self.encoding is not None:
+            token_ids = self.encoding.encode(text)
+            if len(token_ids) <= tokens:
+                return text
+            tail = self.encoding.decode(token_ids[-tokens:])
+        else:
+            chars = int(tokens * self.chars_per_token)
+            if len(text) <= chars:
+                return text
+            tail = text[-chars:]
+        return tail.split(' ', 1)[-1]
+
+    def observe(self, text, completion_tokens):
+        if text and completion_tokens:
+            self.observed_chars += len(text)
+            self.observed_tokens += completion_tokens
+            self.chars_per_token = self.observed_chars / self.observed_tokens
+
+    def max_tokens(self, chars, prompt=''):
+        if not chars:
+            return None
+        planned = max(MIN_COMPLETION_TOKENS,
+                      math.ceil(chars / self.chars_per_token * self.headroom))
+        return self.fit_context(planned, prompt)
+
+    def fit_context(self, max_tokens, prompt):
+        # the prompt and the completion share the context window
+        if not max_tokens or not prompt:
+            return max_tokens
+        return max(min(max_tokens,
+                       self.context_tokens - self.count_tokens(prompt)), 1)
+
+    def as_dict(self):
+        return {
+            'chars_per_token': self.chars_per_token,
+            'observed_tokens': self.observed_tokens,
+            'tokenizer': self.encoding.name if self.encoding is not None
+            else None,
+        }
+
+
+length_planner = LengthPlanner()
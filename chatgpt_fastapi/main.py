@@ -1,17 +1,55 @@
+import asyncio
+from chatgpt_fastapi.api_utils import textru_poller
+from chatgpt_fastapi.artifacts import artifact_response
+from chatgpt_fastapi.clients import (close_openai_batch_client,
+                                     close_openai_client,
+                                     close_textru_client, get_openai_client,
+                                     get_textru_client,
+                                     get_textru_pool_stats)
 from chatgpt_fastapi.database import create_db_and_tables, get_async_session
-from chatgpt_fastapi.models import TextsParsingSet, User
-from chatgpt_fastapi.services import (generate_texts, get_text_set,
-                                      generate_text_set_zip)
-from chatgpt_fastapi.schemas import UserCreate, UserRead, UserUpdate
+from chatgpt_fastapi.hedging import openai_hedger
+from chatgpt_fastapi.job_queue import get_queue_stats
+from chatgpt_fastapi.metrics import render_metrics
+from chatgpt_fastapi.models import User
+from chatgpt_fastapi.near_duplicates import near_duplicate_index
+from chatgpt_fastapi.progress import (event_stream_response, progress_hub,
+                                      progress_relay)
+from chatgpt_fastapi.rate_limiter import openai_limiter
+from chatgpt_fastapi.resilience import breakers
+from chatgpt_fastapi.scheduler import text_scheduler
+from chatgpt_fastapi.services import (
+    GENERATION_MODES, RETRYABLE_OUTCOMES, build_text_set_zip_artifact,
+    cancel_text_set, create_text_set, get_outcome_counts,
+    get_text_set, get_text_sets_page, remove_text_set, resume_text_set,
+    retry_text_set_lines, stream_text_set_zip, text_flights, text_pipeline)
+from chatgpt_fastapi.schemas import (TextSetImport, UserCreate, UserRead,
+                                     UserUpdate)
+from chatgpt_fastapi.system_usage import system_usage_sampler
+from chatgpt_fastapi.task_import import (TASK_FILE_FORMATS, TaskImportError,
+                                         guess_task_file_format,
+                                         iter_json_tasks, iter_task_file)
+from chatgpt_fastapi.uniqueness_cache import uniqueness_cache
+from chatgpt_fastapi.user_cache import user_cache
 from chatgpt_fastapi.users import auth_backend, fastapi_users
-from fastapi import BackgroundTasks, Depends, FastAPI, Form, Request, status
-from fastapi.responses import (HTMLResponse, RedirectResponse, Response,
-                               StreamingResponse)
+from chatgpt_fastapi.worker import run_worker
+from dotenv import load_dotenv
+from fastapi import (Depends, FastAPI, File, Form, Request, UploadFile,
+                     status)
+from fastapi.responses import (HTMLResponse, JSONResponse, PlainTextResponse,
+                               RedirectResponse, Response, StreamingResponse)
 from fastapi.templating import Jinja2Templates
-from sqlalchemy import select
+import os
+import socket
 from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.background import BackgroundTask
+
+load_dotenv()
+# generation normally runs in separate worker processes, set APP_WORKERS to
+# also process queued sets inside the web application
+APP_WORKERS = int(os.getenv("APP_WORKERS", 0))
 
 app = FastAPI()
+app_worker_stop = asyncio.Event()
 current_user = fastapi_users.current_user()
 templates = Jinja2Templates(directory="chatgpt_fastapi/templates")
 
@@ -45,6 +83,30 @@ app.include_router(
 @app.on_event("startup")
 async def on_startup():
     await create_db_and_tables()
+    get_openai_client()
+    get_textru_client()
+    system_usage_sampler.start()
+    progress_relay.start()
+    if APP_WORKERS:
+        near_duplicate_index.request_refresh()
+        worker_id = f'{socket.gethostname()}:{os.getpid()}:app'
+        app.state.worker = asyncio.create_task(
+            run_worker(worker_id, APP_WORKERS, app_worker_stop))
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    if APP_WORKERS:
+        app_worker_stop.set()
+        await app.state.worker
+        await near_duplicate_index.close()
+        await text_pipeline.close()
+    await textru_poller.close()
+    await progress_relay.close()
+    await system_usage_sampler.close()
+    await close_openai_client()
+    await close_openai_batch_client()
+    await close_textru_client()
 
 
 @app.get("/", response_class=HTMLResponse)
@@ -72,21 +134,89 @@ async def logout(request: Request):
     return response
 
 
+@app.get("/stats")
+async def get_stats(session: AsyncSession = Depends(get_async_session),
+                    user: User = Depends(fastapi_users.current_user())):
+    return {
+        'circuit_breakers': {name: breaker.as_dict()
+                             for name, breaker in breakers.items()},
+        'job_queue': await get_queue_stats(session),
+        'near_duplicate_index': near_duplicate_index.as_dict(),
+        'openai_hedging': openai_hedger.as_dict(),
+        'openai_limiter': openai_limiter.as_dict(),
+        'pipeline': text_pipeline.as_dict(),
+        'progress': progress_hub.as_dict(),
+        'scheduler': text_scheduler.as_dict(),
+        'single_flight': text_flights.as_dict(),
+        'textru_poller': textru_poller.as_dict(),
+        'textru_pool': get_textru_pool_stats(),
+        'uniqueness_cache': uniqueness_cache.as_dict(),
+        'user_cache': user_cache.as_dict()
+    }
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics(session: AsyncSession = Depends(get_async_session)):
+    # the job queue lives in the database, the other gauges are read from
+    # this process
+    await get_queue_stats(session)
+    return PlainTextResponse(render_metrics(),
+                             media_type='text/plain; version=0.0.4')
+
+
 @app.get("/texts_list", response_class=HTMLResponse)
 async def list_text_sets(request: Request,
                          session: AsyncSession = Depends(get_async_session),
+                         author: str = None,
+                         before: int = None,
+                         status: str = None,
                          user: User = Depends(fastapi_users.current_user())):
-    result = await session.execute(select(TextsParsingSet, User.email)
-                                   .join(User,
-                                         TextsParsingSet.author == User.id)
-                                   .order_by(TextsParsingSet.id))
-    parsing_sets = result.all()
+    parsing_sets, outcome_counts, next_cursor = await get_text_sets_page(
+        session,
+        author_email=author,
+        is_complete={'complete': True, 'running': False}.get(status),
+        before=before
+    )
     return templates.TemplateResponse("texts_parsing_sets.html",
-                                      {"parsing_sets": parsing_sets,
+                                      {"author": author or '',
+                                       "next_cursor": next_cursor,
+                                       "outcome_counts": outcome_counts,
+                                       "parsing_sets": parsing_sets,
                                        "request": request,
+                                       "status": status or '',
                                        "user": user})
 
 
+@app.get("/text_sets/events")
+async def user_text_set_events(user: User = Depends(
+        fastapi_users.current_user())):
+    return event_stream_response(f'user:{user.id}')
+
+
+@app.get("/text_sets/{text_set_id}/events")
+async def text_set_events(session: AsyncSession = Depends(get_async_session),
+                          text_set_id: int = None,
+                          user: User = Depends(fastapi_users.current_user())):
+    text_set = await get_text_set(session=session, text_set_id=text_set_id)
+    if not text_set:
+        return Response(content="Text set not found", status_code=404)
+    counts = (await get_outcome_counts(session, [text_set_id],
+                                       include_ok=True)).get(text_set_id, {})
+    # the state so far, the stream only has what happens from now on
+    first_event = {
+        'author': str(text_set.author),
+        'counts': counts,
+        'done': sum(counts.values()),
+        'is_complete': text_set.is_complete,
+        'text_set_id': text_set_id,
+        'total': text_set.total_amount,
+        'type': 'snapshot',
+    }
+    # the stream stays open for long, don't hold a database connection
+    await session.close()
+    return event_stream_response(f'set:{text_set_id}', first_event)
+
+
 @app.get("/delete_text_set/{text_set_id}")
 async def get_text_set_for_delete(request: Request,
                                   session: AsyncSession = Depends(
@@ -114,8 +244,58 @@ async def delete_text_set(request: Request,
     text_set_to_delete = await get_text_set(session=session,
                                             text_set_id=text_set_id)
     if text_set_to_delete:
-        await session.delete(text_set_to_delete)
-        await session.commit()
+        await remove_text_set(session, text_set_id)
+    return RedirectResponse(url='/texts_list', status_code=303)
+
+
+@app.post("/text_sets/{text_set_id}/cancel")
+async def cancel_text_set_run(session: AsyncSession = Depends(
+                                  get_async_session),
+                              text_set_id: int = None,
+                              user: User = Depends(
+                                  fastapi_users.current_user())):
+    text_set = await get_text_set(session=session, text_set_id=text_set_id)
+    if not text_set:
+        return Response(content="Text set not found", status_code=404)
+    if not await cancel_text_set(session, text_set):
+        return Response(content="Text set is not running", status_code=409)
+    return RedirectResponse(url='/texts_list', status_code=303)
+
+
+@app.post("/text_sets/{text_set_id}/resume")
+async def resume_text_set_run(session: AsyncSession = Depends(
+                                  get_async_session),
+                              text_set_id: int = None,
+                              user: User = Depends(
+                                  fastapi_users.current_user())):
+    text_set = await get_text_set(session=session, text_set_id=text_set_id)
+    if not text_set:
+        return Response(content="Text set not found", status_code=404)
+    if text_set.is_complete or not await resume_text_set(session,
+                                                         text_set_id):
+        return Response(content="Only cancelled or failed text sets can "
+                                "be resumed", status_code=409)
+    return RedirectResponse(url='/texts_list', status_code=303)
+
+
+@app.post("/text_sets/{text_set_id}/retry")
+async def retry_text_set_run(session: AsyncSession = Depends(
+                                 get_async_session),
+                             statuses: list[str] = Form(
+                                 list(RETRYABLE_OUTCOMES)),
+                             text_set_id: int = None,
+                             user: User = Depends(
+                                 fastapi_users.current_user())):
+    if not set(statuses) <= set(RETRYABLE_OUTCOMES):
+        return Response(content="Only failed and low uniqueness texts "
+                                "can be retried", status_code=400)
+    text_set = await get_text_set(session=session, text_set_id=text_set_id)
+    if not text_set:
+        return Response(content="Text set not found", status_code=404)
+    if not await retry_text_set_lines(session, text_set_id,
+                                      tuple(statuses)):
+        return Response(content="Text set is running or has nothing to "
+                                "retry", status_code=409)
     return RedirectResponse(url='/texts_list', status_code=303)
 
 
@@ -125,18 +305,27 @@ async def download_text_set(request: Request,
                             text_set_id: int = None,
                             user: User = Depends(
                                 fastapi_users.current_user())):
-    zip_buffer = await generate_text_set_zip(session=session,
-                                             text_set_id=text_set_id)
-
-    def iterfile():
-        yield from zip_buffer
+    text_set = await get_text_set(session=session, text_set_id=text_set_id)
+    if not text_set:
+        return Response(content="Text set not found", status_code=404)
+    filename = f'{text_set_id}.zip'
+    if text_set.zip_artifact:
+        response = artifact_response(request, text_set.zip_artifact,
+                                     filename)
+        if response is not None:
+            return response
 
-    zip_buffer.seek(0)
     headers = {
-        'Content-Disposition': f'attachment; filename="{text_set_id}.zip"'
+        'Content-Disposition': f'attachment; filename="{filename}"'
     }
-
-    return StreamingResponse(iterfile(), headers=headers,
+    background = None
+    if text_set.is_complete:
+        # the artifact was evicted or built on another machine
+        background = BackgroundTask(build_text_set_zip_artifact,
+                                    text_set_id)
+    return StreamingResponse(stream_text_set_zip(text_set_id),
+                             background=background,
+                             headers=headers,
                              media_type='application/zip')
 
 
@@ -153,8 +342,10 @@ async def create_texts_task(request: Request,
 @app.post("/generate_texts")
 async def send_generate_texts_form(
         request: Request,
-        background_tasks: BackgroundTasks,
+        generation_mode: str = Form('online'),
+        priority: int = Form(0),
         required_uniqueness: float = Form(...),
+        reuse_texts: bool = Form(False),
         rewriting_task: str = Form(...),
         session: AsyncSession = Depends(get_async_session),
         set_name: str = Form(...),
@@ -164,9 +355,15 @@ async def send_generate_texts_form(
         user: User = Depends(fastapi_users.current_user(optional=True))
 ):
     if user:
-        background_tasks.add_task(generate_texts,
-                                  author=user.id,
+        if generation_mode not in GENERATION_MODES:
+            return Response(content="Unknown generation mode",
+                            status_code=400)
+        try:
+            await create_text_set(author=user.id,
+                                  generation_mode=generation_mode,
+                                  priority=priority,
                                   required_uniqueness=required_uniqueness,
+                                  reuse_texts=reuse_texts,
                                   rewriting_task=rewriting_task,
                                   session=session,
                                   set_name=set_name,
@@ -174,6 +371,72 @@ async def send_generate_texts_form(
                                   task_strings=task_strings,
                                   text_len=text_len
                                   )
+        except TaskImportError as e:
+            return Response(content='\n'.join(
+                f"Строка {error['line']}: {error['error']}"
+                for error in e.errors), status_code=400)
 
         return RedirectResponse(url='/', status_code=303)
     return templates.TemplateResponse("login.html", {"request": request})
+
+
+async def import_text_set(user: User, session: AsyncSession, tasks,
+                          generation_mode: str, **parameters):
+    if generation_mode not in GENERATION_MODES:
+        return JSONResponse({'detail': 'Unknown generation mode'},
+                            status_code=400)
+    try:
+        text_set = await create_text_set(author=user.id,
+                                         generation_mode=generation_mode,
+                                         session=session, tasks=tasks,
+                                         **parameters)
+    except TaskImportError as e:
+        return JSONResponse({'detail': 'Invalid task lines',
+                             'errors': e.errors}, status_code=422)
+    await session.refresh(text_set)
+    return JSONResponse({'id': text_set.id,
+                         'total_amount': text_set.total_amount},
+                        status_code=201)
+
+
+@app.post("/api/text_sets")
+async def create_text_set_from_json(
+        text_set: TextSetImport,
+        session: AsyncSession = Depends(get_async_session),
+        user: User = Depends(fastapi_users.current_user())):
+    parameters = text_set.model_dump(exclude={'tasks'})
+    return await import_text_set(user, session,
+                                 iter_json_tasks(text_set.tasks),
+                                 **parameters)
+
+
+@app.post("/api/text_sets/upload")
+async def create_text_set_from_file(
+        file_format: str = Form(None),
+        generation_mode: str = Form('online'),
+        priority: int = Form(0),
+        required_uniqueness: float = Form(...),
+        reuse_texts: bool = Form(False),
+        rewriting_task: str = Form(...),
+        session: AsyncSession = Depends(get_async_session),
+        set_name: str = Form(...),
+        tasks_file: UploadFile = File(...),
+        temperature: float = Form(...),
+        text_len: int = Form(...),
+        user: User = Depends(fastapi_users.current_user())):
+    # CSV with task and header columns or JSON lines with task and header
+    # keys, the file is read line by line and never held in memory
+    file_format = file_format or guess_task_file_format(tasks_file.filename)
+    if file_format not in TASK_FILE_FORMATS.values():
+        return JSONResponse({'detail': 'Send a .csv or .jsonl file or set '
+                                       'file_format'}, status_code=400)
+    return await import_text_set(user, session,
+                                 iter_task_file(tasks_file.file, file_format),
+                                 generation_mode=generation_mode,
+                                 priority=priority,
+                                 required_uniqueness=required_uniqueness,
+                                 reuse_texts=reuse_texts,
+                                 rewriting_task=rewriting_task,
+                                 set_name=set_name,
+                                 temperature=temperature,
+                                 text_len=text_len)
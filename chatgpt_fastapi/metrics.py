@@ -0,0 +1,152 @@
+import asyncio
+from bisect import bisect_left
+from collections import defaultdict
+import logging
+import time
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+registry = []
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"')
+         .replace('\n', '\\n'))
+        for name, value in labels)
+    return '{' + ','.join(f'{name}="{value}"'
+                          for name, value in escaped) + '}'
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values = defaultdict(float)
+        registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        self.values[tuple(labels.get(name, '')
+                          for name in self.labelnames)] += amount
+
+    def samples(self):
+        for label_values, value in self.values.items():
+            yield (self.name, zip(self.labelnames, label_values), value)
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        # a callback returns {label values: value} when the metrics are
+        # collected, for values that already live in other objects
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def set(self, value, **labels):
+        self.values[tuple(labels.get(name, '')
+                          for name in self.labelnames)] = value
+
+    def samples(self):
+        if self.callback is not None:
+            try:
+                self.values = defaultdict(float, self.callback())
+            except Exception as e:
+                logging.error(f"Can't collect {self.name}: {e}")
+        return super().samples()
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # per label set: counts per bucket plus the overflow, sum, count
+        self.values = {}
+        registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        series = self.values.get(key)
+        if series is None:
+            series = self.values[key] = [[0] * (len(self.buckets) + 1),
+                                         0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def observe_since(self, started, **labels):
+        self.observe(time.monotonic() - started, **labels)
+
+    def samples(self):
+        for label_values, (counts, total, count) in self.values.items():
+            labels = list(zip(self.labelnames, label_values))
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, '+Inf'),
+                                           counts):
+                cumulative += bucket_count
+                yield (f'{self.name}_bucket', labels + [('le', bound)],
+                       cumulative)
+            yield f'{self.name}_sum', labels, total
+            yield f'{self.name}_count', labels, count
+
+
+def render_metrics():
+    lines = []
+    for metric in registry:
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        for name, labels, value in metric.samples():
+            lines.append(f'{name}{format_labels(list(labels))} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+async def handle_metrics_request(reader, writer):
+    try:
+        await reader.readuntil(b'\r\n\r\n')
+        body = render_metrics().encode()
+        writer.write(b'HTTP/1.1 200 OK\r\n'
+                     b'Content-Type: text/plain; version=0.0.4\r\n'
+                     b'Content-Length: ' + str(len(body)).encode()
+                     + b'\r\nConnection: close\r\n\r\n' + body)
+        await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(port: int):
+    # worker processes have no web application, they answer any request
+    # on this port with the metrics
+    return await asyncio.start_server(handle_metrics_request, port=port)
+
+
+openai_request_seconds = Histogram(
+    'openai_request_seconds', 'OpenAI chat completion latency',
+    ('outcome', 'error_class'))
+textru_submit_seconds = Histogram(
+    'textru_submit_seconds', 'text.ru text submit latency',
+    ('outcome', 'error_class'))
+textru_poll_seconds = Histogram(
+    'textru_poll_seconds', 'text.ru result poll latency',
+    ('outcome', 'error_class'))
+textru_check_seconds = Histogram(
+    'textru_check_seconds', 'Time from text.ru submit to its result',
+    ('outcome',), buckets=(5, 10, 20, 30, 60, 120, 300, 600, 900))
+db_commit_seconds = Histogram(
+    'db_commit_seconds', 'Database commit latency', ('operation',))
+zip_build_seconds = Histogram(
+    'zip_build_seconds', 'ZIP artifact build time',
+    ('outcome', 'error_class'))
+texts_total = Counter(
+    'texts_total', 'Processed task lines', ('status', 'error_class'))
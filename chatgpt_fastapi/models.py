@@ -1,9 +1,10 @@
 from fastapi_users.db import SQLAlchemyBaseUserTableUUID
+from fastapi_users_db_sqlalchemy.generics import GUID
 from sqlalchemy import (
-    Boolean, Column, DateTime, ForeignKey, Integer, Numeric, String
+    JSON, Boolean, Column, DateTime, Float, ForeignKey, Index, Integer,
+    LargeBinary, Numeric, String
 )
 from sqlalchemy import Text as TextType
-from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.orm import declarative_base, relationship
 from sqlalchemy.sql import func
 
@@ -19,18 +20,36 @@ class TextsParsingSet(Base):
 
     id = Column(Integer, primary_key=True)
     # author = relationship('User', backref='texts_parsing_sets')
-    author = Column(UUID(as_uuid=True), ForeignKey('user.id'), nullable=False)
+    author = Column(GUID, ForeignKey('user.id'), nullable=False)
     average_attempts_to_uniqueness = Column(Integer, default=0)
+    average_extension_seconds = Column(Float)
+    average_generation_seconds = Column(Float)
     average_uniqueness = Column(Integer, default=0)
+    average_uniqueness_seconds = Column(Float)
+    completion_tokens = Column(Integer, default=0)
     created_at = Column(DateTime, default=func.now())
+    deduplicated_amount = Column(Integer, default=0)
     failed_texts = Column(TextType, default='')
+    generation_mode = Column(String(20), default='online')
     is_complete = Column(Boolean, default=False)
     low_uniqueness_texts = Column(TextType, default='')
     parsed_amount = Column(Integer, default=0)
+    priority = Column(Integer, default=0)
+    prompt_tokens = Column(Integer, default=0)
+    reuse_texts = Column(Boolean, default=False)
     set_name = Column(String(500))
     task_strings = Column(TextType, default='')
     temperature = Column(Numeric(2, 1), default=0)
     total_amount = Column(Integer)
+    zip_artifact = Column(String(64))
+
+    __table_args__ = (
+        Index('ix_texts_parsing_set_created_at_id', 'created_at', 'id'),
+        Index('ix_texts_parsing_set_author_created_at_id',
+              'author', 'created_at', 'id'),
+        Index('ix_texts_parsing_set_is_complete_created_at_id',
+              'is_complete', 'created_at', 'id'),
+    )
 
     def __str__(self):
         return self.set_name
@@ -42,13 +61,140 @@ class Text(Base):
     id = Column(Integer, primary_key=True)
     attempts_to_uniqueness = Column(Integer)
     chat_request = Column(TextType)
+    # the prompts are too long for an index of their own
+    chat_request_hash = Column(String(64), index=True)
+    completion_tokens = Column(Integer, default=0)
     created_at = Column(DateTime, default=func.now())
+    extension_seconds = Column(Float)
+    generation_seconds = Column(Float)
     header = Column(TextType)
+    # the line of the task list, retried lines replace their texts
+    line_no = Column(Integer)
+    # the MinHash signature of the near-duplicate index
+    minhash = Column(LargeBinary)
+    openai_calls = Column(Integer, default=0)
     parsing_set = relationship('TextsParsingSet', backref='texts')
     parsing_set_id = Column(Integer, ForeignKey('texts_parsing_set.id'),
-                            nullable=False)
+                            index=True, nullable=False)
+    prompt_tokens = Column(Integer, default=0)
     text = Column(TextType)
     uniqueness = Column(Integer)
+    uniqueness_seconds = Column(Float)
+
+    __table_args__ = (
+        Index('ix_text_set_line', 'parsing_set_id', 'line_no', unique=True),
+    )
 
     def __str__(self):
         return self.header
+
+
+class TextTask(Base):
+    __tablename__ = 'text_task'
+
+    id = Column(Integer, primary_key=True)
+    header = Column(TextType, nullable=False)
+    line_no = Column(Integer, nullable=False)
+    parsing_set_id = Column(Integer, ForeignKey('texts_parsing_set.id',
+                                                ondelete='CASCADE'),
+                            nullable=False)
+    task = Column(TextType, nullable=False)
+
+    __table_args__ = (
+        Index('ix_text_task_set_line', 'parsing_set_id', 'line_no',
+              unique=True),
+    )
+
+    def __str__(self):
+        return f'{self.line_no}: {self.header}'
+
+
+class TextOutcome(Base):
+    __tablename__ = 'text_outcome'
+
+    id = Column(Integer, primary_key=True)
+    attempts_to_uniqueness = Column(Integer, default=0)
+    chat_request = Column(TextType)
+    duration = Column(Float)
+    error_class = Column(String(100))
+    error_details = Column(TextType)
+    finished_at = Column(DateTime)
+    header = Column(TextType)
+    line_no = Column(Integer, nullable=False)
+    parsing_set_id = Column(Integer, ForeignKey('texts_parsing_set.id',
+                                                ondelete='CASCADE'),
+                            nullable=False)
+    started_at = Column(DateTime)
+    status = Column(String(20), nullable=False)
+    uniqueness = Column(Float)
+    uniqueness_check_status = Column(String(100))
+
+    __table_args__ = (
+        Index('ix_text_outcome_set_line', 'parsing_set_id', 'line_no',
+              unique=True),
+        Index('ix_text_outcome_set_status_line',
+              'parsing_set_id', 'status', 'line_no'),
+    )
+
+    def __str__(self):
+        return f'{self.line_no}: {self.status}'
+
+
+class UniquenessCheck(Base):
+    __tablename__ = 'uniqueness_check'
+
+    content_hash = Column(String(64), primary_key=True)
+    checked_at = Column(DateTime, nullable=False)
+    uniqueness = Column(Float, nullable=False)
+
+    def __str__(self):
+        return f'{self.content_hash}: {self.uniqueness}'
+
+
+class OpenAIBatch(Base):
+    __tablename__ = 'openai_batch'
+
+    id = Column(Integer, primary_key=True)
+    batch_id = Column(String(100), nullable=False)
+    completed_requests = Column(Integer, default=0)
+    created_at = Column(DateTime, default=func.now())
+    error_file_id = Column(String(100))
+    failed_requests = Column(Integer, default=0)
+    finished_at = Column(DateTime)
+    input_file_id = Column(String(100))
+    output_file_id = Column(String(100))
+    parsing_set_id = Column(Integer, ForeignKey('texts_parsing_set.id',
+                                                ondelete='CASCADE'),
+                            index=True, nullable=False)
+    status = Column(String(20), nullable=False)
+    total_requests = Column(Integer, default=0)
+
+    def __str__(self):
+        return f'{self.batch_id}: {self.status}'
+
+
+class TextJob(Base):
+    __tablename__ = 'text_job'
+
+    id = Column(Integer, primary_key=True)
+    attempts = Column(Integer, default=0)
+    created_at = Column(DateTime, default=func.now())
+    error = Column(TextType, default='')
+    finished_at = Column(DateTime)
+    heartbeat_at = Column(DateTime)
+    locked_by = Column(String(200))
+    locked_until = Column(DateTime)
+    parameters = Column(JSON, default=dict)
+    parsing_set_id = Column(Integer, ForeignKey('texts_parsing_set.id',
+                                                ondelete='CASCADE'),
+                            nullable=False)
+    priority = Column(Integer, default=0)
+    status = Column(String(20), default='queued')
+
+    __table_args__ = (
+        Index('ix_text_job_status_priority_id', 'status', 'priority', 'id'),
+        Index('ix_text_job_set_id', 'parsing_set_id', 'id'),
+    )
+
+    def __str__(self):
+        return f'{self.parsing_set_id}: {self.status}'
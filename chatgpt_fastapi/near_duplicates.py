@@ -0,0 +1,259 @@
+from array import array
+import asyncio
+from chatgpt_fastapi.database import async_session_maker
+from chatgpt_fastapi.models import Text
+from dotenv import load_dotenv
+import logging
+import os
+import random
+import re
+from sqlalchemy import select, update
+import time
+import zlib
+
+load_dotenv()
+NEAR_DUPLICATE_INDEX = os.getenv("NEAR_DUPLICATE_INDEX", "1") == "1"
+NEAR_DUPLICATE_BANDS = int(os.getenv("NEAR_DUPLICATE_BANDS", 8))
+NEAR_DUPLICATE_ROWS = int(os.getenv("NEAR_DUPLICATE_ROWS", 4))
+NEAR_DUPLICATE_SHINGLE_SIZE = int(os.getenv("NEAR_DUPLICATE_SHINGLE_SIZE", 5))
+NEAR_DUPLICATE_TABLE_BITS = int(os.getenv("NEAR_DUPLICATE_TABLE_BITS", 20))
+NEAR_DUPLICATE_MAX_CANDIDATES = int(
+    os.getenv("NEAR_DUPLICATE_MAX_CANDIDATES", 1000))
+NEAR_DUPLICATE_LOAD_BATCH = int(os.getenv("NEAR_DUPLICATE_LOAD_BATCH", 1000))
+# ids are taken when a text is inserted, not when it is committed. Missing
+# ids this close to the newest loaded one are looked up again for a while
+NEAR_DUPLICATE_GAP_WINDOW = int(os.getenv("NEAR_DUPLICATE_GAP_WINDOW", 1000))
+NEAR_DUPLICATE_GAP_SECONDS = float(
+    os.getenv("NEAR_DUPLICATE_GAP_SECONDS", 600))
+
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+
+
+def shingle_hashes(text: str, size: int = NEAR_DUPLICATE_SHINGLE_SIZE):
+    # character shingles of the text with case, punctuation and spacing
+    # removed, a rewrite that only reorders a few words stays similar
+    normalized = ' '.join(re.findall(r'\w+', text.lower()))
+    return {zlib.crc32(normalized[start:start + size].encode())
+            for start in range(max(1, len(normalized) - size + 1))}
+
+
+class NearDuplicateIndex:
+    # MinHash signatures with banded LSH, everything is kept in flat arrays:
+    # the signatures of all texts one after another, and for every band a
+    # table of chain heads plus one "next" link per text. A million texts
+    # take about 200 MB with the default settings
+
+    def __init__(self, bands=NEAR_DUPLICATE_BANDS, rows=NEAR_DUPLICATE_ROWS,
+                 shingle_size=NEAR_DUPLICATE_SHINGLE_SIZE,
+                 table_bits=NEAR_DUPLICATE_TABLE_BITS,
+                 max_candidates=NEAR_DUPLICATE_MAX_CANDIDATES):
+        self.bands = bands
+        self.rows = rows
+        self.num_perm = bands * rows
+        self.shingle_size = shingle_size
+        self.table_mask = (1 << table_bits) - 1
+        self.max_candidates = max_candidates
+        generator = random.Random(self.num_perm)
+        self.permutations = [(generator.randrange(1, MERSENNE_PRIME),
+                              generator.randrange(MERSENNE_PRIME))
+                             for _ in range(self.num_perm)]
+        self.signatures = array('I')
+        self.text_ids = array('q')
+        self.heads = None
+        self.chains = [array('i') for _ in range(bands)]
+        self.last_text_id = 0
+        self.removed_text_ids = set()
+        self.queries = 0
+        self._gaps = {}
+        self._refresh_requested = False
+        self._refresh_task = None
+
+    def signature(self, text: str):
+        hashes = shingle_hashes(text, self.shingle_size)
+        return array('I', (min((a * value + b) % MERSENNE_PRIME
+                               for value in hashes) & MAX_HASH
+                           for a, b in self.permutations))
+
+    def stored_signature(self, text: str):
+        # kept in text.minhash, so loading the index doesn't hash every
+        # text of the table again
+        if not NEAR_DUPLICATE_INDEX:
+            return None
+        return self.signature(text or '').tobytes()
+
+    def _load_signature(self, minhash):
+        if minhash is None or len(minhash) != self.num_perm * 4:
+            # stored before the column existed or with other settings
+            return None
+        signature = array('I')
+        signature.frombytes(minhash)
+        return signature
+
+    def _band_key(self, signature, band):
+        start = band * self.rows
+        return zlib.crc32(
+            signature[start:start + self.rows].tobytes()) & self.table_mask
+
+    def add(self, text_id: int, signature):
+        if self.heads is None:
+            # allocated on the first text, processes without generation
+            # never pay for the tables
+            self.heads = [array('i', [-1]) * (self.table_mask + 1)
+                          for _ in range(self.bands)]
+        position = len(self.text_ids)
+        self.text_ids.append(text_id)
+        self.signatures.extend(signature)
+        for band in range(self.bands):
+            key = self._band_key(signature, band)
+            self.chains[band].append(self.heads[band][key])
+            self.heads[band][key] = position
+
+    def query(self, signature):
+        self.queries += 1
+        if self.heads is None:
+            return 0.0, None
+        candidates = set()
+        for band in range(self.bands):
+            position = self.heads[band][self._band_key(signature, band)]
+            walked = 0
+            while position != -1 and walked < self.max_candidates:
+                if self.text_ids[position] not in self.removed_text_ids:
+                    candidates.add(position)
+                position = self.chains[band][position]
+                walked += 1
+        best_similarity, best_text_id = 0.0, None
+        for position in candidates:
+            start = position * self.num_perm
+            # the share of equal minhashes estimates the Jaccard similarity,
+            # it also sorts out bucket collisions of the truncated band keys
+            similarity = sum(
+                value == other for value, other in
+                zip(signature, self.signatures[start:start + self.num_perm])
+            ) / self.num_perm
+            if similarity > best_similarity:
+                best_similarity = similarity
+                best_text_id = self.text_ids[position]
+        return best_similarity, best_text_id
+
+    def remove(self, text_ids):
+        # the entries stay in the arrays, queries pass over them
+        self.removed_text_ids.update(text_ids)
+
+    async def similarity(self, text: str):
+        if not NEAR_DUPLICATE_INDEX:
+            return 0.0, None
+        signature = await asyncio.to_thread(self.signature, text)
+        while True:
+            similarity, text_id = self.query(signature)
+            if text_id is None or await self._text_exists(text_id):
+                return similarity, text_id
+            # deleted by another process
+            self.remove([text_id])
+
+    async def _text_exists(self, text_id: int):
+        async with async_session_maker() as session:
+            return await session.scalar(
+                select(Text.id).where(Text.id == text_id)) is not None
+
+    def request_refresh(self):
+        # new texts are picked up from the table, so the index also learns
+        # about the ones saved by other workers
+        if not NEAR_DUPLICATE_INDEX:
+            return
+        self._refresh_requested = True
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._refresh())
+
+    async def _refresh(self):
+        while self._refresh_requested:
+            self._refresh_requested = False
+            try:
+                await self._load_new_texts()
+            except Exception as e:
+                logging.error(f"Near-duplicate index refresh failed: {e}")
+
+    async def _load_new_texts(self):
+        async with async_session_maker() as session:
+            await self._load_gaps(session)
+            while True:
+                result = await session.execute(
+                    select(Text.id, Text.text, Text.minhash)
+                    .where(Text.id > self.last_text_id)
+                    .order_by(Text.id)
+                    .limit(NEAR_DUPLICATE_LOAD_BATCH)
+                )
+                rows = result.all()
+                if not rows:
+                    return
+                self._note_gaps([text_id for text_id, _, _ in rows])
+                await self._add_rows(session, rows)
+                self.last_text_id = rows[-1][0]
+
+    def _note_gaps(self, text_ids):
+        now = time.monotonic()
+        lowest = text_ids[-1] - NEAR_DUPLICATE_GAP_WINDOW
+        previous = self.last_text_id
+        for text_id in text_ids:
+            for missing in range(max(previous + 1, lowest), text_id):
+                self._gaps[missing] = now
+            previous = text_id
+
+    async def _load_gaps(self, session):
+        # a gap is a text committed late, or one rolled back or deleted
+        expired = time.monotonic() - NEAR_DUPLICATE_GAP_SECONDS
+        lowest = self.last_text_id - NEAR_DUPLICATE_GAP_WINDOW
+        self._gaps = {text_id: seen for text_id, seen in self._gaps.items()
+                      if seen > expired and text_id > lowest}
+        gaps = sorted(self._gaps)
+        for start in range(0, len(gaps), NEAR_DUPLICATE_LOAD_BATCH):
+            result = await session.execute(
+                select(Text.id, Text.text, Text.minhash)
+                .where(Text.id.in_(gaps[start:start
+                                        + NEAR_DUPLICATE_LOAD_BATCH]))
+            )
+            rows = result.all()
+            for text_id, _, _ in rows:
+                del self._gaps[text_id]
+            await self._add_rows(session, rows)
+
+    async def _add_rows(self, session, rows):
+        signatures = [self._load_signature(minhash) for _, _, minhash in rows]
+        missing = [position for position, signature in enumerate(signatures)
+                   if signature is None]
+        if missing:
+            computed = await asyncio.to_thread(
+                lambda: [self.signature(rows[position][1] or '')
+                         for position in missing])
+            for position, signature in zip(missing, computed):
+                signatures[position] = signature
+            # the next start loads them
+            await session.execute(update(Text), [
+                {'id': rows[position][0], 'minhash': signature.tobytes()}
+                for position, signature in zip(missing, computed)])
+            await session.commit()
+        for (text_id, _, _), signature in zip(rows, signatures):
+            self.add(text_id, signature)
+
+    async def close(self):
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            await asyncio.gather(self._refresh_task, return_exceptions=True)
+
+    def as_dict(self):
+        return {
+            'enabled': NEAR_DUPLICATE_INDEX,
+            'gaps': len(self._gaps),
+            'memory_bytes': (
+                self.signatures.buffer_info()[1] * self.signatures.itemsize
+                + len(self.text_ids) * self.text_ids.itemsize
+                + sum(len(chain) * chain.itemsize for chain in self.chains)
+                + (self.bands * (self.table_mask + 1) * 4
+                   if self.heads is not None else 0)),
+            'queries': self.queries,
+            'removed': len(self.removed_text_ids),
+            'texts': len(self.text_ids),
+        }
+
+
+near_duplicate_index = NearDuplicateIndex()
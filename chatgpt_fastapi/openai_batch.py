@@ -0,0 +1,258 @@
+import asyncio
+from chatgpt_fastapi.api_utils import add_randomize_task, openai_breaker
+from chatgpt_fastapi.clients import get_openai_batch_client
+from chatgpt_fastapi.database import async_session_maker
+from chatgpt_fastapi.job_queue import utcnow
+from chatgpt_fastapi.length_planner import length_planner, trim_to_sentence
+from chatgpt_fastapi.models import OpenAIBatch
+from chatgpt_fastapi.randomizer import RANDOMIZER_STRINGS
+from chatgpt_fastapi.resilience import (RetryableError, classify_http_error,
+                                        parse_retry_after)
+from dotenv import load_dotenv
+from functools import partial
+import json
+import logging
+import os
+from sqlalchemy import select
+import tempfile
+
+load_dotenv()
+OPENAI_BATCH_POLL_INTERVAL = float(
+    os.getenv("OPENAI_BATCH_POLL_INTERVAL", 60))
+OPENAI_BATCH_COMPLETION_WINDOW = os.getenv("OPENAI_BATCH_COMPLETION_WINDOW",
+                                           "24h")
+# request and output files up to this size are kept in memory
+BATCH_FILE_MEMORY_SIZE = 8 * 1024 * 1024
+
+# a batch in one of these states never produces more output
+FINISHED_BATCH_STATUSES = ('cancelled', 'completed', 'expired', 'failed')
+# the set doesn't read these batches again. The answers of a retried set
+# are superseded, a cancelled batch still has the answers it got to
+FAILED_BATCH_STATUSES = ('failed', 'superseded')
+
+
+class BatchRequestError(Exception):
+    pass
+
+
+def line_custom_id(line):
+    return f'line-{line}'
+
+
+async def build_batch_request(line, task, temperature, text_len):
+    full_task = task + '\n' + await add_randomize_task(RANDOMIZER_STRINGS)
+    body = {
+        'messages': [{'role': 'user', 'content': full_task}],
+        'model': 'gpt-3.5-turbo',
+        'temperature': float(temperature),
+    }
+    max_tokens = length_planner.max_tokens(text_len, full_task)
+    if max_tokens:
+        body['max_tokens'] = max_tokens
+    return {
+        'body': body,
+        'custom_id': line_custom_id(line),
+        'method': 'POST',
+        'url': '/v1/chat/completions',
+    }
+
+
+async def checked_batch_request(method, url, input_file=None, **kwargs):
+    if input_file is not None:
+        # a retried upload sends the file from the start again
+        input_file.seek(0)
+        kwargs['files'] = {'file': ('requests.jsonl', input_file,
+                                    'application/jsonl')}
+    response = await get_openai_batch_client().request(method, url,
+                                                       **kwargs)
+    if response.status_code == 429 or response.status_code >= 500:
+        raise RetryableError(
+            f'OpenAI answered {response.status_code}',
+            parse_retry_after(response.headers.get('retry-after')))
+    if response.is_error:
+        raise BatchRequestError(
+            f'OpenAI answered {response.status_code}: {response.text}')
+    return response.json()
+
+
+async def call_batch_api(method, url, **kwargs):
+    return await openai_breaker.call(
+        partial(checked_batch_request, method, url, **kwargs),
+        classify_http_error)
+
+
+async def get_set_batch(text_set_id):
+    async with async_session_maker() as session:
+        return (await session.execute(
+            select(OpenAIBatch)
+            .where(OpenAIBatch.parsing_set_id == text_set_id,
+                   OpenAIBatch.status.not_in(FAILED_BATCH_STATUSES))
+            .order_by(OpenAIBatch.id.desc())
+            .limit(1)
+        )).scalar()
+
+
+async def submit_batch(text_set_id, requests):
+    with tempfile.SpooledTemporaryFile(BATCH_FILE_MEMORY_SIZE) as input_file:
+        for request in requests:
+            input_file.write(
+                (json.dumps(request, ensure_ascii=False) + '\n').encode())
+        uploaded = await call_batch_api('POST', '/files',
+                                        data={'purpose': 'batch'},
+                                        input_file=input_file)
+    batch = await call_batch_api('POST', '/batches', json={
+        'completion_window': OPENAI_BATCH_COMPLETION_WINDOW,
+        'endpoint': '/v1/chat/completions',
+        'input_file_id': uploaded['id'],
+        'metadata': {'text_set_id': str(text_set_id)},
+    })
+    async with async_session_maker() as session:
+        batch_row = OpenAIBatch(batch_id=batch['id'],
+                                input_file_id=uploaded['id'],
+                                parsing_set_id=text_set_id,
+                                status=batch['status'],
+                                total_requests=len(requests))
+        session.add(batch_row)
+        await session.commit()
+        await session.refresh(batch_row)
+    logging.info(f"{text_set_id}: OpenAI batch {batch['id']} submitted with "
+                 f"{len(requests)} requests")
+    return batch_row
+
+
+async def wait_for_batch(batch_row):
+    while True:
+        batch = await call_batch_api('GET', f'/batches/{batch_row.batch_id}')
+        counts = batch.get('request_counts') or {}
+        async with async_session_maker() as session:
+            batch_row = await session.get(OpenAIBatch, batch_row.id)
+            batch_row.completed_requests = counts.get('completed', 0)
+            batch_row.error_file_id = batch.get('error_file_id')
+            batch_row.failed_requests = counts.get('failed', 0)
+            batch_row.output_file_id = batch.get('output_file_id')
+            batch_row.status = batch['status']
+            if batch['status'] in FINISHED_BATCH_STATUSES:
+                batch_row.finished_at = utcnow()
+            await session.commit()
+            await session.refresh(batch_row)
+        if batch_row.status in FINISHED_BATCH_STATUSES:
+            if batch_row.status != 'completed':
+                logging.error(f"{batch_row.parsing_set_id}: OpenAI batch "
+                              f"{batch_row.batch_id} ended as "
+                              f"{batch_row.status}")
+            return batch_row
+        await asyncio.sleep(OPENAI_BATCH_POLL_INTERVAL)
+
+
+async def download_batch_file(file_id, output_file):
+    # a retried download starts the file again
+    output_file.seek(0)
+    output_file.truncate()
+    async with get_openai_batch_client().stream(
+            'GET', f'/files/{file_id}/content') as response:
+        if response.status_code == 429 or response.status_code >= 500:
+            raise RetryableError(
+                f'OpenAI answered {response.status_code}',
+                parse_retry_after(response.headers.get('retry-after')))
+        if response.is_error:
+            raise BatchRequestError(
+                f'Can\'t download {file_id}: {response.status_code}')
+        async for chunk in response.aiter_bytes():
+            output_file.write(chunk)
+    output_file.seek(0)
+
+
+async def iter_batch_file(file_id):
+    # the file is downloaded before the first line is handed on, the
+    # pipeline can keep a line waiting for minutes and an idle download
+    # would time out and lose the lines not read yet
+    with tempfile.SpooledTemporaryFile(BATCH_FILE_MEMORY_SIZE) as output_file:
+        await openai_breaker.call(
+            partial(download_batch_file, file_id, output_file),
+            classify_http_error)
+        for line in output_file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def parse_batch_line(batch_line):
+    # the same result as get_text_from_openai gives for a single request
+    response = batch_line.get('response') or {}
+    body = response.get('body') or {}
+    if response.get('status_code') == 200 and body.get('choices'):
+        choice = body['choices'][0]
+        text = str(choice['message']['content'])
+        usage = body.get('usage') or {}
+        length_planner.observe(text, usage.get('completion_tokens'))
+        if choice.get('finish_reason') == 'length':
+            text = trim_to_sentence(text)
+        return {
+            'completion_tokens': usage.get('completion_tokens', 0),
+            'prompt_tokens': usage.get('prompt_tokens', 0),
+            'text': text,
+            'status': 'ok'
+        }
+    error = batch_line.get('error') or body.get('error') or {}
+    return {
+        'error_class': 'BatchRequestError',
+        'text': None,
+        'status': f"Batch request failed: {error.get('message', error)}"
+    }
+
+
+async def cancel_set_batch(text_set_id):
+    # the requests OpenAI already answered stay in the output file, a
+    # resumed set reads them from there
+    batch_row = await get_set_batch(text_set_id)
+    if batch_row is None or batch_row.status in FINISHED_BATCH_STATUSES:
+        return None
+    batch = await call_batch_api('POST',
+                                 f'/batches/{batch_row.batch_id}/cancel')
+    async with async_session_maker() as session:
+        batch_row = await session.get(OpenAIBatch, batch_row.id)
+        batch_row.status = batch['status']
+        await session.commit()
+    logging.info(f"{text_set_id}: OpenAI batch {batch['id']} cancelled")
+    return batch['status']
+
+
+async def iter_batch_answers(batch_row, custom_ids):
+    for file_id in (batch_row.output_file_id, batch_row.error_file_id):
+        if file_id is None:
+            continue
+        async for batch_line in iter_batch_file(file_id):
+            line = custom_ids.get(batch_line.get('custom_id'))
+            if line is not None:
+                yield line, parse_batch_line(batch_line)
+
+
+async def run_batch(text_set_id, requests):
+    # yields (line, result) as the output file is read. A set that is
+    # picked up again after a worker died or it was cancelled continues its
+    # earlier batch, the lines it has no answer for go into a new one
+    custom_ids = {request['custom_id']: int(
+        request['custom_id'].removeprefix('line-')) for request in requests}
+    batch_row = await get_set_batch(text_set_id)
+    if batch_row is not None:
+        logging.info(f"{text_set_id}: continuing OpenAI batch "
+                     f"{batch_row.batch_id}")
+        batch_row = await wait_for_batch(batch_row)
+        answered = set()
+        async for line, result in iter_batch_answers(batch_row, custom_ids):
+            # failed requests are sent again
+            if result['status'] == 'ok' and line not in answered:
+                answered.add(line)
+                yield line, result
+        requests = [request for request in requests
+                    if custom_ids[request['custom_id']] not in answered]
+        if not requests:
+            return
+        logging.info(f"{text_set_id}: {len(requests)} lines have no answer "
+                     f"in OpenAI batch {batch_row.batch_id}")
+    batch_row = await wait_for_batch(await submit_batch(text_set_id,
+                                                        requests))
+    if batch_row.output_file_id is None and batch_row.error_file_id is None:
+        raise BatchRequestError(
+            f'Batch {batch_row.batch_id} ended as {batch_row.status}')
+    async for line, result in iter_batch_answers(batch_row, custom_ids):
+        yield line, result
@@ -0,0 +1,157 @@
+import asyncio
+from dotenv import load_dotenv
+from functools import partial
+import os
+import time
+
+load_dotenv()
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", 50))
+
+
+class PipelineItem:
+    def __init__(self, future, data):
+        self.future = future
+        self.data = data
+        self.queued_at = None
+
+
+class Stage:
+    # a stage without workers runs in the task that hands the item in, the
+    # others take items from a bounded queue, so a slow stage makes the
+    # stage before it wait instead of piling up texts in memory
+
+    def __init__(self, name, handler, workers=0,
+                 queue_size=PIPELINE_QUEUE_SIZE):
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.queue_size = queue_size
+        self.next_stage = None
+        self._queue = None
+        self._tasks = []
+        self._closing = False
+        self.busy = 0
+        self.cancelled = 0
+        self.failed = 0
+        self.processed = 0
+        self.service_seconds = 0.0
+        self.wait_seconds = 0.0
+
+    def _ensure_running(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue(self.queue_size)
+            self._tasks = [asyncio.create_task(self._work())
+                           for _ in range(self.workers)]
+
+    async def put(self, item):
+        self._ensure_running()
+        item.queued_at = time.monotonic()
+        await self._queue.put(item)
+
+    async def _work(self):
+        while True:
+            item = await self._queue.get()
+            self.wait_seconds += time.monotonic() - item.queued_at
+            await self.process(item)
+
+    async def process(self, item):
+        if item.future.done():
+            # the set was cancelled while the item waited
+            return
+        started = time.monotonic()
+        self.busy += 1
+        # a cancelled set also stops the texts this stage is working on,
+        # together with their requests
+        handler = asyncio.ensure_future(self.handler(item.data))
+        stop_handler = partial(self._stop_abandoned, handler)
+        item.future.add_done_callback(stop_handler)
+        try:
+            data = await handler
+        except asyncio.CancelledError:
+            if self._is_stopping():
+                raise
+            if item.future.cancelled():
+                self.cancelled += 1
+            else:
+                # the handler was cancelled from inside, the worker goes on
+                # and the text is given up
+                self.failed += 1
+                item.future.cancel()
+            return
+        except Exception as e:
+            self.failed += 1
+            if not item.future.done():
+                item.future.set_exception(e)
+            return
+        finally:
+            item.future.remove_done_callback(stop_handler)
+            self.busy -= 1
+            self.processed += 1
+            self.service_seconds += time.monotonic() - started
+        item.data = data
+        if self.next_stage is None or 'error' in data:
+            if not item.future.done():
+                item.future.set_result(data)
+        else:
+            await self.next_stage.put(item)
+
+    def _is_stopping(self):
+        # the worker, or the task that handed the item in, is cancelled
+        task = asyncio.current_task()
+        return self._closing or (hasattr(task, 'cancelling')
+                                 and task.cancelling() > 0)
+
+    @staticmethod
+    def _stop_abandoned(handler, future):
+        if future.cancelled():
+            handler.cancel()
+
+    async def close(self):
+        self._closing = True
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._queue is not None:
+            while not self._queue.empty():
+                self._queue.get_nowait().future.cancel()
+        self._queue = None
+        self._closing = False
+
+    def as_dict(self):
+        return {
+            'average_service_seconds': (self.service_seconds / self.processed
+                                        if self.processed else 0),
+            'average_wait_seconds': (self.wait_seconds / self.processed
+                                     if self.processed and self.workers
+                                     else 0),
+            'busy': self.busy,
+            'cancelled': self.cancelled,
+            'failed': self.failed,
+            'processed': self.processed,
+            'queued': self._queue.qsize() if self._queue is not None else 0,
+            'workers': self.workers,
+        }
+
+
+class Pipeline:
+    def __init__(self, stages):
+        self.stages = stages
+        for stage, next_stage in zip(stages, stages[1:]):
+            stage.next_stage = next_stage
+
+    async def run(self, future, data, start=0):
+        # returns once the item is handed over to a stage with workers, the
+        # future gets the result of the last one
+        stage = self.stages[start]
+        if stage.workers:
+            await stage.put(PipelineItem(future, data))
+        else:
+            await stage.process(PipelineItem(future, data))
+
+    async def close(self):
+        for stage in self.stages:
+            await stage.close()
+
+    def as_dict(self):
+        return {stage.name: stage.as_dict() for stage in self.stages}
@@ -0,0 +1,167 @@
+import asyncio
+from chatgpt_fastapi.database import engine
+from chatgpt_fastapi.metrics import Gauge
+from collections import defaultdict
+from dotenv import load_dotenv
+from fastapi.responses import StreamingResponse
+import json
+import logging
+import os
+
+load_dotenv()
+PROGRESS_QUEUE_SIZE = int(os.getenv("PROGRESS_QUEUE_SIZE", 1000))
+PROGRESS_KEEPALIVE = float(os.getenv("PROGRESS_KEEPALIVE", 15))
+# with postgres the events of all processes go through LISTEN/NOTIFY, so
+# clients of the web application see the sets of the workers
+PROGRESS_RELAY = os.getenv("PROGRESS_RELAY", "true").lower() == "true"
+PROGRESS_CHANNEL = 'text_progress'
+RELAY_RECONNECT_DELAY = 5
+
+
+class ProgressHub:
+    # every subscriber has a bounded queue, a client that does not read
+    # loses its oldest events instead of holding memory
+
+    def __init__(self, queue_size=PROGRESS_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.relay = None
+        self._subscribers = defaultdict(set)
+        self.published = 0
+        self.delivered = 0
+        self.dropped = 0
+
+    def publish(self, event):
+        self.published += 1
+        if self.relay is not None and self.relay.connected:
+            self.relay.send(event)
+        else:
+            self.deliver(event)
+
+    def deliver(self, event):
+        for topic in (f"set:{event['text_set_id']}",
+                      f"user:{event['author']}"):
+            for queue in self._subscribers.get(topic, ()):
+                if queue.full():
+                    queue.get_nowait()
+                    self.dropped += 1
+                queue.put_nowait(event)
+                self.delivered += 1
+
+    async def events(self, topic, keepalive=PROGRESS_KEEPALIVE):
+        # yields None when nothing happened for keepalive seconds
+        queue = asyncio.Queue(self.queue_size)
+        self._subscribers[topic].add(queue)
+        try:
+            while True:
+                try:
+                    yield await asyncio.wait_for(queue.get(), keepalive)
+                except asyncio.TimeoutError:
+                    yield None
+        finally:
+            self._subscribers[topic].discard(queue)
+            if not self._subscribers[topic]:
+                del self._subscribers[topic]
+
+    def subscriber_count(self):
+        return sum(len(queues) for queues in self._subscribers.values())
+
+    def as_dict(self):
+        return {
+            'delivered': self.delivered,
+            'dropped': self.dropped,
+            'published': self.published,
+            'relay': self.relay.connected if self.relay is not None
+            else None,
+            'subscribers': self.subscriber_count(),
+        }
+
+
+class PgNotifyRelay:
+    # one connection of the pool is kept for LISTEN and for sending the
+    # notifications, asyncpg runs one query at a time on it, so they are
+    # sent from a queue
+
+    def __init__(self, hub, channel=PROGRESS_CHANNEL):
+        self.hub = hub
+        self.channel = channel
+        self.connected = False
+        self._outgoing = asyncio.Queue()
+        self._task = None
+
+    def start(self):
+        if not PROGRESS_RELAY or engine.dialect.name != 'postgresql':
+            return
+        if self._task is None or self._task.done():
+            self.hub.relay = self
+            self._task = asyncio.create_task(self._run())
+
+    def send(self, event):
+        self._outgoing.put_nowait(json.dumps(event, default=str))
+
+    def _on_notification(self, connection, pid, channel, payload):
+        self.hub.deliver(json.loads(payload))
+
+    async def _run(self):
+        while True:
+            try:
+                async with engine.connect() as connection:
+                    raw_connection = await connection.get_raw_connection()
+                    driver_connection = raw_connection.driver_connection
+                    await driver_connection.add_listener(
+                        self.channel, self._on_notification)
+                    self.connected = True
+                    logging.info("Progress relay connected")
+                    while True:
+                        payload = await self._outgoing.get()
+                        await driver_connection.execute(
+                            'SELECT pg_notify($1, $2)', self.channel,
+                            payload)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Progress relay failed: {e}")
+            finally:
+                self.connected = False
+            # events published meanwhile only reach this process
+            while not self._outgoing.empty():
+                self.hub.deliver(json.loads(self._outgoing.get_nowait()))
+            await asyncio.sleep(RELAY_RECONNECT_DELAY)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.hub.relay = None
+
+
+def format_event(event):
+    return (f"event: {event['type']}\n"
+            f"data: {json.dumps(event, default=str)}\n\n")
+
+
+async def iter_event_stream(topic, first_event=None):
+    if first_event is not None:
+        yield format_event(first_event)
+    async for event in progress_hub.events(topic):
+        if event is None:
+            # a comment line keeps proxies from closing an idle stream
+            yield ': keepalive\n\n'
+        else:
+            yield format_event(event)
+
+
+def event_stream_response(topic, first_event=None):
+    return StreamingResponse(iter_event_stream(topic, first_event),
+                             headers={'Cache-Control': 'no-cache',
+                                      'X-Accel-Buffering': 'no'},
+                             media_type='text/event-stream')
+
+
+progress_hub = ProgressHub()
+progress_relay = PgNotifyRelay(progress_hub)
+Gauge('progress_subscribers', 'Clients following the progress of sets',
+      callback=lambda: {(): progress_hub.subscriber_count()})
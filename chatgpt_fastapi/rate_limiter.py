@@ -0,0 +1,89 @@
+import asyncio
+from dotenv import load_dotenv
+import os
+import time
+
+load_dotenv()
+OPENAI_RPM = int(os.getenv("OPENAI_RPM", 3500))
+OPENAI_TPM = int(os.getenv("OPENAI_TPM", 90000))
+
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60
+        self.balance = float(per_minute)
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.balance = min(self.capacity,
+                           self.balance + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, amount):
+        # the balance is allowed to go negative: a negative balance is the
+        # queue of callers that already reserved their share and now wait
+        self.balance -= min(amount, self.capacity)
+        return max(0.0, -self.balance / self.rate)
+
+    def set_limit(self, per_minute):
+        if per_minute and per_minute != self.capacity:
+            self.capacity = float(per_minute)
+            self.rate = per_minute / 60
+            self.balance = min(self.balance, self.capacity)
+
+    def set_remaining(self, remaining):
+        self.balance = min(self.balance, float(remaining))
+
+
+class RateLimiter:
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.waits = 0
+        self.total_wait = 0.0
+
+    async def acquire(self, tokens):
+        now = time.monotonic()
+        self.requests.refill(now)
+        self.tokens.refill(now)
+        wait = max(self.requests.take(1), self.tokens.take(tokens))
+        if wait:
+            self.waits += 1
+            self.total_wait += wait
+            await asyncio.sleep(wait)
+
+    def reconcile(self, reserved_tokens, used_tokens):
+        self.tokens.refill(time.monotonic())
+        self.tokens.balance = min(self.tokens.capacity,
+                                  self.tokens.balance + reserved_tokens
+                                  - used_tokens)
+
+    def update_from_headers(self, headers):
+        # the server counts every process sharing the key, so its numbers
+        # override the local estimate whenever they are stricter
+        for bucket, name in ((self.requests, 'requests'),
+                             (self.tokens, 'tokens')):
+            limit = headers.get(f'x-ratelimit-limit-{name}')
+            remaining = headers.get(f'x-ratelimit-remaining-{name}')
+            try:
+                if limit is not None:
+                    bucket.set_limit(int(limit))
+                if remaining is not None:
+                    bucket.refill(time.monotonic())
+                    bucket.set_remaining(int(remaining))
+            except ValueError:
+                continue
+
+    def as_dict(self):
+        return {
+            'requests_per_minute': self.requests.capacity,
+            'tokens_per_minute': self.tokens.capacity,
+            'requests_available': self.requests.balance,
+            'tokens_available': self.tokens.balance,
+            'waits': self.waits,
+            'total_wait': self.total_wait,
+        }
+
+
+openai_limiter = RateLimiter(OPENAI_RPM, OPENAI_TPM)
@@ -0,0 +1,190 @@
+import asyncio
+from chatgpt_fastapi.metrics import Counter, Gauge
+from collections import deque
+from dotenv import load_dotenv
+from email.utils import parsedate_to_datetime
+import httpx
+import logging
+import os
+import random
+import time
+
+load_dotenv()
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", 4))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", 1))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", 60))
+BREAKER_FAILURE_RATE = float(os.getenv("BREAKER_FAILURE_RATE", 0.5))
+BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", 20))
+BREAKER_WINDOW = float(os.getenv("BREAKER_WINDOW", 60))
+BREAKER_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", 30))
+
+BREAKER_STATES = {'closed': 0, 'half_open': 1, 'open': 2}
+
+upstream_retries_total = Counter(
+    'upstream_retries_total', 'Retried upstream calls',
+    ('upstream', 'error_class'))
+
+
+class RetryableError(Exception):
+    # raised for responses that should be retried, but are not exceptions
+    # of the client library, e.g. a 503 from text.ru
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def classify_http_error(error):
+    # for upstreams called with plain httpx
+    if isinstance(error, RetryableError):
+        return True, error.retry_after, True
+    if isinstance(error, httpx.TransportError):
+        return True, None, True
+    return False, None, False
+
+
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp()
+                   - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, retry_after=None, base_delay=RETRY_BASE_DELAY,
+                  max_delay=RETRY_MAX_DELAY):
+    # full jitter spreads the retries of many texts that failed together
+    delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, max_delay))
+    return delay
+
+
+class CircuitBreaker:
+    # opens when the share of failed calls in the window gets too high,
+    # callers then wait instead of adding load to a failing upstream. After
+    # the open period a single probe call decides whether to close again
+
+    def __init__(self, name, failure_rate=BREAKER_FAILURE_RATE,
+                 min_calls=BREAKER_MIN_CALLS, window=BREAKER_WINDOW,
+                 open_seconds=BREAKER_OPEN_SECONDS):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.open_seconds = open_seconds
+        self.state = 'closed'
+        self.opened_at = None
+        self.opened = 0
+        self._calls = deque()
+        self._probe = None
+
+    def _forget_old_calls(self, now):
+        while self._calls and self._calls[0][0] < now - self.window:
+            self._calls.popleft()
+
+    async def before_call(self):
+        while True:
+            now = time.monotonic()
+            if self.state == 'closed':
+                return
+            if self.state == 'open':
+                remaining = self.opened_at + self.open_seconds - now
+                if remaining > 0:
+                    await asyncio.sleep(remaining)
+                    continue
+                self.state = 'half_open'
+            if self._probe is None or self._probe.done():
+                self._probe = asyncio.get_running_loop().create_future()
+                return
+            # another call is probing the upstream, wait for its result
+            await asyncio.shield(self._probe)
+
+    def _open(self, now):
+        if self.state != 'open':
+            self.opened += 1
+            logging.error(f"Circuit breaker {self.name} opened")
+        self.state = 'open'
+        self.opened_at = now
+        self._calls.clear()
+
+    def record_success(self):
+        now = time.monotonic()
+        if self.state == 'half_open':
+            logging.info(f"Circuit breaker {self.name} closed")
+            self.state = 'closed'
+        self._calls.append((now, True))
+        self._forget_old_calls(now)
+        self._finish_probe()
+
+    def record_failure(self):
+        now = time.monotonic()
+        if self.state == 'half_open':
+            self._open(now)
+        else:
+            self._calls.append((now, False))
+            self._forget_old_calls(now)
+            failures = sum(1 for _, ok in self._calls if not ok)
+            if (len(self._calls) >= self.min_calls
+                    and failures / len(self._calls) >= self.failure_rate):
+                self._open(now)
+        self._finish_probe()
+
+    def _finish_probe(self):
+        if self._probe is not None and not self._probe.done():
+            self._probe.set_result(None)
+
+    async def call(self, func, classify, max_attempts=RETRY_MAX_ATTEMPTS):
+        # classify(error) returns (retryable, retry_after, counts as an
+        # upstream failure)
+        attempt = 0
+        while True:
+            await self.before_call()
+            try:
+                result = await func()
+            except asyncio.CancelledError:
+                self._finish_probe()
+                raise
+            except Exception as e:
+                retryable, retry_after, upstream_failure = classify(e)
+                if upstream_failure:
+                    self.record_failure()
+                else:
+                    self._finish_probe()
+                attempt += 1
+                if not retryable or attempt >= max_attempts:
+                    raise
+                upstream_retries_total.inc(upstream=self.name,
+                                           error_class=type(e).__name__)
+                await asyncio.sleep(backoff_delay(attempt - 1, retry_after))
+                continue
+            self.record_success()
+            return result
+
+    def as_dict(self):
+        return {
+            'calls_in_window': len(self._calls),
+            'opened': self.opened,
+            'state': self.state,
+        }
+
+
+breakers = {}
+
+
+def get_breaker(name):
+    if name not in breakers:
+        breakers[name] = CircuitBreaker(name)
+    return breakers[name]
+
+
+Gauge('circuit_breaker_state',
+      'Upstream circuit breaker state, 0 closed, 1 half open, 2 open',
+      ('upstream',),
+      callback=lambda: {(name,): BREAKER_STATES[breaker.state]
+                        for name, breaker in breakers.items()})
@@ -0,0 +1,146 @@
+import asyncio
+from chatgpt_fastapi.metrics import Gauge
+from collections import Counter, deque
+from dotenv import load_dotenv
+from functools import partial
+import os
+
+load_dotenv()
+SCHEDULER_WORKERS = int(os.getenv("SCHEDULER_WORKERS", 50))
+SCHEDULER_USER_WORKERS = int(os.getenv("SCHEDULER_USER_WORKERS", 30))
+SCHEDULER_SET_WORKERS = int(os.getenv("SCHEDULER_SET_WORKERS", 20))
+
+
+class SetQueue:
+    def __init__(self, set_id, user_id, priority):
+        self.set_id = set_id
+        self.user_id = user_id
+        self.priority = priority
+        self.jobs = deque()
+        self.running = set()
+
+
+class JobScheduler:
+    def __init__(self, workers=SCHEDULER_WORKERS,
+                 user_workers=SCHEDULER_USER_WORKERS,
+                 set_workers=SCHEDULER_SET_WORKERS):
+        self.workers = workers
+        self.user_workers = user_workers
+        self.set_workers = set_workers
+        self._sets = {}
+        self._rotation = deque()
+        self._running_by_user = Counter()
+        self._running = 0
+        self.completed = 0
+
+    def submit(self, set_id, user_id, job_factory, priority=0):
+        set_queue = self._sets.get(set_id)
+        if set_queue is None:
+            set_queue = SetQueue(set_id, user_id, priority)
+            self._sets[set_id] = set_queue
+            # a new set gets the next turn ahead of the sets already served
+            self._rotation.appendleft(set_id)
+        future = asyncio.get_running_loop().create_future()
+        set_queue.jobs.append((job_factory, future))
+        self._dispatch()
+        return future
+
+    def _is_eligible(self, set_queue):
+        return (set_queue.jobs
+                and len(set_queue.running) < self.set_workers
+                and self._running_by_user[set_queue.user_id]
+                < self.user_workers)
+
+    def _next_set(self):
+        eligible = [self._sets[set_id] for set_id in self._rotation
+                    if self._is_eligible(self._sets[set_id])]
+        if not eligible:
+            return None
+        # the highest priority wins, sets of equal priority take turns
+        set_queue = max(eligible, key=lambda queue: queue.priority)
+        self._rotation.remove(set_queue.set_id)
+        self._rotation.append(set_queue.set_id)
+        return set_queue
+
+    def _dispatch(self):
+        while self._running < self.workers:
+            set_queue = self._next_set()
+            if set_queue is None:
+                return
+            job_factory, future = set_queue.jobs.popleft()
+            if future.done():
+                # the caller is not waiting for this job anymore
+                self._drop_if_idle(set_queue)
+                continue
+            self._running += 1
+            self._running_by_user[set_queue.user_id] += 1
+            task = asyncio.create_task(job_factory())
+            task.add_done_callback(partial(self._job_done, set_queue,
+                                           future))
+            future.add_done_callback(partial(self._job_abandoned, task))
+            set_queue.running.add(task)
+
+    @staticmethod
+    def _job_abandoned(task, future):
+        if future.cancelled():
+            task.cancel()
+
+    def _job_done(self, set_queue, future, task):
+        self._running -= 1
+        self._running_by_user[set_queue.user_id] -= 1
+        if not self._running_by_user[set_queue.user_id]:
+            del self._running_by_user[set_queue.user_id]
+        set_queue.running.discard(task)
+        self.completed += 1
+        if not future.done():
+            if task.cancelled():
+                future.cancel()
+            elif task.exception() is not None:
+                future.set_exception(task.exception())
+            else:
+                future.set_result(task.result())
+        self._drop_if_idle(set_queue)
+        self._dispatch()
+
+    def _drop_if_idle(self, set_queue):
+        if not set_queue.jobs and not set_queue.running:
+            self._sets.pop(set_queue.set_id, None)
+            if set_queue.set_id in self._rotation:
+                self._rotation.remove(set_queue.set_id)
+
+    def cancel_set(self, set_id):
+        set_queue = self._sets.get(set_id)
+        if set_queue is None:
+            return
+        for _, future in set_queue.jobs:
+            future.cancel()
+        set_queue.jobs.clear()
+        for task in set_queue.running:
+            task.cancel()
+        # a set with nothing running is not removed by a finishing job
+        self._drop_if_idle(set_queue)
+
+    def as_dict(self):
+        return {
+            'workers': self.workers,
+            'running': self._running,
+            'queued': sum(len(queue.jobs) for queue in self._sets.values()),
+            'completed': self.completed,
+            'running_by_user': {str(user_id): running for user_id, running
+                                in self._running_by_user.items()},
+            'sets': {
+                set_id: {
+                    'user': str(queue.user_id),
+                    'priority': queue.priority,
+                    'queued': len(queue.jobs),
+                    'running': len(queue.running),
+                } for set_id, queue in self._sets.items()
+            },
+        }
+
+
+text_scheduler = JobScheduler()
+Gauge('scheduler_texts', 'Texts waiting for or holding a scheduler slot',
+      ('state',),
+      callback=lambda: {(state,): text_scheduler.as_dict()[state]
+                        for state in ('queued', 'running')})
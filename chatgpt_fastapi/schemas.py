@@ -23,6 +23,7 @@ class TextsParsingSetBase(BaseModel):
     is_complete: bool = False
     low_uniqueness_texts: str = ''
     parsed_amount: int = 0
+    priority: int = 0
     rewriting_task: str = ''
     required_uniqueness: int = 0
     set_name: str
@@ -44,6 +45,23 @@ class TextsParsingSet(TextsParsingSetBase):
         orm_mode = True
 
 
+class TaskLine(BaseModel):
+    header: str
+    task: str
+
+
+class TextSetImport(BaseModel):
+    generation_mode: str = 'online'
+    priority: int = 0
+    required_uniqueness: float
+    reuse_texts: bool = False
+    rewriting_task: str
+    set_name: str
+    tasks: list[TaskLine]
+    temperature: float
+    text_len: int
+
+
 class TextBase(BaseModel):
     attempts_to_uniqueness: int
     chat_request: str
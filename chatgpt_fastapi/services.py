@@ -1,22 +1,62 @@
 import asyncio
-from chatgpt_fastapi.api_utils import add_text, get_text_from_openai, \
+from chatgpt_fastapi.api_utils import continue_text, get_text_from_openai, \
     get_text_uniqueness, raise_uniqueness
-from chatgpt_fastapi.database import get_async_session
-from chatgpt_fastapi.models import TextsParsingSet, Text, User
+from chatgpt_fastapi.artifacts import remove_artifact, store_artifact
+from chatgpt_fastapi.database import async_session_maker, get_async_session
+from chatgpt_fastapi.job_queue import (ACTIVE_JOB_STATUSES,
+                                       RESUMABLE_JOB_STATUSES, cancel_set_jobs,
+                                       enqueue_text_set_job, get_set_jobs,
+                                       utcnow)
+from chatgpt_fastapi.length_planner import append_continuation, length_planner
+from chatgpt_fastapi.metrics import (Counter, Gauge, texts_total,
+                                     zip_build_seconds)
+from chatgpt_fastapi.models import (OpenAIBatch, TextJob, TextOutcome,
+                                    TextsParsingSet, TextTask, Text, User)
+from chatgpt_fastapi.near_duplicates import near_duplicate_index
+from chatgpt_fastapi.openai_batch import (build_batch_request,
+                                          cancel_set_batch, run_batch)
+from chatgpt_fastapi.pipeline import Pipeline, Stage
+from chatgpt_fastapi.progress import progress_hub
+from chatgpt_fastapi.scheduler import text_scheduler
+from chatgpt_fastapi.single_flight import SingleFlight
+from chatgpt_fastapi.system_usage import system_usage_sampler
+from chatgpt_fastapi.task_import import (TASK_IMPORT_MAX_ERRORS,
+                                         TaskImportError, TaskLineError,
+                                         iter_task_batches, iter_task_strings)
+from chatgpt_fastapi.text_writer import TextBatchWriter
+from chatgpt_fastapi.uniqueness_cache import content_hash
+from chatgpt_fastapi.zip_stream import stream_zip
 from dotenv import load_dotenv
 from fastapi import Depends
-from io import BytesIO
+from functools import partial
 import logging
 import os
-import psutil
-from sqlalchemy import select, func
+from sqlalchemy import (and_, delete, func, insert, or_, select, tuple_,
+                        update)
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import selectinload
+import time
 from uuid import UUID
-import zipfile
 
 load_dotenv()
 LOG_LEVEL = os.getenv("LOG_LEVEL")
+# texts at least this similar to one we generated before are rewritten
+# before they are sent to text.ru
+NEAR_DUPLICATE_REWRITE_SIMILARITY = float(
+    os.getenv("NEAR_DUPLICATE_REWRITE_SIMILARITY", 0.5))
+# texts less similar than this to all of ours skip the text.ru check, their
+# uniqueness is estimated locally, 0 turns it off
+NEAR_DUPLICATE_SKIP_SIMILARITY = float(
+    os.getenv("NEAR_DUPLICATE_SKIP_SIMILARITY", 0))
+TEXT_SETS_PAGE_SIZE = int(os.getenv("TEXT_SETS_PAGE_SIZE", 50))
+PIPELINE_EXTENSION_WORKERS = int(os.getenv("PIPELINE_EXTENSION_WORKERS", 20))
+PIPELINE_UNIQUENESS_WORKERS = int(
+    os.getenv("PIPELINE_UNIQUENESS_WORKERS", 100))
+ZIP_TEXTS_PER_FETCH = int(os.getenv("ZIP_TEXTS_PER_FETCH", 100))
+STORED_TEXTS_PER_QUERY = 500
+# batch sets are generated by the OpenAI Batch API, cheaper but slower
+GENERATION_MODES = ('online', 'batch')
+# the outcomes a retry generates again
+RETRYABLE_OUTCOMES = ('failed', 'low_uniqueness')
 
 log_levels = {
     "DEBUG": logging.DEBUG,
@@ -33,15 +73,9 @@ logging.basicConfig(
 )
 
 
-async def get_system_usage():
-    cpu_usage = await asyncio.to_thread(psutil.cpu_percent, interval=1,
-                                        percpu=True)
-    memory_usage = await asyncio.to_thread(psutil.virtual_memory)
-    swap_memory_usage = await asyncio.to_thread(psutil.swap_memory)
-
-    return (f"CPU Usage:\n{cpu_usage}\n"
-            f"Memory usage:\n{memory_usage}\n"
-            f"Swap usage:\n{swap_memory_usage}")
+def get_system_usage():
+    # the latest background sample, error paths must not wait for psutil
+    return system_usage_sampler.describe()
 
 
 async def get_text_set(session: AsyncSession = Depends(get_async_session),
@@ -52,52 +86,157 @@ async def get_text_set(session: AsyncSession = Depends(get_async_session),
     return result.scalars().first()
 
 
-async def generate_text(
-        header: str,
-        rewriting_task: str,
-        required_uniqueness: float,
-        task: str,
-        temperature: float,
-        text_len: int
-):
+async def get_text_sets_page(session: AsyncSession,
+                             author_email: str = None,
+                             is_complete: bool = None,
+                             before: int = None,
+                             limit: int = TEXT_SETS_PAGE_SIZE):
+    # only the columns shown in the list, the task and log blobs stay in
+    # the database
+    job_status = (
+        select(TextJob.status)
+        .where(TextJob.parsing_set_id == TextsParsingSet.id)
+        .order_by(TextJob.id.desc())
+        .limit(1)
+        .scalar_subquery()
+    )
+    query = (
+        select(TextsParsingSet.id,
+               TextsParsingSet.average_uniqueness,
+               TextsParsingSet.created_at,
+               TextsParsingSet.deduplicated_amount,
+               TextsParsingSet.is_complete,
+               TextsParsingSet.parsed_amount,
+               TextsParsingSet.set_name,
+               TextsParsingSet.temperature,
+               TextsParsingSet.total_amount,
+               User.email.label('author_email'),
+               job_status.label('job_status'))
+        .join(User, TextsParsingSet.author == User.id)
+        .order_by(TextsParsingSet.created_at.desc(),
+                  TextsParsingSet.id.desc())
+        .limit(limit + 1)
+    )
+    if author_email:
+        query = query.where(User.email == author_email)
+    if is_complete is not None:
+        query = query.where(TextsParsingSet.is_complete == is_complete)
+    if before:
+        # the cursor is the id of the last set on the previous page, its
+        # created_at is taken from the database so both sides compare alike
+        before_created_at = (
+            select(TextsParsingSet.created_at)
+            .where(TextsParsingSet.id == before)
+            .scalar_subquery()
+        )
+        # a cursor set deleted meanwhile has no created_at, the ids grow
+        # with it closely enough to go on from there
+        query = query.where(or_(
+            tuple_(TextsParsingSet.created_at, TextsParsingSet.id)
+            < tuple_(before_created_at, before),
+            and_(before_created_at.is_(None), TextsParsingSet.id < before)))
+    result = await session.execute(query)
+    text_sets = result.all()
+    next_cursor = None
+    if len(text_sets) > limit:
+        text_sets = text_sets[:limit]
+        next_cursor = text_sets[-1].id
+    outcome_counts = await get_outcome_counts(
+        session, [text_set.id for text_set in text_sets])
+    return text_sets, outcome_counts, next_cursor
+
+
+def new_usage():
+    return {'completion_tokens': 0, 'openai_calls': 0, 'prompt_tokens': 0}
+
+
+def count_usage(usage: dict, openai_response: dict):
+    if usage is None:
+        return
+    usage['openai_calls'] += 1
+    usage['completion_tokens'] += openai_response.get('completion_tokens', 0)
+    usage['prompt_tokens'] += openai_response.get('prompt_tokens', 0)
+
+
+async def generate_first_text(header: str, task: str, temperature: float,
+                              usage: dict = None, text_len: int = 0):
     logging.info(f"{header}: Starting text generation")
-    openai_response = await get_text_from_openai(task, temperature)
+    openai_response = await get_text_from_openai(
+        task, temperature, max_tokens=length_planner.max_tokens(text_len))
+    count_usage(usage, openai_response)
     text = openai_response.get('text')
     if not text:
         error_details = openai_response.get('status')
         logging.error(
             f"{header}: Can't get text from OpenAI server: {error_details}. "
-            f"System usage:\n{await get_system_usage()}")
-        return error_details
+            f"System usage:\n{get_system_usage()}")
+        return {
+            'error': error_details,
+            'error_class': openai_response.get('error_class')
+        }
+    return {'text': text}
+
 
+async def extend_text(header: str, text: str, text_len: int,
+                      usage: dict = None):
     add_text_counter = 0
     while text_len and (len(text) + 100 < text_len) and add_text_counter < 3:
         add_text_counter += 1
         logging.info(
-            f"{header}: Low text length: {text_len}, trying to rewrite"
+            f"{header}: Low text length: {text_len}, trying to continue"
             f"{add_text_counter} time")
-        openai_response = await add_text(text, text_len)
-        new_text = openai_response.get('text')
-        if new_text:
-            text = new_text
+        openai_response = await continue_text(text, text_len - len(text))
+        count_usage(usage, openai_response)
+        continuation = openai_response.get('text')
+        if continuation:
+            text = append_continuation(text, continuation)
         else:
             error_details = openai_response.get('status')
             logging.error(
                 f"{header}: During adding text can't get response from OpenAI "
                 f"server: {error_details}\nSystem usage:\n"
-                f"{await get_system_usage()}")
+                f"{get_system_usage()}")
             # it seems protection against duplicate requests has worked,
             # break and leave the current text
             break
+    return text
+
 
+async def make_text_unique(header: str, text: str, rewriting_task: str,
+                           required_uniqueness: float, usage: dict = None,
+                           on_rewrite=None):
     make_text_unique_counter = 0
     while make_text_unique_counter <= 2:
+        similarity, similar_text_id = await near_duplicate_index.similarity(
+            text)
+        if (similarity >= NEAR_DUPLICATE_REWRITE_SIMILARITY
+                and make_text_unique_counter < 2):
+            make_text_unique_counter += 1
+            logging.info(
+                f"{header}: Text is {similarity:.2f} similar to text "
+                f"{similar_text_id}, trying to rewrite "
+                f"{make_text_unique_counter} time")
+            if on_rewrite is not None:
+                on_rewrite(make_text_unique_counter, similarity=similarity)
+            openai_response = await raise_uniqueness(text, rewriting_task)
+            count_usage(usage, openai_response)
+            new_text = openai_response.get('text')
+            if new_text:
+                text = new_text
+                continue
+        if (NEAR_DUPLICATE_SKIP_SIMILARITY
+                and similarity < NEAR_DUPLICATE_SKIP_SIMILARITY):
+            text_uniqueness = round((1 - similarity) * 100, 1)
+            uniqueness_check_status = 'нет, оценка по своим текстам'
+            logging.info(f"{header}: Text.ru check skipped, local "
+                         f"similarity {similarity:.2f}")
+            break
         if text_uniqueness := await get_text_uniqueness(text):
             uniqueness_check_status = 'да'
         else:
             logging.error(
                 f"{header}: Can't get text uniqueness from text.ru server. "
-                f"System usage:\n{await get_system_usage()}")
+                f"System usage:\n{get_system_usage()}")
             uniqueness_check_status = 'нет'
             uniqueness_check_status += (', дана уникальность предыдущей '
                                         'версии текста') if (
@@ -109,7 +248,10 @@ async def generate_text(
         logging.info(
             f"{header}: Low uniqueness: {text_uniqueness}, trying to rewrite"
             f"{make_text_unique_counter} time")
+        if on_rewrite is not None:
+            on_rewrite(make_text_unique_counter, uniqueness=text_uniqueness)
         openai_response = await raise_uniqueness(text, rewriting_task)
+        count_usage(usage, openai_response)
         new_text = openai_response.get('text')
         logging.info(f"{header}: rewrite text")
         if new_text:
@@ -119,12 +261,11 @@ async def generate_text(
             logging.error(
                 f"{header}: During rewrite text for uniqueness can't get "
                 f"response from OpenAI server: {error_details}\nSystem usage:"
-                f"\n{await get_system_usage()}")
+                f"\n{get_system_usage()}")
             # it seems protection against duplicate requests has worked,
             # break and leave the current text
             break
 
-    logging.info(f"{header}: Text generation completed")
     return {
         'attempts_to_uniqueness': make_text_unique_counter,
         'text': text,
@@ -133,114 +274,756 @@ async def generate_text(
     }
 
 
-async def generate_text_set_zip(session: AsyncSession, text_set_id: int):
-    buffer = BytesIO()
+async def generate_text(
+        header: str,
+        rewriting_task: str,
+        required_uniqueness: float,
+        task: str,
+        temperature: float,
+        text_len: int
+):
+    usage = new_usage()
+    text_data = await generate_first_text(header, task, temperature, usage,
+                                          text_len)
+    if 'error' in text_data:
+        return text_data
+    text = await extend_text(header, text_data['text'], text_len, usage)
+    text_data = await make_text_unique(header, text, rewriting_task,
+                                       required_uniqueness, usage)
+    logging.info(f"{header}: Text generation completed")
+    return dict(text_data, **usage)
+
+
+async def generation_stage(data: dict):
+    started = time.monotonic()
+    started_at = utcnow()
+    usage = new_usage()
+    text_data = await generate_first_text(data['header'], data['task'],
+                                          data['temperature'], usage,
+                                          data['text_len'])
+    if 'error' in text_data:
+        text_data['finished_at'] = utcnow()
+    return dict(data, generation_seconds=time.monotonic() - started,
+                started_at=started_at, usage=usage, **text_data)
 
-    text_set_query = (
-        select(TextsParsingSet).options(
-            selectinload(TextsParsingSet.texts)).where(
-            TextsParsingSet.id == text_set_id))
-    result = await session.execute(text_set_query)
-    text_set = result.scalars().first()
-
-    with zipfile.ZipFile(buffer, 'a', zipfile.ZIP_DEFLATED, False) as zipf:
-        for text in text_set.texts:
-            text_content = (f"уникальность: {text.uniqueness}\n\n"
-                            f"{text.header}\n"
-                            f"{text.text}")
-            header = text.header.replace('\r', '')
-            zipf.writestr(f"{header}.txt", text_content)
-
-        task_strings = text_set.task_strings
-        failed_texts = text_set.failed_texts
-        low_uniqueness_texts = text_set.low_uniqueness_texts
-        zipf.writestr("запрос на тексты.txt", task_strings)
-        if failed_texts:
-            zipf.writestr("не получились.txt", failed_texts)
-        if low_uniqueness_texts:
-            zipf.writestr("тексты с низкой уникальностью.txt",
-                          low_uniqueness_texts)
-
-    buffer.seek(0)
-    return buffer
-
-
-async def generate_texts(author: UUID,
-                         rewriting_task: str,
-                         required_uniqueness: float,
-                         set_name: str,
-                         task_strings: str,
-                         temperature: float,
-                         text_len: int,
-                         session: AsyncSession = Depends(get_async_session)):
-    logging.info(
-        f"{set_name}:Starting text set generation\n{await get_system_usage()}")
 
-    task_list = [task for task in task_strings.split('\n') if "||" in task]
+async def extension_stage(data: dict):
+    started = time.monotonic()
+    text = await extend_text(data['header'], data['text'], data['text_len'],
+                             data['usage'])
+    return dict(data, extension_seconds=time.monotonic() - started,
+                text=text)
+
+
+def publish_rewrite(data: dict, attempt: int, **reason):
+    progress_hub.publish({
+        'attempt': attempt,
+        'author': data['author'],
+        'header': data['header'],
+        'line_no': data['line_no'],
+        'text_set_id': data['text_set_id'],
+        'type': 'rewrite',
+        **reason
+    })
+
+
+async def uniqueness_stage(data: dict):
+    started = time.monotonic()
+    text_data = await make_text_unique(data['header'], data['text'],
+                                       data['rewriting_task'],
+                                       data['required_uniqueness'],
+                                       data['usage'],
+                                       partial(publish_rewrite, data))
+    logging.info(f"{data['header']}: Text generation completed")
+    return dict(data, finished_at=utcnow(),
+                uniqueness_seconds=time.monotonic() - started, **text_data)
+
+
+# generation runs in the scheduler slots, which share OpenAI fairly between
+# sets, the slow stages after it get their own workers
+text_pipeline = Pipeline([
+    Stage('generation', generation_stage),
+    Stage('extension', extension_stage, PIPELINE_EXTENSION_WORKERS),
+    Stage('uniqueness', uniqueness_stage, PIPELINE_UNIQUENESS_WORKERS),
+])
+
+
+Gauge('pipeline_texts', 'Texts queued for or processed by a pipeline stage',
+      ('stage', 'state'),
+      callback=lambda: {
+          (name, state): stats[state]
+          for name, stats in text_pipeline.as_dict().items()
+          for state in ('busy', 'queued')})
+
+
+def deduplicated_text_data(text_data: dict):
+    # the tokens and stage times belong to the line that did the work
+    return dict(text_data, deduplicated='coalesced', extension_seconds=None,
+                generation_seconds=None, uniqueness_seconds=None,
+                usage=new_usage())
+
+
+text_flights = SingleFlight(deduplicated_text_data)
+deduplicated_texts_total = Counter(
+    'deduplicated_texts_total', 'Lines served without generating a text',
+    ('source',))
+
+
+async def find_stored_texts(session: AsyncSession, text_set_id: int,
+                            tasks: list, required_uniqueness: float):
+    # the newest text of another set for each prompt, by prompt hash
+    hashes = list({content_hash(task) for task in tasks})
+    stored_texts = {}
+    for start in range(0, len(hashes), STORED_TEXTS_PER_QUERY):
+        result = await session.execute(
+            select(Text.chat_request_hash, Text.text, Text.uniqueness)
+            .where(Text.chat_request_hash.in_(
+                       hashes[start:start + STORED_TEXTS_PER_QUERY]),
+                   Text.parsing_set_id != text_set_id,
+                   Text.uniqueness >= required_uniqueness)
+            .order_by(Text.id)
+        )
+        for stored in result.all():
+            stored_texts[stored.chat_request_hash] = stored
+    return stored_texts
+
+
+def stored_text_data(stored):
+    now = utcnow()
+    return {
+        'attempts_to_uniqueness': 0,
+        'deduplicated': 'reused',
+        'finished_at': now,
+        'started_at': now,
+        'text': stored.text,
+        'text_uniqueness': stored.uniqueness,
+        'uniqueness_check_status': 'да, текст из прошлого набора',
+        'usage': new_usage(),
+    }
+
+
+def forward_abandoned_text(future, scheduled):
+    if future.done():
+        return
+    if scheduled.cancelled():
+        future.cancel()
+    elif scheduled.exception() is not None:
+        future.set_exception(scheduled.exception())
+
 
-    author = await session.get(User, author)
+async def feed_batch_results(text_set_id: int, items: list):
+    # the first texts come from one OpenAI batch instead of the generation
+    # stage, the rest of the pipeline is the same
+    requests = [await build_batch_request(data['line_no'], data['task'],
+                                          data['temperature'],
+                                          data['text_len'])
+                for _, data in items]
+    items_by_line = {data['line_no']: (future, data)
+                     for future, data in items}
+    answered = set()
+    async for line, result in run_batch(text_set_id, requests):
+        future, data = items_by_line.get(line, (None, None))
+        if future is None or future.done() or line in answered:
+            continue
+        answered.add(line)
+        usage = new_usage()
+        count_usage(usage, result)
+        started_at = utcnow()
+        if not result.get('text'):
+            logging.error(f"{data['header']}: Can't get text from OpenAI "
+                          f"batch: {result['status']}")
+            future.set_result(dict(data, error=result['status'],
+                                   error_class=result['error_class'],
+                                   finished_at=started_at,
+                                   started_at=started_at, usage=usage))
+            continue
+        await text_pipeline.run(future, dict(data, started_at=started_at,
+                                             text=result['text'],
+                                             usage=usage), start=1)
+    for line, (future, data) in items_by_line.items():
+        if line not in answered and not future.done():
+            future.set_result({'error': 'No answer in the batch output',
+                               'error_class': 'BatchRequestError'})
 
+
+async def iter_text_set_files(text_set_id: int):
+    async with async_session_maker() as session:
+        text_set = await get_text_set(session=session,
+                                      text_set_id=text_set_id)
+        texts = await session.stream(
+            select(Text.header, Text.text, Text.uniqueness)
+            .where(Text.parsing_set_id == text_set_id)
+            .order_by(Text.id)
+            .execution_options(yield_per=ZIP_TEXTS_PER_FETCH)
+        )
+        async for header, text, uniqueness in texts:
+            text_content = (f"уникальность: {uniqueness}\n\n"
+                            f"{header}\n"
+                            f"{text}")
+            header = header.replace('\r', '')
+            yield f"{header}.txt", text_content
+
+        if text_set.task_strings:
+            yield "запрос на тексты.txt", text_set.task_strings
+        else:
+            yield "запрос на тексты.txt", iter_task_lines(session,
+                                                          text_set_id)
+        outcome_counts = (await get_outcome_counts(
+            session, [text_set_id])).get(text_set_id, {})
+        if outcome_counts.get('failed'):
+            yield "не получились.txt", iter_outcome_lines(
+                session, text_set_id, 'failed',
+                lambda outcome: (f'{outcome.chat_request}&&'
+                                 f'{outcome.error_details}\n'))
+        elif text_set.failed_texts:
+            yield "не получились.txt", text_set.failed_texts
+        if outcome_counts.get('low_uniqueness'):
+            yield "тексты с низкой уникальностью.txt", iter_outcome_lines(
+                session, text_set_id, 'low_uniqueness',
+                lambda outcome: (f"{outcome.chat_request}||"
+                                 f"{outcome.uniqueness}||"
+                                 f"Была ли получена уникальность текста? - "
+                                 f"{outcome.uniqueness_check_status}\n"))
+        elif text_set.low_uniqueness_texts:
+            yield ("тексты с низкой уникальностью.txt",
+                   text_set.low_uniqueness_texts)
+
+
+async def get_outcome_counts(session: AsyncSession, text_set_ids: list,
+                             include_ok: bool = False):
+    query = (
+        select(TextOutcome.parsing_set_id, TextOutcome.status, func.count())
+        .where(TextOutcome.parsing_set_id.in_(text_set_ids))
+        .group_by(TextOutcome.parsing_set_id, TextOutcome.status)
+    )
+    if not include_ok:
+        query = query.where(TextOutcome.status != 'ok')
+    result = await session.execute(query)
+    counts = {}
+    for text_set_id, status, count in result.all():
+        counts.setdefault(text_set_id, {})[status] = count
+    return counts
+
+
+async def iter_outcome_lines(session: AsyncSession, text_set_id: int,
+                             status: str, format_line):
+    outcomes = await session.stream_scalars(
+        select(TextOutcome)
+        .where(TextOutcome.parsing_set_id == text_set_id,
+               TextOutcome.status == status)
+        .order_by(TextOutcome.line_no)
+        .execution_options(yield_per=ZIP_TEXTS_PER_FETCH)
+    )
+    async for outcome in outcomes:
+        yield format_line(outcome)
+
+
+async def iter_task_lines(session: AsyncSession, text_set_id: int):
+    tasks = await session.stream(
+        select(TextTask.task, TextTask.header)
+        .where(TextTask.parsing_set_id == text_set_id)
+        .order_by(TextTask.line_no)
+        .execution_options(yield_per=ZIP_TEXTS_PER_FETCH)
+    )
+    async for task, header in tasks:
+        yield f'{task}||{header}\n'
+
+
+def stream_text_set_zip(text_set_id: int):
+    return stream_zip(iter_text_set_files(text_set_id))
+
+
+async def build_text_set_zip_artifact(text_set_id: int):
+    started = time.monotonic()
+    try:
+        digest = await store_artifact(stream_text_set_zip(text_set_id))
+    except Exception as e:
+        zip_build_seconds.observe_since(started, outcome='error',
+                                        error_class=type(e).__name__)
+        raise
+    zip_build_seconds.observe_since(started, outcome='ok')
+    async with async_session_maker() as session:
+        previous_digest = (await session.execute(
+            select(TextsParsingSet.zip_artifact)
+            .where(TextsParsingSet.id == text_set_id))).scalar_one_or_none()
+        await session.execute(
+            update(TextsParsingSet)
+            .where(TextsParsingSet.id == text_set_id)
+            .values(zip_artifact=digest)
+        )
+        await session.commit()
+        if previous_digest and previous_digest != digest:
+            await remove_unused_artifact(session, previous_digest)
+    return digest
+
+
+async def remove_unused_artifact(session: AsyncSession, digest: str):
+    still_used = await session.execute(
+        select(TextsParsingSet.id)
+        .where(TextsParsingSet.zip_artifact == digest).limit(1))
+    if still_used.first() is None:
+        remove_artifact(digest)
+
+
+async def invalidate_text_set_zip_artifact(session: AsyncSession,
+                                           text_set_id: int):
+    digest = (await session.execute(
+        select(TextsParsingSet.zip_artifact)
+        .where(TextsParsingSet.id == text_set_id))).scalar_one_or_none()
+    if not digest:
+        return
+    await session.execute(
+        update(TextsParsingSet)
+        .where(TextsParsingSet.id == text_set_id)
+        .values(zip_artifact=None)
+    )
+    await session.commit()
+    await remove_unused_artifact(session, digest)
+
+
+def get_task_list(task_strings: str):
+    return [task for task in task_strings.split('\n') if "||" in task]
+
+
+async def get_set_tasks(session: AsyncSession, text_set_id: int,
+                        task_strings: str = ''):
+    # sets created before the text_task table only have the task strings
+    tasks = (await session.execute(
+        select(TextTask.task, TextTask.header)
+        .where(TextTask.parsing_set_id == text_set_id)
+        .order_by(TextTask.line_no)
+    )).all()
+    if not tasks:
+        tasks = [task.split('||', 1)
+                 for task in get_task_list(task_strings)]
+    return [tuple(task) for task in tasks]
+
+
+async def insert_tasks(session: AsyncSession, text_set_id: int, tasks):
+    # the tasks are inserted in batches as they are read, an invalid line
+    # stops the inserts but the rest is still checked for the report
+    total = 0
+    errors = []
+    async for batch in iter_task_batches(tasks):
+        rows = []
+        for line, task in batch:
+            if isinstance(task, TaskLineError):
+                errors.append({'error': str(task), 'line': line})
+                if len(errors) >= TASK_IMPORT_MAX_ERRORS:
+                    raise TaskImportError(errors)
+                continue
+            rows.append({'header': task[1], 'line_no': total,
+                         'parsing_set_id': text_set_id, 'task': task[0]})
+            total += 1
+        if rows and not errors:
+            await session.execute(insert(TextTask), rows)
+    if errors:
+        raise TaskImportError(errors)
+    if not total:
+        raise TaskImportError([{'error': 'no tasks', 'line': None}])
+    return total
+
+
+async def create_text_set(author: UUID,
+                          rewriting_task: str,
+                          required_uniqueness: float,
+                          set_name: str,
+                          temperature: float,
+                          text_len: int,
+                          task_strings: str = '',
+                          tasks=None,
+                          priority: int = 0,
+                          generation_mode: str = 'online',
+                          reuse_texts: bool = False,
+                          session: AsyncSession = Depends(
+                              get_async_session)):
+    # tasks yields (line, (task, header)) as the task_import iterators do,
+    # nothing is created when one of the lines is invalid
     new_set = TextsParsingSet(
-        author=author.id,
+        author=author,
+        generation_mode=generation_mode,
+        priority=priority,
+        reuse_texts=reuse_texts,
         set_name=set_name,
-        task_strings=task_strings,
         temperature=temperature,
-        total_amount=len(task_list)
+        total_amount=0
     )
-
     session.add(new_set)
+    await session.flush()
+    if tasks is None:
+        tasks = iter_task_strings(task_strings)
+    try:
+        new_set.total_amount = await insert_tasks(session, new_set.id, tasks)
+    except TaskImportError:
+        await session.rollback()
+        raise
+    await enqueue_text_set_job(
+        session,
+        parsing_set_id=new_set.id,
+        parameters={
+            'required_uniqueness': required_uniqueness,
+            'rewriting_task': rewriting_task,
+            'text_len': text_len,
+        },
+        priority=priority
+    )
     await session.commit()
-    await session.refresh(new_set)
-
-    tasks = [generate_text(
-        header,
-        rewriting_task,
-        required_uniqueness,
-        task,
-        temperature,
-        text_len
-    ) for task, header in (task.split('||') for task in task_list)]
-    results = await asyncio.gather(*tasks, return_exceptions=True)
-
-    for task, text_data in zip(task_list, results):
-        task, header = task.split('||')
-
-        if isinstance(text_data, dict):
-            text = Text(
-                attempts_to_uniqueness=text_data['attempts_to_uniqueness'],
-                chat_request=task,
-                header=header,
-                parsing_set=new_set,
-                text=text_data['text'],
-                uniqueness=text_data['text_uniqueness'],
-            )
-            session.add(text)
-        else:
-            new_set.failed_texts += f'{task}&&{text_data}\n'
+    logging.info(f"{set_name}: Text set generation queued")
+    return new_set
 
-            if text_data['text_uniqueness'] < required_uniqueness:
-                new_set.low_uniqueness_texts += (
-                    f"{task}||{text_data['text_uniqueness']}||"
-                    f"Была ли получена уникальность текста? - "
-                    f"{text_data['uniqueness_check_status']}\n")
 
-        new_set.parsed_amount += 1
-        await session.commit()
-        await session.refresh(new_set)
+async def cancel_text_set(session: AsyncSession, text_set: TextsParsingSet):
+    text_set_id = text_set.id
+    author = str(text_set.author)
+    generation_mode = text_set.generation_mode
+    if not await cancel_set_jobs(session, text_set_id):
+        return False
+    # the worker running the set stops as soon as it gets the event, the
+    # heartbeat is the fallback when the event is lost
+    progress_hub.publish({'author': author, 'text_set_id': text_set_id,
+                          'type': 'set_cancelled'})
+    if generation_mode == 'batch':
+        try:
+            await cancel_set_batch(text_set_id)
+        except Exception as e:
+            logging.error(f"{text_set_id}: Can't cancel OpenAI batch: {e}")
+    logging.info(f"{text_set_id}: Text set cancelled")
+    return True
+
+
+async def requeue_text_set(session: AsyncSession, text_set_id: int,
+                           job_statuses: tuple = None):
+    # the new job runs with the parameters of the last one and generates
+    # only the lines without an outcome
+    jobs = await get_set_jobs(session, text_set_id)
+    if not jobs or jobs[0].status in ACTIVE_JOB_STATUSES:
+        return False
+    if job_statuses is not None and jobs[0].status not in job_statuses:
+        return False
+    await enqueue_text_set_job(session,
+                               parsing_set_id=text_set_id,
+                               parameters=dict(jobs[0].parameters or {}),
+                               priority=jobs[0].priority)
+    await session.execute(
+        update(TextsParsingSet)
+        .where(TextsParsingSet.id == text_set_id)
+        .values(is_complete=False)
+    )
+    return True
+
 
-    avg_uniqueness = await session.execute(
-        select(func.avg(Text.uniqueness)).where(
-            Text.parsing_set_id == new_set.id)
+async def resume_text_set(session: AsyncSession, text_set_id: int):
+    if not await requeue_text_set(session, text_set_id,
+                                  RESUMABLE_JOB_STATUSES):
+        return False
+    await session.commit()
+    logging.info(f"{text_set_id}: Text set resumed")
+    return True
+
+
+async def retry_text_set_lines(session: AsyncSession, text_set_id: int,
+                               statuses: tuple = RETRYABLE_OUTCOMES):
+    lines = (await session.execute(
+        select(TextOutcome.line_no)
+        .where(TextOutcome.parsing_set_id == text_set_id,
+               TextOutcome.status.in_(statuses))
+    )).scalars().all()
+    if not lines or not await requeue_text_set(session, text_set_id):
+        await session.rollback()
+        return 0
+    deleted_text_ids = []
+    for start in range(0, len(lines), STORED_TEXTS_PER_QUERY):
+        chunk = lines[start:start + STORED_TEXTS_PER_QUERY]
+        deleted_text_ids += (await session.execute(
+            delete(Text)
+            .where(Text.parsing_set_id == text_set_id,
+                   Text.line_no.in_(chunk))
+            .returning(Text.id)
+        )).scalars().all()
+        await session.execute(delete(TextOutcome).where(
+            TextOutcome.parsing_set_id == text_set_id,
+            TextOutcome.line_no.in_(chunk)))
+    # the old batches answered the retried lines, the new job submits them
+    # again
+    await session.execute(
+        update(OpenAIBatch)
+        .where(OpenAIBatch.parsing_set_id == text_set_id,
+               OpenAIBatch.status != 'superseded')
+        .values(status='superseded')
     )
-    average_attempts_to_uniqueness = await session.execute(
-        select(func.avg(Text.attempts_to_uniqueness)).where(
-            Text.parsing_set_id == new_set.id)
+    await session.execute(
+        update(TextsParsingSet)
+        .where(TextsParsingSet.id == text_set_id)
+        .values(parsed_amount=TextsParsingSet.parsed_amount - len(lines))
     )
+    await session.commit()
+    near_duplicate_index.remove(deleted_text_ids)
+    await invalidate_text_set_zip_artifact(session, text_set_id)
+    logging.info(f"{text_set_id}: Retrying {len(lines)} lines")
+    return len(lines)
 
-    new_set.average_attempts_to_uniqueness = (
-            average_attempts_to_uniqueness.scalar_one() or 0)
-    new_set.average_uniqueness = avg_uniqueness.scalar_one() or 0
-    new_set.is_complete = True
 
+async def remove_text_set(session: AsyncSession, text_set_id: int):
+    await invalidate_text_set_zip_artifact(session, text_set_id)
+    deleted_text_ids = (await session.execute(
+        delete(Text)
+        .where(Text.parsing_set_id == text_set_id)
+        .returning(Text.id)
+    )).scalars().all()
+    for model in (TextOutcome, TextJob, TextTask, OpenAIBatch):
+        await session.execute(delete(model).where(
+            model.parsing_set_id == text_set_id))
+    await session.execute(delete(TextsParsingSet).where(
+        TextsParsingSet.id == text_set_id))
+    await session.commit()
+    # other processes drop them when a query finds them
+    near_duplicate_index.remove(deleted_text_ids)
+
+
+async def generate_texts(text_set_id: int,
+                         rewriting_task: str,
+                         required_uniqueness: float,
+                         text_len: int,
+                         session: AsyncSession = Depends(get_async_session)):
+    new_set = await get_text_set(session=session, text_set_id=text_set_id)
+    if new_set is None:
+        logging.error(f"{text_set_id}: Text set was deleted, skip it")
+        return
+    set_name = new_set.set_name
+    temperature = new_set.temperature
+    # the set expires with the first commit of the writer
+    author_id = new_set.author
+    deduplicated = new_set.deduplicated_amount or 0
+    priority = new_set.priority
+    logging.info(
+        f"{set_name}:Starting text set generation\n{get_system_usage()}")
+
+    task_list = await get_set_tasks(session, text_set_id,
+                                    new_set.task_strings)
+    # a resumed or retried set keeps the lines it already has an outcome
+    # for, only the rest is generated
+    done_lines = dict((await session.execute(
+        select(TextOutcome.line_no, TextOutcome.status)
+        .where(TextOutcome.parsing_set_id == text_set_id)
+    )).all())
+    if done_lines:
+        logging.info(f"{set_name}: Resuming, {len(done_lines)} of "
+                     f"{len(task_list)} texts are done")
+
+    author = str(author_id)
+    progress_hub.publish({'author': author, 'text_set_id': text_set_id,
+                          'total': len(task_list), 'type': 'set_started'})
+
+    loop = asyncio.get_running_loop()
+    items = []
+    for line, (task, header) in enumerate(task_list):
+        if line in done_lines:
+            continue
+        items.append((loop.create_future(), {
+            'author': author,
+            'header': header,
+            'line_no': line,
+            'required_uniqueness': required_uniqueness,
+            'rewriting_task': rewriting_task,
+            'task': task,
+            'temperature': temperature,
+            'text_len': text_len,
+            'text_set_id': text_set_id,
+        }))
+    futures = [future for future, _ in items]
+    scheduled = []
+
+    def schedule_text(future, data):
+        scheduled.append(text_scheduler.submit(
+            text_set_id,
+            author_id,
+            partial(text_pipeline.run, future, data),
+            priority
+        ))
+        scheduled[-1].add_done_callback(partial(forward_abandoned_text,
+                                                future))
+
+    stored_texts = {}
+    if new_set.reuse_texts:
+        stored_texts = await find_stored_texts(
+            session, text_set_id, [data['task'] for _, data in items],
+            required_uniqueness)
+    pending = []
+    for future, data in items:
+        stored = stored_texts.get(content_hash(data['task']))
+        if stored is not None:
+            future.set_result(stored_text_data(stored))
+        else:
+            pending.append((future, data))
+    if new_set.generation_mode == 'batch':
+        # batch sets are not coalesced, a batch can take hours and the
+        # lines of a resumed set have to stay in the same batch
+        feeder = asyncio.create_task(feed_batch_results(text_set_id,
+                                                        pending))
+        for future, _ in pending:
+            feeder.add_done_callback(partial(forward_abandoned_text, future))
+        scheduled.append(feeder)
+    else:
+        for future, data in pending:
+            key = (data['task'], float(temperature), rewriting_task,
+                   text_len, float(required_uniqueness))
+            if not text_flights.join(key, future,
+                                     partial(schedule_text, future, data)):
+                schedule_text(future, data)
+
+    # results are written in the order they complete, not in the order
+    # of the task list
+    completed = asyncio.Queue()
+    for future, data in items:
+        future.add_done_callback(partial(
+            lambda line, done: completed.put_nowait((line, done)),
+            data['line_no']))
+
+    writer = TextBatchWriter(session, text_set_id)
+    status_counts = {}
+    for status in done_lines.values():
+        status_counts[status] = status_counts.get(status, 0) + 1
+    try:
+        for done in range(len(done_lines) + 1, len(task_list) + 1):
+            try:
+                line, future = await asyncio.wait_for(completed.get(),
+                                                      writer.time_to_flush())
+            except asyncio.TimeoutError:
+                await writer.flush()
+                line, future = await completed.get()
+            task, header = task_list[line]
+            if future.cancelled():
+                text_data = {'error': 'Cancelled',
+                             'error_class': 'CancelledError'}
+            elif future.exception() is not None:
+                logging.error(f"{header}: Text generation failed: "
+                              f"{future.exception()!r}")
+                text_data = {'error': str(future.exception()),
+                             'error_class': type(future.exception()).__name__}
+            else:
+                text_data = future.result()
+            outcome = {
+                'chat_request': task,
+                'duration': (text_data['finished_at']
+                             - text_data['started_at']).total_seconds()
+                if 'started_at' in text_data else None,
+                'finished_at': text_data.get('finished_at'),
+                'header': header,
+                'line_no': line,
+                'started_at': text_data.get('started_at'),
+            }
+
+            if 'error' in text_data:
+                outcome.update(
+                    error_class=text_data['error_class'],
+                    error_details=text_data['error'],
+                    status='failed'
+                )
+                writer.add(outcome=outcome)
+            else:
+                outcome.update(
+                    attempts_to_uniqueness=text_data[
+                        'attempts_to_uniqueness'],
+                    status='ok' if text_data['text_uniqueness']
+                    >= required_uniqueness else 'low_uniqueness',
+                    uniqueness=text_data['text_uniqueness'],
+                    uniqueness_check_status=text_data[
+                        'uniqueness_check_status']
+                )
+                writer.add(
+                    text={
+                        'attempts_to_uniqueness':
+                            text_data['attempts_to_uniqueness'],
+                        'chat_request': task,
+                        'chat_request_hash': content_hash(task),
+                        'extension_seconds':
+                            text_data.get('extension_seconds'),
+                        'generation_seconds':
+                            text_data.get('generation_seconds'),
+                        'header': header,
+                        'line_no': line,
+                        'text': text_data['text'],
+                        'uniqueness': text_data['text_uniqueness'],
+                        'uniqueness_seconds':
+                            text_data.get('uniqueness_seconds'),
+                        **text_data.get('usage', new_usage()),
+                    },
+                    outcome=outcome
+                )
+            texts_total.inc(status=outcome['status'],
+                            error_class=outcome.get('error_class') or '')
+            if text_data.get('deduplicated'):
+                deduplicated += 1
+                deduplicated_texts_total.inc(
+                    source=text_data['deduplicated'])
+            status_counts[outcome['status']] = status_counts.get(
+                outcome['status'], 0) + 1
+            progress_hub.publish({
+                'author': author,
+                'counts': dict(status_counts),
+                'done': done,
+                'error_class': outcome.get('error_class'),
+                'header': header,
+                'line_no': line,
+                'status': outcome['status'],
+                'text_set_id': text_set_id,
+                'total': len(task_list),
+                'type': 'text',
+                'uniqueness': outcome.get('uniqueness'),
+            })
+            if writer.is_due():
+                await writer.flush()
+    except asyncio.CancelledError:
+        # keep the texts that are done, resuming the set skips them
+        try:
+            await session.rollback()
+            await writer.flush()
+        except Exception as e:
+            logging.error(f"{set_name}: Can't save finished texts: {e}")
+        raise
+    finally:
+        # the set was cancelled or the worker lost it, stop the texts
+        # still in flight
+        for future in futures + scheduled:
+            future.cancel()
+        text_scheduler.cancel_set(text_set_id)
+    await writer.flush()
+
+    # one pass over the texts of the set for all rollups
+    rollups = (await session.execute(
+        select(func.avg(Text.uniqueness),
+               func.avg(Text.attempts_to_uniqueness),
+               func.avg(Text.generation_seconds),
+               func.avg(Text.extension_seconds),
+               func.avg(Text.uniqueness_seconds),
+               func.sum(Text.prompt_tokens),
+               func.sum(Text.completion_tokens))
+        .where(Text.parsing_set_id == text_set_id)
+    )).one()
+    await session.execute(
+        update(TextsParsingSet)
+        .where(TextsParsingSet.id == text_set_id)
+        .values(
+            average_attempts_to_uniqueness=rollups[1] or 0,
+            average_extension_seconds=rollups[3],
+            average_generation_seconds=rollups[2],
+            average_uniqueness=rollups[0] or 0,
+            average_uniqueness_seconds=rollups[4],
+            completion_tokens=rollups[6] or 0,
+            deduplicated_amount=deduplicated,
+            is_complete=True,
+            prompt_tokens=rollups[5] or 0
+        )
+    )
     await session.commit()
+    progress_hub.publish({'author': author, 'average_uniqueness':
+                          rollups[0] or 0, 'counts': dict(status_counts),
+                          'deduplicated': deduplicated,
+                          'text_set_id': text_set_id,
+                          'total': len(task_list), 'type': 'set_finished'})
+    try:
+        await build_text_set_zip_artifact(text_set_id)
+    except Exception as e:
+        # downloads fall back to streaming from the database
+        logging.error(f"{set_name}: Can't build zip artifact: {e}")
     logging.info(f"{set_name}: Finish text set generation")
@@ -0,0 +1,53 @@
+from functools import partial
+
+
+class SingleFlight:
+    # identical work that is already in flight is not started again, the
+    # followers get the result of the first one. share turns that result
+    # into the one of a follower
+
+    def __init__(self, share=None):
+        self.share = share
+        self._leaders = {}
+        self.coalesced = 0
+        self.rerun = 0
+
+    def join(self, key, future, run_alone):
+        # returns True when the future follows a leader. A follower whose
+        # leader gets cancelled, e.g. with the set of the leader, calls
+        # run_alone to do the work itself
+        leader = self._leaders.get(key)
+        if leader is not None and not leader.done():
+            self.coalesced += 1
+            leader.add_done_callback(partial(self._follow, key, future,
+                                             run_alone))
+            return True
+        self._leaders[key] = future
+        future.add_done_callback(partial(self._forget, key))
+        return False
+
+    def _forget(self, key, future):
+        if self._leaders.get(key) is future:
+            del self._leaders[key]
+
+    def _follow(self, key, future, run_alone, leader):
+        if future.done():
+            return
+        if leader.cancelled():
+            # the first follower takes over, the others follow it
+            self.coalesced -= 1
+            if not self.join(key, future, run_alone):
+                self.rerun += 1
+                run_alone()
+        elif leader.exception() is not None:
+            future.set_exception(leader.exception())
+        else:
+            result = leader.result()
+            future.set_result(self.share(result) if self.share else result)
+
+    def as_dict(self):
+        return {
+            'coalesced': self.coalesced,
+            'in_flight': len(self._leaders),
+            'rerun': self.rerun,
+        }
@@ -0,0 +1,70 @@
+import asyncio
+from chatgpt_fastapi.metrics import Gauge
+from dotenv import load_dotenv
+import os
+import psutil
+
+load_dotenv()
+SYSTEM_USAGE_INTERVAL = float(os.getenv("SYSTEM_USAGE_INTERVAL", 5))
+
+
+class SystemUsageSampler:
+    # psutil.cpu_percent(interval=None) measures since the previous call,
+    # so a periodic sample costs microseconds and never blocks a thread
+
+    def __init__(self, interval=SYSTEM_USAGE_INTERVAL):
+        self.interval = interval
+        self.process = psutil.Process()
+        self.latest = None
+        self._task = None
+
+    def sample(self):
+        self.latest = {
+            'cpu': psutil.cpu_percent(interval=None, percpu=True),
+            'memory': psutil.virtual_memory(),
+            'process_rss': self.process.memory_info().rss,
+            'swap': psutil.swap_memory(),
+        }
+        return self.latest
+
+    def snapshot(self):
+        return self.latest or self.sample()
+
+    async def _run(self):
+        while True:
+            self.sample()
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def describe(self):
+        snapshot = self.snapshot()
+        return (f"CPU Usage:\n{snapshot['cpu']}\n"
+                f"Memory usage:\n{snapshot['memory']}\n"
+                f"Swap usage:\n{snapshot['swap']}")
+
+
+system_usage_sampler = SystemUsageSampler()
+
+
+def collect_system_usage():
+    snapshot = system_usage_sampler.snapshot()
+    cpu = snapshot['cpu']
+    return {
+        ('cpu_percent',): sum(cpu) / len(cpu) if cpu else 0,
+        ('memory_percent',): snapshot['memory'].percent,
+        ('process_rss_bytes',): snapshot['process_rss'],
+        ('swap_percent',): snapshot['swap'].percent,
+    }
+
+
+Gauge('system_usage', 'Latest CPU, memory and swap sample', ('resource',),
+      callback=collect_system_usage)
@@ -0,0 +1,127 @@
+import asyncio
+import codecs
+import csv
+from dotenv import load_dotenv
+from itertools import islice
+import json
+import os
+
+load_dotenv()
+TASK_INSERT_BATCH_SIZE = int(os.getenv("TASK_INSERT_BATCH_SIZE", 1000))
+# an import stops reading after this many invalid lines
+TASK_IMPORT_MAX_ERRORS = int(os.getenv("TASK_IMPORT_MAX_ERRORS", 100))
+# headers become file names in the archive
+TASK_HEADER_MAX_LENGTH = 200
+TASK_FILE_FORMATS = {'.csv': 'csv', '.jsonl': 'jsonl', '.ndjson': 'jsonl'}
+
+
+class TaskLineError(ValueError):
+    pass
+
+
+class TaskImportError(Exception):
+    def __init__(self, errors):
+        super().__init__(f'{len(errors)} invalid task lines')
+        self.errors = errors
+
+
+def check_task(task, header):
+    if not isinstance(task, str) or not isinstance(header, str):
+        raise TaskLineError('task and header must be strings')
+    task, header = task.strip(), header.strip()
+    if not task:
+        raise TaskLineError('task is empty')
+    if not header:
+        raise TaskLineError('header is empty')
+    if '\n' in header or '\r' in header:
+        raise TaskLineError('header must be a single line')
+    if len(header) > TASK_HEADER_MAX_LENGTH:
+        raise TaskLineError(
+            f'header is longer than {TASK_HEADER_MAX_LENGTH} characters')
+    return task, header
+
+
+def task_or_error(task, header):
+    try:
+        return check_task(task, header)
+    except TaskLineError as e:
+        return e
+
+
+# the iterators below yield (line, result) where the result is a
+# (task, header) tuple or the TaskLineError of the line
+
+def iter_task_strings(task_strings):
+    # the format of the form, lines without || are skipped
+    for line, text in enumerate(task_strings.split('\n'), 1):
+        if '||' in text:
+            yield line, task_or_error(*text.split('||', 1))
+
+
+def iter_json_tasks(items):
+    for line, item in enumerate(items, 1):
+        yield line, task_or_error(item.task, item.header)
+
+
+def iter_csv_tasks(text_file):
+    reader = csv.reader(text_file)
+    try:
+        for row in reader:
+            if not any(cell.strip() for cell in row):
+                continue
+            if reader.line_num == 1 and [
+                    cell.strip().lower() for cell in row] == ['task',
+                                                              'header']:
+                continue
+            if len(row) != 2:
+                yield reader.line_num, TaskLineError(
+                    f'expected 2 columns, task and header, got {len(row)}')
+                continue
+            yield reader.line_num, task_or_error(*row)
+    except (csv.Error, UnicodeDecodeError) as e:
+        # the reader can't go on after a broken line
+        yield reader.line_num, TaskLineError(str(e))
+
+
+def iter_jsonl_tasks(text_file):
+    line = 0
+    try:
+        for line, text in enumerate(text_file, 1):
+            if not text.strip():
+                continue
+            try:
+                item = json.loads(text)
+            except ValueError as e:
+                yield line, TaskLineError(f'invalid JSON: {e}')
+                continue
+            if not isinstance(item, dict):
+                yield line, TaskLineError(
+                    'expected an object with task and header')
+                continue
+            yield line, task_or_error(item.get('task'), item.get('header'))
+    except UnicodeDecodeError as e:
+        yield line + 1, TaskLineError(str(e))
+
+
+def guess_task_file_format(filename):
+    return TASK_FILE_FORMATS.get(os.path.splitext(filename or '')[1].lower())
+
+
+def iter_task_file(binary_file, file_format):
+    # reads the file line by line, uploads are spooled to disk by starlette.
+    # the lines are decoded here, a spooled file can't be wrapped in a
+    # TextIOWrapper on every python version
+    text_file = codecs.iterdecode(binary_file, 'utf-8-sig')
+    if file_format == 'csv':
+        yield from iter_csv_tasks(text_file)
+    else:
+        yield from iter_jsonl_tasks(text_file)
+
+
+async def iter_task_batches(tasks, size=TASK_INSERT_BATCH_SIZE):
+    # files are read in a thread, a big upload doesn't block the loop
+    while True:
+        batch = await asyncio.to_thread(list, islice(tasks, size))
+        if not batch:
+            return
+        yield batch
@@ -0,0 +1,84 @@
+import asyncio
+from chatgpt_fastapi.metrics import db_commit_seconds
+from chatgpt_fastapi.models import Text, TextOutcome, TextsParsingSet
+from chatgpt_fastapi.near_duplicates import near_duplicate_index
+from dotenv import load_dotenv
+import os
+from sqlalchemy import update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+import time
+
+load_dotenv()
+TEXT_WRITE_BATCH_SIZE = int(os.getenv("TEXT_WRITE_BATCH_SIZE", 20))
+TEXT_WRITE_FLUSH_INTERVAL = float(os.getenv("TEXT_WRITE_FLUSH_INTERVAL", 5))
+DIALECT_INSERTS = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}
+
+
+def insert_new_lines(session, model):
+    # a worker that took over an expired lease may have written some of the
+    # lines already, those rows are kept and the new ones skipped
+    dialect = session.get_bind().dialect.name
+    return DIALECT_INSERTS[dialect](model).on_conflict_do_nothing(
+        index_elements=['parsing_set_id', 'line_no'])
+
+
+class TextBatchWriter:
+    def __init__(self, session: AsyncSession, text_set_id: int,
+                 batch_size: int = TEXT_WRITE_BATCH_SIZE,
+                 flush_interval: float = TEXT_WRITE_FLUSH_INTERVAL):
+        self.session = session
+        self.text_set_id = text_set_id
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.texts = []
+        self.outcomes = []
+        self.first_added = None
+
+    def add(self, outcome: dict, text: dict = None):
+        if text:
+            self.texts.append(dict(text, parsing_set_id=self.text_set_id))
+        self.outcomes.append(dict(outcome, parsing_set_id=self.text_set_id))
+        if self.first_added is None:
+            self.first_added = time.monotonic()
+
+    def time_to_flush(self):
+        if self.first_added is None:
+            return None
+        return max(0.0, self.first_added + self.flush_interval
+                   - time.monotonic())
+
+    def is_due(self):
+        return (len(self.outcomes) >= self.batch_size
+                or self.time_to_flush() == 0)
+
+    async def flush(self):
+        if not self.outcomes:
+            return
+        if self.texts:
+            minhashes = await asyncio.to_thread(
+                lambda: [near_duplicate_index.stored_signature(text['text'])
+                         for text in self.texts])
+            for text, minhash in zip(self.texts, minhashes):
+                text['minhash'] = minhash
+            await self.session.execute(insert_new_lines(self.session, Text),
+                                       self.texts)
+        inserted = await self.session.execute(
+            insert_new_lines(self.session, TextOutcome)
+            .returning(TextOutcome.line_no), self.outcomes)
+        # the counter is incremented in place, so concurrent writers of the
+        # same set never overwrite each other's progress
+        await self.session.execute(
+            update(TextsParsingSet)
+            .where(TextsParsingSet.id == self.text_set_id)
+            .values(parsed_amount=TextsParsingSet.parsed_amount
+                    + len(inserted.all()))
+        )
+        started = time.monotonic()
+        await self.session.commit()
+        db_commit_seconds.observe_since(started, operation='text_batch')
+        if self.texts:
+            near_duplicate_index.request_refresh()
+        self.texts = []
+        self.outcomes = []
+        self.first_added = None
@@ -0,0 +1,158 @@
+import asyncio
+from dotenv import load_dotenv
+import heapq
+import logging
+import os
+import time
+
+load_dotenv()
+TEXTRU_FIRST_POLL_DELAY = float(os.getenv("TEXTRU_FIRST_POLL_DELAY", 10))
+TEXTRU_MAX_POLL_INTERVAL = float(os.getenv("TEXTRU_MAX_POLL_INTERVAL", 60))
+TEXTRU_POLL_BACKOFF = float(os.getenv("TEXTRU_POLL_BACKOFF", 1.5))
+TEXTRU_POLL_TIMEOUT = float(os.getenv("TEXTRU_POLL_TIMEOUT", 720))
+TEXTRU_POLL_CONCURRENCY = int(os.getenv("TEXTRU_POLL_CONCURRENCY", 10))
+
+
+class PendingCheck:
+    def __init__(self, uid, future, submitted, interval, deadline):
+        self.uid = uid
+        self.future = future
+        self.submitted = submitted
+        self.interval = interval
+        self.deadline = deadline
+        self.polls = 0
+
+
+class TextruPoller:
+    # text.ru has no batch result endpoint, so all outstanding uids live in
+    # one heap ordered by their next poll time and a single task polls the
+    # due ones through the shared client
+
+    def __init__(self, poll_func,
+                 first_delay=TEXTRU_FIRST_POLL_DELAY,
+                 max_interval=TEXTRU_MAX_POLL_INTERVAL,
+                 backoff=TEXTRU_POLL_BACKOFF,
+                 timeout=TEXTRU_POLL_TIMEOUT,
+                 concurrency=TEXTRU_POLL_CONCURRENCY):
+        self.poll_func = poll_func
+        self.first_delay = first_delay
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self._pending = {}
+        self._schedule = []
+        self._wakeup = None
+        self._task = None
+        self.ready_time = None
+        self.polls = 0
+        self.resolved = 0
+        self.timed_out = 0
+
+    def _first_delay(self):
+        # start a bit before the typical check time, but never earlier than
+        # the configured minimum
+        if self.ready_time is None:
+            return self.first_delay
+        return min(self.max_interval,
+                   max(self.first_delay, self.ready_time * 0.75))
+
+    def _ensure_running(self):
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    def wait_for(self, uid):
+        if uid in self._pending:
+            return self._pending[uid].future
+        now = time.monotonic()
+        self._ensure_running()
+        delay = self._first_delay()
+        check = PendingCheck(uid,
+                             asyncio.get_running_loop().create_future(),
+                             now, delay, now + self.timeout)
+        self._pending[uid] = check
+        heapq.heappush(self._schedule, (now + delay, uid))
+        self._wakeup.set()
+        return check.future
+
+    def _resolve(self, check, uniqueness):
+        self._pending.pop(check.uid, None)
+        if not check.future.done():
+            check.future.set_result(uniqueness)
+
+    async def _poll(self, check):
+        check.polls += 1
+        self.polls += 1
+        try:
+            data = await self.poll_func(check.uid)
+        except Exception as e:
+            logging.warning(f"text.ru poll for {check.uid} failed: {e}")
+            data = {}
+        now = time.monotonic()
+        if 'text_unique' in data:
+            self.resolved += 1
+            elapsed = now - check.submitted
+            self.ready_time = elapsed if self.ready_time is None else (
+                0.8 * self.ready_time + 0.2 * elapsed)
+            self._resolve(check, float(data['text_unique']))
+        elif now >= check.deadline:
+            self.timed_out += 1
+            self._resolve(check, 0)
+        else:
+            check.interval = min(self.max_interval,
+                                 check.interval * self.backoff)
+            heapq.heappush(self._schedule,
+                           (min(now + check.interval, check.deadline),
+                            check.uid))
+
+    def _pop_due(self, now):
+        due = []
+        while (self._schedule and self._schedule[0][0] <= now
+               and len(due) < self.concurrency):
+            _, uid = heapq.heappop(self._schedule)
+            check = self._pending.get(uid)
+            if check is None:
+                continue
+            if check.future.done():
+                # the waiting coroutine was cancelled
+                self._pending.pop(uid)
+                continue
+            due.append(check)
+        return due
+
+    async def _run(self):
+        while self._pending:
+            due = self._pop_due(time.monotonic())
+            if due:
+                await asyncio.gather(*(self._poll(check) for check in due))
+                continue
+            self._wakeup.clear()
+            timeout = (self._schedule[0][0] - time.monotonic()
+                       if self._schedule else None)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for check in self._pending.values():
+            check.future.cancel()
+        self._pending.clear()
+        self._schedule.clear()
+
+    def as_dict(self):
+        return {
+            'pending': len(self._pending),
+            'polls': self.polls,
+            'resolved': self.resolved,
+            'timed_out': self.timed_out,
+            'typical_check_time': self.ready_time,
+        }
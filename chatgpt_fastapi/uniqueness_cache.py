@@ -0,0 +1,93 @@
+from chatgpt_fastapi.database import async_session_maker
+from chatgpt_fastapi.job_queue import utcnow
+from chatgpt_fastapi.models import UniquenessCheck
+from collections import OrderedDict
+from datetime import timedelta
+from dotenv import load_dotenv
+import hashlib
+import logging
+import os
+
+load_dotenv()
+# uniqueness against the web decays as copies of a text get published
+UNIQUENESS_CACHE_TTL = float(os.getenv("UNIQUENESS_CACHE_TTL", 7 * 86400))
+UNIQUENESS_CACHE_SIZE = int(os.getenv("UNIQUENESS_CACHE_SIZE", 10000))
+
+
+def content_hash(text: str):
+    normalized = ' '.join(text.split())
+    return hashlib.sha256(normalized.encode()).hexdigest()
+
+
+class UniquenessCache:
+    # in-memory LRU in front of the uniqueness_check table, the table is
+    # shared by all workers and survives restarts
+
+    def __init__(self, ttl=UNIQUENESS_CACHE_TTL, size=UNIQUENESS_CACHE_SIZE):
+        self.ttl = timedelta(seconds=ttl)
+        self.size = size
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.database_hits = 0
+        self.misses = 0
+        self.checks = 0
+        self.check_seconds = 0.0
+
+    def _remember(self, key, uniqueness, checked_at):
+        self._entries[key] = (uniqueness, checked_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    async def get(self, text: str):
+        key = content_hash(text)
+        expires_before = utcnow() - self.ttl
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] > expires_before:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+        try:
+            async with async_session_maker() as session:
+                check = await session.get(UniquenessCheck, key)
+                if check is not None and check.checked_at > expires_before:
+                    self._remember(key, check.uniqueness, check.checked_at)
+                    self.hits += 1
+                    self.database_hits += 1
+                    return check.uniqueness
+        except Exception as e:
+            logging.error(f"Can't read uniqueness cache: {e}")
+        self.misses += 1
+        return None
+
+    async def put(self, text: str, uniqueness: float, check_seconds: float):
+        key = content_hash(text)
+        checked_at = utcnow()
+        self.checks += 1
+        self.check_seconds += check_seconds
+        self._remember(key, uniqueness, checked_at)
+        try:
+            async with async_session_maker() as session:
+                await session.merge(UniquenessCheck(content_hash=key,
+                                                    checked_at=checked_at,
+                                                    uniqueness=uniqueness))
+                await session.commit()
+        except Exception as e:
+            # another worker stored the same text at the same moment
+            logging.error(f"Can't store uniqueness check: {e}")
+
+    def as_dict(self):
+        average_check_seconds = (self.check_seconds / self.checks
+                                 if self.checks else 0)
+        return {
+            'average_check_seconds': average_check_seconds,
+            'database_hits': self.database_hits,
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            # every hit is a paid check and its polling time not spent
+            'saved_seconds': self.hits * average_check_seconds,
+        }
+
+
+uniqueness_cache = UniquenessCache()
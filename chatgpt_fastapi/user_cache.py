@@ -0,0 +1,105 @@
+from chatgpt_fastapi.metrics import Counter
+from chatgpt_fastapi.models import User
+from collections import OrderedDict
+from dotenv import load_dotenv
+from fastapi_users.db import SQLAlchemyUserDatabase
+import os
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient_to_detached
+import time
+
+load_dotenv()
+# every process has its own cache, a user changed through another process
+# is seen there after at most this long. 0 turns the cache off
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", 30))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 10000))
+
+user_cache_lookups_total = Counter(
+    'user_cache_lookups_total', 'User lookups of authenticated requests',
+    ('result',))
+
+
+class UserCache:
+    # detached copies of users by id, each request merges the copy into its
+    # own session, so no instance is shared between sessions
+
+    def __init__(self, ttl=USER_CACHE_TTL, size=USER_CACHE_SIZE):
+        self.ttl = ttl
+        self.size = size
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, user_id):
+        entry = self._entries.get(user_id)
+        if entry is not None and entry[1] > time.monotonic():
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            user_cache_lookups_total.inc(result='hit')
+            return entry[0]
+        if entry is not None:
+            del self._entries[user_id]
+        self.misses += 1
+        user_cache_lookups_total.inc(result='miss')
+        return None
+
+    def put(self, user):
+        if self.ttl <= 0:
+            return
+        copy = User(**{attribute.key: getattr(user, attribute.key)
+                       for attribute in inspect(User).column_attrs})
+        make_transient_to_detached(copy)
+        self._entries[user.id] = (copy, time.monotonic() + self.ttl)
+        self._entries.move_to_end(user.id)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, user_id):
+        if self._entries.pop(user_id, None) is not None:
+            self.invalidations += 1
+
+    def as_dict(self):
+        lookups = self.hits + self.misses
+        return {
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0,
+            'hits': self.hits,
+            'invalidations': self.invalidations,
+            'misses': self.misses,
+            'size': len(self._entries),
+            'ttl': self.ttl,
+        }
+
+
+class CachedUserDatabase(SQLAlchemyUserDatabase):
+    # the users router updates and deletes through here, so changes made
+    # in this process are never served from the cache
+
+    def __init__(self, session, user_table, cache=None):
+        super().__init__(session, user_table)
+        self.cache = user_cache if cache is None else cache
+
+    async def get(self, id):
+        cached = self.cache.get(id)
+        if cached is not None:
+            return await self.session.merge(cached, load=False)
+        user = await super().get(id)
+        if user is not None:
+            self.cache.put(user)
+        return user
+
+    async def update(self, user, update_dict):
+        user = await super().update(user, update_dict)
+        self.cache.invalidate(user.id)
+        return user
+
+    async def delete(self, user):
+        user_id = user.id
+        await super().delete(user)
+        self.cache.invalidate(user_id)
+
+
+user_cache = UserCache()
@@ -0,0 +1,147 @@
+import asyncio
+from chatgpt_fastapi.api_utils import textru_poller
+from chatgpt_fastapi.clients import (close_openai_batch_client,
+                                     close_openai_client, close_textru_client)
+from chatgpt_fastapi.database import async_session_maker, create_db_and_tables
+from chatgpt_fastapi.job_queue import (claim_job, finish_job, heartbeat_job,
+                                       release_job)
+from chatgpt_fastapi.metrics import start_metrics_server
+from chatgpt_fastapi.near_duplicates import near_duplicate_index
+from chatgpt_fastapi.progress import progress_hub, progress_relay
+from chatgpt_fastapi.services import generate_texts, text_pipeline
+from chatgpt_fastapi.system_usage import system_usage_sampler
+from dotenv import load_dotenv
+import logging
+import os
+import signal
+import socket
+
+load_dotenv()
+JOB_HEARTBEAT_INTERVAL = float(os.getenv("JOB_HEARTBEAT_INTERVAL", 15))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", 5))
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", 2))
+# give every worker on a host its own port, 0 turns the endpoint off
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", 0))
+
+
+async def keep_job_alive(job_id: int, worker_id: str,
+                         job_task: asyncio.Task):
+    while True:
+        await asyncio.sleep(JOB_HEARTBEAT_INTERVAL)
+        try:
+            async with async_session_maker() as session:
+                still_owned = await heartbeat_job(session, job_id, worker_id)
+        except Exception as e:
+            logging.error(f"Job {job_id}: heartbeat failed: {e}")
+            continue
+        if not still_owned:
+            logging.error(f"Job {job_id}: lease lost or set cancelled, "
+                          f"stopping the job")
+            job_task.cancel()
+            return
+
+
+async def stop_on_cancel(text_set_id: int, job_task: asyncio.Task):
+    async for event in progress_hub.events(f'set:{text_set_id}',
+                                           keepalive=None):
+        if event['type'] == 'set_cancelled':
+            logging.info(f"{text_set_id}: set cancelled, stopping the job")
+            job_task.cancel()
+            return
+
+
+async def process_job(job: dict, worker_id: str):
+    logging.info(f"Job {job['id']}: claimed by {worker_id}")
+    heartbeat = asyncio.create_task(
+        keep_job_alive(job['id'], worker_id, asyncio.current_task()))
+    watcher = asyncio.create_task(
+        stop_on_cancel(job['parsing_set_id'], asyncio.current_task()))
+    try:
+        # a set a previous worker died in the middle of continues after
+        # the lines it finished
+        async with async_session_maker() as session:
+            await generate_texts(session=session,
+                                 text_set_id=job['parsing_set_id'],
+                                 **job['parameters'])
+    except asyncio.CancelledError:
+        heartbeat.cancel()
+        watcher.cancel()
+        raise
+    except Exception as e:
+        heartbeat.cancel()
+        watcher.cancel()
+        logging.exception(f"Job {job['id']}: failed")
+        async with async_session_maker() as session:
+            await finish_job(session, job['id'], worker_id, error=repr(e))
+        return
+    heartbeat.cancel()
+    watcher.cancel()
+    async with async_session_maker() as session:
+        await finish_job(session, job['id'], worker_id)
+    logging.info(f"Job {job['id']}: done")
+
+
+async def run_worker(worker_id: str, concurrency: int = WORKER_CONCURRENCY,
+                     stop: asyncio.Event = None):
+    stop = stop or asyncio.Event()
+    stopping = asyncio.create_task(stop.wait())
+    running = {}
+    while not stop.is_set():
+        job = None
+        if len(running) < concurrency:
+            try:
+                async with async_session_maker() as session:
+                    job = await claim_job(session, worker_id)
+            except Exception as e:
+                logging.error(f"{worker_id}: can't claim a job: {e}")
+        if job is not None:
+            task = asyncio.create_task(process_job(job, worker_id))
+            running[task] = job['id']
+            task.add_done_callback(lambda done: running.pop(done, None))
+            continue
+        await asyncio.wait([stopping, *running], timeout=JOB_POLL_INTERVAL,
+                           return_when=asyncio.FIRST_COMPLETED)
+    stopping.cancel()
+
+    # give the unfinished jobs back to the queue, so another worker can
+    # pick them up right away instead of waiting for the lease to expire
+    for task, job_id in list(running.items()):
+        task.cancel()
+        async with async_session_maker() as session:
+            await release_job(session, job_id, worker_id)
+    await asyncio.gather(*running, return_exceptions=True)
+
+
+async def main():
+    await create_db_and_tables()
+    worker_id = f'{socket.gethostname()}:{os.getpid()}'
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signal_number, stop.set)
+    logging.info(f"{worker_id}: worker started")
+    # built in the background, sets started meanwhile see a partial index
+    near_duplicate_index.request_refresh()
+    system_usage_sampler.start()
+    progress_relay.start()
+    metrics_server = None
+    if WORKER_METRICS_PORT:
+        metrics_server = await start_metrics_server(WORKER_METRICS_PORT)
+    try:
+        await run_worker(worker_id, WORKER_CONCURRENCY, stop)
+    finally:
+        if metrics_server is not None:
+            metrics_server.close()
+        await progress_relay.close()
+        await system_usage_sampler.close()
+        await near_duplicate_index.close()
+        await text_pipeline.close()
+        await textru_poller.close()
+        await close_openai_client()
+        await close_openai_batch_client()
+        await close_textru_client()
+    logging.info(f"{worker_id}: worker stopped")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,58 @@
+from dotenv import load_dotenv
+import os
+import zipfile
+
+load_dotenv()
+ZIP_STREAM_CHUNK_SIZE = int(os.getenv("ZIP_STREAM_CHUNK_SIZE", 64 * 1024))
+# the same files always give the same bytes, archives are stored and
+# served by their sha256
+ZIP_ENTRY_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+
+class ZipStreamBuffer:
+    # write-only sink without seek(), zipfile then writes a data descriptor
+    # after every entry instead of going back to patch sizes into its header
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.size = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        self.size += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        return data
+
+
+async def stream_zip(files, chunk_size: int = ZIP_STREAM_CHUNK_SIZE):
+    buffer = ZipStreamBuffer()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        async for name, content in files:
+            file_info = zipfile.ZipInfo(name, ZIP_ENTRY_DATE_TIME)
+            file_info.compress_type = zipfile.ZIP_DEFLATED
+            if isinstance(content, (str, bytes)):
+                zipf.writestr(file_info, content)
+            else:
+                # large files come as an async iterator of their lines
+                with zipf.open(file_info, 'w') as entry:
+                    async for part in content:
+                        entry.write(part.encode())
+                        if buffer.size >= chunk_size:
+                            yield buffer.drain()
+            if buffer.size >= chunk_size:
+                yield buffer.drain()
+    # the central directory is written when the archive is closed
+    yield buffer.drain()
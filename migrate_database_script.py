@@ -0,0 +1,58 @@
+import asyncio
+from chatgpt_fastapi.database import create_db_and_tables, engine
+from chatgpt_fastapi.models import Base
+from sqlalchemy import text
+from sqlalchemy.schema import CreateIndex
+
+# columns added to the tables of earlier versions, the defaults fill in the
+# existing rows. create_all makes the new tables but never alters old ones
+MIGRATION_STATEMENTS = (
+    """
+    ALTER TABLE texts_parsing_set
+        ADD COLUMN IF NOT EXISTS average_extension_seconds FLOAT,
+        ADD COLUMN IF NOT EXISTS average_generation_seconds FLOAT,
+        ADD COLUMN IF NOT EXISTS average_uniqueness_seconds FLOAT,
+        ADD COLUMN IF NOT EXISTS completion_tokens INTEGER DEFAULT 0,
+        ADD COLUMN IF NOT EXISTS deduplicated_amount INTEGER DEFAULT 0,
+        ADD COLUMN IF NOT EXISTS generation_mode VARCHAR(20)
+            DEFAULT 'online',
+        ADD COLUMN IF NOT EXISTS priority INTEGER DEFAULT 0,
+        ADD COLUMN IF NOT EXISTS prompt_tokens INTEGER DEFAULT 0,
+        ADD COLUMN IF NOT EXISTS reuse_texts BOOLEAN DEFAULT false,
+        ADD COLUMN IF NOT EXISTS zip_artifact VARCHAR(64)
+    """,
+    """
+    ALTER TABLE text
+        ADD COLUMN IF NOT EXISTS chat_request_hash VARCHAR(64),
+        ADD COLUMN IF NOT EXISTS completion_tokens INTEGER DEFAULT 0,
+        ADD COLUMN IF NOT EXISTS extension_seconds FLOAT,
+        ADD COLUMN IF NOT EXISTS generation_seconds FLOAT,
+        ADD COLUMN IF NOT EXISTS line_no INTEGER,
+        ADD COLUMN IF NOT EXISTS minhash BYTEA,
+        ADD COLUMN IF NOT EXISTS openai_calls INTEGER DEFAULT 0,
+        ADD COLUMN IF NOT EXISTS prompt_tokens INTEGER DEFAULT 0,
+        ADD COLUMN IF NOT EXISTS uniqueness_seconds FLOAT
+    """,
+)
+
+
+async def migrate_database():
+    if engine.dialect.name != 'postgresql':
+        raise SystemExit('The migration is written for PostgreSQL, other '
+                         'databases are created from scratch')
+    await create_db_and_tables()
+    async with engine.begin() as connection:
+        for statement in MIGRATION_STATEMENTS:
+            await connection.execute(text(statement))
+        # the indexes of the old tables and the ones added to new tables
+        # after they were created
+        for table in Base.metadata.sorted_tables:
+            for index in sorted(table.indexes, key=lambda index: index.name):
+                await connection.execute(CreateIndex(index,
+                                                     if_not_exists=True))
+    await engine.dispose()
+    print("Database migrated successfully.")
+
+
+if __name__ == "__main__":
+    asyncio.run(migrate_database())
@@ -0,0 +1,89 @@
+from chatgpt_fastapi import artifacts
+from fastapi import FastAPI, Request, Response
+from fastapi.testclient import TestClient
+import os
+import pytest
+
+
+def test_parse_range():
+    assert artifacts.parse_range('bytes=0-99', 1000) == (0, 99)
+    assert artifacts.parse_range('bytes=900-', 1000) == (900, 999)
+    assert artifacts.parse_range('bytes=-100', 1000) == (900, 999)
+    assert artifacts.parse_range('bytes=500-5000', 1000) == (500, 999)
+    assert artifacts.parse_range('bytes=1000-', 1000) is None
+    assert artifacts.parse_range('bytes=0-1,5-9', 1000) is None
+    assert artifacts.parse_range('items=0-1', 1000) is None
+
+
+@pytest.mark.asyncio
+async def test_store_artifact_is_content_addressed_and_evicted(
+        tmp_path, monkeypatch):
+    monkeypatch.setattr(artifacts, 'ARTIFACT_DIR', str(tmp_path))
+
+    async def chunks(content):
+        yield content
+
+    first = await artifacts.store_artifact(chunks(b'a' * 100))
+    os.utime(artifacts.artifact_path(first), (1, 1))
+    assert first == await artifacts.store_artifact(chunks(b'a' * 100))
+    os.utime(artifacts.artifact_path(first), (1, 1))
+
+    monkeypatch.setattr(artifacts, 'ARTIFACT_MAX_BYTES', 150)
+    second = await artifacts.store_artifact(chunks(b'b' * 100))
+
+    assert sorted(os.listdir(tmp_path)) == [f'{second}.zip']
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(artifacts, 'ARTIFACT_DIR', str(tmp_path))
+    digest = 'a' * 64
+    with open(artifacts.artifact_path(digest), 'wb') as artifact:
+        artifact.write(bytes(range(100)))
+    app = FastAPI()
+
+    @app.get('/artifact')
+    async def get_artifact(request: Request):
+        return (artifacts.artifact_response(request, digest, '1.zip')
+                or Response(status_code=404))
+
+    return TestClient(app), digest
+
+
+def test_artifact_response(client):
+    client, digest = client
+    etag = f'"{digest}"'
+
+    response = client.get('/artifact')
+    assert response.status_code == 200
+    assert response.content == bytes(range(100))
+    assert response.headers['etag'] == etag
+
+    response = client.get('/artifact', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.content == b''
+
+    response = client.get('/artifact', headers={'Range': 'bytes=10-19'})
+    assert response.status_code == 206
+    assert response.content == bytes(range(10, 20))
+    assert response.headers['content-range'] == 'bytes 10-19/100'
+
+    response = client.get('/artifact', headers={'Range': 'bytes=100-'})
+    assert response.status_code == 416
+    assert response.headers['content-range'] == 'bytes */100'
+
+    response = client.get('/artifact', headers={'If-Range': etag,
+                                                'Range': 'bytes=-5'})
+    assert response.status_code == 206
+    assert response.content == bytes(range(95, 100))
+    # the client has an older version, the whole artifact is sent
+    response = client.get('/artifact', headers={'If-Range': '"old"',
+                                                'Range': 'bytes=-5'})
+    assert response.status_code == 200
+    assert response.content == bytes(range(100))
+
+
+def test_evicted_artifact_is_not_served(client):
+    client, digest = client
+    artifacts.remove_artifact(digest)
+    assert client.get('/artifact').status_code == 404
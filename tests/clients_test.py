@@ -0,0 +1,52 @@
+from chatgpt_fastapi import clients
+from chatgpt_fastapi.main import app
+from fastapi.testclient import TestClient
+import httpx
+import pytest
+
+
+@pytest.fixture
+def no_clients(monkeypatch):
+    monkeypatch.setattr(clients, 'OPENAI_API_KEY', 'test-key')
+    monkeypatch.setattr(clients, 'openai_client', None)
+    monkeypatch.setattr(clients, 'textru_client', None)
+
+
+@pytest.mark.asyncio
+async def test_clients_are_created_once(no_clients, monkeypatch):
+    created = []
+    requests = []
+
+    def async_client(**kwargs):
+        client = httpx.AsyncClient(transport=httpx.MockTransport(
+            lambda request: requests.append(request)
+            or httpx.Response(200, json={})), **kwargs)
+        created.append(client)
+        return client
+
+    monkeypatch.setattr(clients, 'AsyncClient', async_client)
+    assert clients.get_openai_client() is clients.get_openai_client()
+
+    for _ in range(2):
+        response = await clients.textru_post('https://api.text.ru/post',
+                                             json={})
+        assert response.status_code == 200
+    assert len(created) == 1
+    assert len(requests) == 2
+    assert clients.textru_pool_wait_stats.requests >= 2
+
+    await clients.close_openai_client()
+    await clients.close_textru_client()
+    assert created[0].is_closed
+    assert (clients.openai_client, clients.textru_client) == (None, None)
+
+
+def test_clients_are_closed_on_shutdown(no_clients):
+    with TestClient(app):
+        openai_client = clients.openai_client
+        textru_client = clients.textru_client
+        assert openai_client is not None
+        assert textru_client is not None
+    assert textru_client.is_closed
+    assert openai_client._client.is_closed
+    assert (clients.openai_client, clients.textru_client) == (None, None)
@@ -0,0 +1,19 @@
+import os
+import tempfile
+
+# the application reads its settings when its modules are imported, the
+# tests use a fresh SQLite database unless DATABASE_URL is set
+os.environ.setdefault('DATABASE_URL', 'sqlite+aiosqlite:///' + os.path.join(
+    tempfile.mkdtemp(prefix='chatgpt-fastapi-tests-'), 'test.db'))
+
+from chatgpt_fastapi.database import (  # noqa: E402
+    create_db_and_tables, engine)
+import pytest_asyncio  # noqa: E402
+
+
+@pytest_asyncio.fixture
+async def database():
+    await create_db_and_tables()
+    yield
+    # the connections belong to the event loop of the test
+    await engine.dispose()
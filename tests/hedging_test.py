@@ -0,0 +1,43 @@
+import asyncio
+from chatgpt_fastapi.hedging import Hedger
+import pytest
+
+
+@pytest.mark.asyncio
+async def test_slow_call_is_hedged_and_loser_cancelled():
+    hedger = Hedger('test', enabled=True, percentile=0.5, max_rate=1,
+                    min_samples=3)
+    delays = [0.001, 0.001, 0.001, 1, 0.001]
+    cancelled = []
+
+    async def call():
+        delay = delays.pop(0)
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            cancelled.append(delay)
+            raise
+        return delay
+
+    for _ in range(3):
+        await hedger.run(call)
+    assert await hedger.run(call) == 0.001
+    await asyncio.sleep(0)
+    assert cancelled == [1]
+    assert hedger.as_dict()['hedges'] == 1
+    assert hedger.as_dict()['hedge_wins'] == 1
+
+
+@pytest.mark.asyncio
+async def test_hedge_rate_is_capped():
+    hedger = Hedger('test', enabled=True, percentile=0.5, max_rate=0.2,
+                    min_samples=1)
+    hedger._latencies.append(0.001)
+
+    async def call():
+        await asyncio.sleep(0.01)
+        return 'done'
+
+    for _ in range(10):
+        assert await hedger.run(call) == 'done'
+    assert hedger.hedges <= 2
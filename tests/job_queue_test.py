@@ -0,0 +1,123 @@
+from chatgpt_fastapi import job_queue
+from chatgpt_fastapi.job_queue import (JOB_LEASE_SECONDS, JOB_MAX_ATTEMPTS,
+                                       claim_job, enqueue_text_set_job,
+                                       finish_job, get_queue_stats,
+                                       heartbeat_job, job_queue_jobs)
+from chatgpt_fastapi.models import Base, TextJob, TextsParsingSet
+from datetime import timedelta
+import pytest
+import pytest_asyncio
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import StaticPool
+import uuid
+
+
+@pytest_asyncio.fixture
+async def session_maker():
+    engine = create_async_engine('sqlite+aiosqlite://',
+                                 poolclass=StaticPool)
+    async with engine.begin() as connection:
+        await connection.run_sync(Base.metadata.create_all)
+    yield async_sessionmaker(engine)
+    await engine.dispose()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [job_queue.utcnow()]
+    monkeypatch.setattr(job_queue, 'utcnow', lambda: now[0])
+    return now
+
+
+async def enqueue_jobs(session_maker, *priorities):
+    async with session_maker() as session:
+        text_set = TextsParsingSet(author=uuid.uuid4(), set_name='set')
+        session.add(text_set)
+        await session.flush()
+        jobs = [await enqueue_text_set_job(session, text_set.id,
+                                           {'line': line}, priority)
+                for line, priority in enumerate(priorities)]
+        await session.flush()
+        job_ids = [job.id for job in jobs]
+        await session.commit()
+    return job_ids
+
+
+async def get_job(session_maker, job_id):
+    async with session_maker() as session:
+        return await session.get(TextJob, job_id)
+
+
+@pytest.mark.asyncio
+async def test_claim_job(session_maker, clock):
+    low, high = await enqueue_jobs(session_maker, 0, 5)
+    async with session_maker() as session:
+        claimed = await claim_job(session, 'worker-1')
+        assert claimed == {'attempts': 1, 'id': high,
+                           'parameters': {'line': 1},
+                           'parsing_set_id': claimed['parsing_set_id']}
+        assert (await claim_job(session, 'worker-2'))['id'] == low
+        # both jobs are leased
+        assert await claim_job(session, 'worker-3') is None
+
+    job = await get_job(session_maker, high)
+    assert job.status == 'running'
+    assert job.locked_by == 'worker-1'
+    assert job.locked_until == clock[0] + timedelta(
+        seconds=JOB_LEASE_SECONDS)
+
+
+@pytest.mark.asyncio
+async def test_heartbeat_is_rejected_after_a_takeover(session_maker, clock):
+    job_id, = await enqueue_jobs(session_maker, 0)
+    async with session_maker() as session:
+        await claim_job(session, 'worker-1')
+        assert await heartbeat_job(session, job_id, 'worker-1')
+
+        # worker-1 stops sending heartbeats and its lease runs out
+        clock[0] += timedelta(seconds=JOB_LEASE_SECONDS + 1)
+        assert (await claim_job(session, 'worker-2'))['id'] == job_id
+        assert not await heartbeat_job(session, job_id, 'worker-1')
+        assert await heartbeat_job(session, job_id, 'worker-2')
+
+        # the old worker can't finish the job of the new one
+        await finish_job(session, job_id, 'worker-1', error='stale')
+    job = await get_job(session_maker, job_id)
+    assert (job.status, job.locked_by) == ('running', 'worker-2')
+
+
+@pytest.mark.asyncio
+async def test_expired_lease_is_reclaimed(session_maker, clock):
+    job_id, = await enqueue_jobs(session_maker, 0)
+    async with session_maker() as session:
+        await claim_job(session, 'worker-1')
+        # the lease is still valid
+        assert await claim_job(session, 'worker-2') is None
+
+        for attempt in range(2, JOB_MAX_ATTEMPTS + 1):
+            clock[0] += timedelta(seconds=JOB_LEASE_SECONDS + 1)
+            claimed = await claim_job(session, f'worker-{attempt}')
+            assert (claimed['id'], claimed['attempts']) == (job_id, attempt)
+            job = await get_job(session_maker, job_id)
+            assert job.locked_by == f'worker-{attempt}'
+
+        # a job that keeps losing its workers is given up
+        clock[0] += timedelta(seconds=JOB_LEASE_SECONDS + 1)
+        assert await claim_job(session, 'worker-last') is None
+    job = await get_job(session_maker, job_id)
+    assert job.status == 'failed'
+    assert job.error.startswith(f'Lease expired {JOB_MAX_ATTEMPTS} times')
+
+
+@pytest.mark.asyncio
+async def test_queue_gauge_drops_to_zero(session_maker, clock):
+    job_id, = await enqueue_jobs(session_maker, 0)
+    async with session_maker() as session:
+        await get_queue_stats(session)
+        assert job_queue_jobs.values[('queued',)] == 1
+        await claim_job(session, 'worker-1')
+        await finish_job(session, job_id, 'worker-1')
+        assert await get_queue_stats(session) == {'done': 1}
+    assert job_queue_jobs.values[('queued',)] == 0
+    assert job_queue_jobs.values[('running',)] == 0
+    assert job_queue_jobs.values[('done',)] == 1
@@ -0,0 +1,53 @@
+from chatgpt_fastapi import api_utils
+from chatgpt_fastapi.length_planner import (LengthPlanner,
+                                            append_continuation,
+                                            trim_to_sentence)
+import pytest
+from types import SimpleNamespace
+
+
+def test_max_tokens_follows_observed_ratio():
+    planner = LengthPlanner(chars_per_token=2, headroom=1.5,
+                            context_tokens=4096)
+    planner._encoding_loaded = True
+    assert planner.max_tokens(0) is None
+    assert planner.max_tokens(2000) == 1500
+    planner.observe('a' * 4000, 1000)
+    assert planner.chars_per_token == 4
+    assert planner.max_tokens(2000) == 750
+    # the prompt and the completion share the context window
+    assert planner.max_tokens(20000, 'a' * 8000) == 4096 - 2001
+
+
+def test_tail_and_continuation():
+    planner = LengthPlanner(chars_per_token=2)
+    planner._encoding_loaded = True
+    text = 'Первое предложение. Второе предложение здесь.'
+    assert planner.tail(text, 100) == text
+    assert planner.tail(text, 5) == 'здесь.'
+    assert trim_to_sentence('Одно. Два, три') == 'Одно.'
+    assert trim_to_sentence('без точки') == 'без точки'
+    assert append_continuation('Начало. ', 'Конец.') == 'Начало. Конец.'
+    assert append_continuation('Начало.', '\nАбзац.') == 'Начало.\n\nАбзац.'
+
+
+@pytest.mark.asyncio
+async def test_context_is_fitted_to_the_sent_prompt(monkeypatch):
+    planner = LengthPlanner(chars_per_token=1, context_tokens=2000)
+    planner._encoding_loaded = True
+    monkeypatch.setattr(api_utils, 'length_planner', planner)
+    sent = []
+
+    async def request_completion(full_task, temperature, reserved_tokens,
+                                 max_tokens=None):
+        sent.append((full_task, max_tokens))
+        return SimpleNamespace(choices=[SimpleNamespace(
+            finish_reason='stop', message=SimpleNamespace(content='text'))],
+            usage=None)
+
+    monkeypatch.setattr(api_utils, 'request_completion', request_completion)
+    await api_utils.raise_uniqueness('a' * 900, 'rewrite')
+    (full_task, max_tokens), = sent
+    # the randomizer string is counted with the prompt
+    assert len(full_task) > len('rewrite\n' + 'a' * 900)
+    assert max_tokens == 2000 - planner.count_tokens(full_task)
@@ -0,0 +1,25 @@
+from chatgpt_fastapi.metrics import Counter, Histogram, registry, \
+    render_metrics
+
+
+def test_render_histogram_and_counter():
+    histogram = Histogram('test_latency_seconds', 'Test latency',
+                          ('outcome',), buckets=(0.1, 1))
+    counter = Counter('test_errors_total', 'Test errors', ('error_class',))
+    try:
+        histogram.observe(0.05, outcome='ok')
+        histogram.observe(0.5, outcome='ok')
+        histogram.observe(3, outcome='ok')
+        counter.inc(error_class='Rate"Limit')
+
+        lines = render_metrics().splitlines()
+    finally:
+        registry.remove(histogram)
+        registry.remove(counter)
+
+    assert '# TYPE test_latency_seconds histogram' in lines
+    assert 'test_latency_seconds_bucket{outcome="ok",le="0.1"} 1' in lines
+    assert 'test_latency_seconds_bucket{outcome="ok",le="1"} 2' in lines
+    assert 'test_latency_seconds_bucket{outcome="ok",le="+Inf"} 3' in lines
+    assert 'test_latency_seconds_count{outcome="ok"} 3' in lines
+    assert 'test_errors_total{error_class="Rate\\"Limit"} 1.0' in lines
@@ -0,0 +1,75 @@
+from chatgpt_fastapi.database import async_session_maker
+from chatgpt_fastapi.models import Text
+from chatgpt_fastapi.near_duplicates import NearDuplicateIndex
+import pytest
+from sqlalchemy import delete, func, select
+
+
+def test_index_finds_near_copies_only():
+    index = NearDuplicateIndex(table_bits=10)
+    original = ('Осенний лес наполнен запахом прелых листьев, грибов и '
+                'влажной земли, а утренний туман медленно тает над рекой.')
+    other = ('The quarterly report shows steady growth in every region, '
+             'driven mostly by new subscriptions and lower churn.')
+    index.add(1, index.signature(original))
+    index.add(2, index.signature(other))
+
+    similarity, text_id = index.query(index.signature(
+        original.replace('медленно', 'неспешно')))
+    assert text_id == 1
+    assert similarity > 0.6
+
+    similarity, _ = index.query(index.signature(
+        'Рецепт простого пирога с яблоками и корицей на каждый день.'))
+    assert similarity < 0.3
+    assert index.as_dict()['texts'] == 2
+
+
+async def add_text(text_id, text, minhash=None):
+    async with async_session_maker() as session:
+        session.add(Text(id=text_id, minhash=minhash, parsing_set_id=1,
+                         text=text))
+        await session.commit()
+
+
+@pytest.mark.asyncio
+async def test_index_loads_stored_signatures_and_late_commits(database):
+    async with async_session_maker() as session:
+        first_id = (await session.scalar(select(func.max(Text.id))) or 0) + 1
+    index = NearDuplicateIndex(table_bits=10)
+    stored = index.signature('stored text')
+    await add_text(first_id, 'stored text', stored.tobytes())
+    # a worker committed first_id + 2 while first_id + 1 was in flight
+    await add_text(first_id + 2, 'legacy text')
+    await index._load_new_texts()
+    assert index.text_ids[-2:].tolist() == [first_id, first_id + 2]
+    assert index.signatures[-2 * index.num_perm:-index.num_perm] == stored
+    assert index.as_dict()['gaps'] == 1
+
+    await add_text(first_id + 1, 'late text')
+    await index._load_new_texts()
+    assert index.text_ids[-1] == first_id + 1
+    assert index.as_dict()['gaps'] == 0
+    async with async_session_maker() as session:
+        # hashed once, a worker starting later loads the signature
+        legacy = await session.get(Text, first_id + 2)
+        assert legacy.minhash == index.signature('legacy text').tobytes()
+
+
+@pytest.mark.asyncio
+async def test_deleted_texts_are_not_matched(database):
+    async with async_session_maker() as session:
+        text_id = (await session.scalar(select(func.max(Text.id))) or 0) + 1
+    text = ('Осенний лес наполнен запахом прелых листьев, грибов и '
+            'влажной земли, а утренний туман медленно тает над рекой.')
+    index = NearDuplicateIndex(table_bits=10)
+    await add_text(text_id, text)
+    index.add(text_id, index.signature(text))
+    assert await index.similarity(text) == (1.0, text_id)
+
+    # deleted by another process
+    async with async_session_maker() as session:
+        await session.execute(delete(Text).where(Text.id == text_id))
+        await session.commit()
+    assert await index.similarity(text) == (0.0, None)
+    assert index.as_dict()['removed'] == 1
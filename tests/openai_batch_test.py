@@ -0,0 +1,61 @@
+from chatgpt_fastapi import openai_batch
+from chatgpt_fastapi.openai_batch import build_batch_request, parse_batch_line
+import httpx
+import pytest
+
+
+@pytest.mark.asyncio
+async def test_build_batch_request():
+    request = await build_batch_request(7, 'Напиши текст', 1, 1000)
+    assert request['custom_id'] == 'line-7'
+    assert request['url'] == '/v1/chat/completions'
+    # the randomizer strings are part of the prompt, as for single requests
+    assert request['body']['messages'][0]['content'].startswith(
+        'Напиши текст\n')
+    assert request['body']['max_tokens'] > 0
+
+
+def test_parse_batch_line():
+    result = parse_batch_line({
+        'custom_id': 'line-0',
+        'response': {'status_code': 200, 'body': {
+            'choices': [{'message': {'content': 'Один. Два'},
+                         'finish_reason': 'length'}],
+            'usage': {'completion_tokens': 5, 'prompt_tokens': 3}}}})
+    assert result == {'completion_tokens': 5, 'prompt_tokens': 3,
+                      'text': 'Один.', 'status': 'ok'}
+
+    failed = parse_batch_line({
+        'custom_id': 'line-1',
+        'response': {'status_code': 500, 'body': {
+            'error': {'message': 'The server had an error'}}}})
+    assert failed['text'] is None
+    assert failed['error_class'] == 'BatchRequestError'
+    assert 'The server had an error' in failed['status']
+
+
+@pytest.mark.asyncio
+async def test_batch_file_is_downloaded_before_it_is_read(monkeypatch):
+    requests = []
+
+    async def content():
+        # a line split over two chunks
+        yield b'{"custom_id": "line-0"}\n{"custom_'
+        yield b'id": "line-1"}\n\n'
+
+    def answer(request):
+        requests.append(request.url.path)
+        if len(requests) == 1:
+            return httpx.Response(503, headers={'retry-after': '0'})
+        return httpx.Response(200, content=content())
+
+    client = httpx.AsyncClient(base_url='https://api.openai.test/v1',
+                               transport=httpx.MockTransport(answer))
+    monkeypatch.setattr(openai_batch, 'get_openai_batch_client',
+                        lambda: client)
+    lines = openai_batch.iter_batch_file('file-1')
+    assert await anext(lines) == {'custom_id': 'line-0'}
+    # the connection is not needed anymore while the lines are handed on
+    assert len(requests) == 2
+    assert [line async for line in lines] == [{'custom_id': 'line-1'}]
+    await client.aclose()
@@ -0,0 +1,96 @@
+import asyncio
+from chatgpt_fastapi.pipeline import Pipeline, Stage
+import pytest
+
+
+@pytest.mark.asyncio
+async def test_pipeline_stages_have_own_workers():
+    running = {'double': 0, 'slow': 0}
+    peak = {'double': 0, 'slow': 0}
+
+    def stage(name, delay, change):
+        async def handler(data):
+            running[name] += 1
+            peak[name] = max(peak[name], running[name])
+            await asyncio.sleep(delay)
+            running[name] -= 1
+            return change(data)
+        return handler
+
+    async def first(data):
+        if data['value'] < 0:
+            return dict(data, error='negative')
+        return data
+
+    pipeline = Pipeline([
+        Stage('first', first),
+        Stage('double', stage('double', 0.001,
+                              lambda data: dict(data,
+                                                value=data['value'] * 2)), 1),
+        Stage('slow', stage('slow', 0.01,
+                            lambda data: dict(data,
+                                              value=data['value'] + 1)),
+              4, queue_size=2),
+    ])
+    loop = asyncio.get_running_loop()
+    futures = [loop.create_future() for _ in range(8)]
+    await asyncio.gather(*(pipeline.run(future, {'value': value})
+                           for value, future in zip([-1, *range(7)],
+                                                    futures)))
+    results = await asyncio.gather(*futures)
+    await pipeline.close()
+
+    assert results[0] == {'value': -1, 'error': 'negative'}
+    assert [result['value'] for result in results[1:]] == [
+        value * 2 + 1 for value in range(7)]
+    assert peak == {'double': 1, 'slow': 4}
+    stats = pipeline.as_dict()
+    assert stats['double']['processed'] == 7
+    assert stats['slow']['queued'] == 0
+
+
+@pytest.mark.asyncio
+async def test_cancelled_item_stops_its_handler():
+    started, stopped = asyncio.Event(), asyncio.Event()
+
+    async def slow(data):
+        started.set()
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            stopped.set()
+            raise
+        return data
+
+    pipeline = Pipeline([Stage('slow', slow, 1)])
+    loop = asyncio.get_running_loop()
+    cancelled, kept = loop.create_future(), loop.create_future()
+    await pipeline.run(cancelled, {'value': 1})
+    await started.wait()
+    cancelled.cancel()
+    await asyncio.wait_for(stopped.wait(), 1)
+
+    # the worker of the stage goes on with the next item
+    pipeline.stages[0].handler = lambda data: asyncio.sleep(0, data)
+    await pipeline.run(kept, {'value': 2})
+    assert await kept == {'value': 2}
+    assert pipeline.as_dict()['slow']['cancelled'] == 1
+    await pipeline.close()
+
+
+@pytest.mark.asyncio
+async def test_handler_cancelled_from_inside_keeps_the_worker():
+    async def cancelled_inside(data):
+        if data['value'] == 1:
+            raise asyncio.CancelledError()
+        return data
+
+    pipeline = Pipeline([Stage('flaky', cancelled_inside, 1)])
+    loop = asyncio.get_running_loop()
+    given_up, kept = loop.create_future(), loop.create_future()
+    await pipeline.run(given_up, {'value': 1})
+    await pipeline.run(kept, {'value': 2})
+    assert await kept == {'value': 2}
+    assert given_up.cancelled()
+    assert pipeline.as_dict()['flaky']['failed'] == 1
+    await pipeline.close()
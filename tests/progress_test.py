@@ -0,0 +1,40 @@
+import asyncio
+from chatgpt_fastapi.progress import ProgressHub, format_event
+import json
+import pytest
+
+
+@pytest.mark.asyncio
+async def test_events_reach_set_and_user_subscribers():
+    hub = ProgressHub(queue_size=2)
+    set_events = hub.events('set:1', keepalive=0.01)
+    user_events = hub.events('user:a')
+    set_next = asyncio.ensure_future(set_events.__anext__())
+    user_next = asyncio.ensure_future(user_events.__anext__())
+    await asyncio.sleep(0)
+    assert hub.subscriber_count() == 2
+
+    hub.publish({'author': 'a', 'text_set_id': 1, 'type': 'text'})
+    assert (await set_next)['type'] == 'text'
+    assert (await user_next)['text_set_id'] == 1
+    # nothing happened, the stream gets a keepalive
+    assert await set_events.__anext__() is None
+
+    # a client that does not read keeps only the newest events
+    for line in range(3):
+        hub.publish({'author': 'a', 'line_no': line, 'text_set_id': 2,
+                     'type': 'text'})
+    assert hub.dropped == 1
+    assert (await user_events.__anext__())['line_no'] == 1
+
+    await set_events.aclose()
+    await user_events.aclose()
+    assert hub.subscriber_count() == 0
+
+
+def test_format_event():
+    message = format_event({'type': 'rewrite', 'attempt': 1})
+    assert message.startswith('event: rewrite\ndata: ')
+    assert message.endswith('\n\n')
+    data = json.loads(message.split('data: ')[1])
+    assert data == {'type': 'rewrite', 'attempt': 1}
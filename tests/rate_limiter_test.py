@@ -0,0 +1,29 @@
+from chatgpt_fastapi.rate_limiter import RateLimiter
+import pytest
+
+
+@pytest.mark.asyncio
+async def test_rate_limiter_waits_only_over_quota(mocker):
+    sleep = mocker.patch('chatgpt_fastapi.rate_limiter.asyncio.sleep')
+    mocker.patch('chatgpt_fastapi.rate_limiter.time.monotonic',
+                 return_value=100.0)
+    limiter = RateLimiter(requests_per_minute=60, tokens_per_minute=6000)
+
+    await limiter.acquire(3000)
+    await limiter.acquire(3000)
+    sleep.assert_not_called()
+
+    await limiter.acquire(1000)
+    sleep.assert_called_once_with(pytest.approx(10.0))
+
+
+def test_rate_limiter_follows_stricter_headers():
+    limiter = RateLimiter(requests_per_minute=60, tokens_per_minute=6000)
+    limiter.update_from_headers({
+        'x-ratelimit-limit-requests': '30',
+        'x-ratelimit-remaining-requests': '5',
+        'x-ratelimit-remaining-tokens': 'broken',
+    })
+    assert limiter.requests.capacity == 30
+    assert limiter.requests.balance == pytest.approx(5, abs=0.1)
+    assert limiter.tokens.capacity == 6000
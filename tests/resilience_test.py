@@ -0,0 +1,60 @@
+import asyncio
+from chatgpt_fastapi.resilience import CircuitBreaker, RetryableError
+import pytest
+import time
+
+
+def classify(error):
+    return isinstance(error, RetryableError), getattr(
+        error, 'retry_after', None), True
+
+
+@pytest.mark.asyncio
+async def test_call_retries_transient_errors(monkeypatch):
+    monkeypatch.setattr('chatgpt_fastapi.resilience.RETRY_BASE_DELAY', 0.001)
+    breaker = CircuitBreaker('test', min_calls=100)
+    calls = []
+
+    async def flaky():
+        calls.append(time.monotonic())
+        if len(calls) < 3:
+            raise RetryableError('busy', retry_after=0.02 * len(calls))
+        return 'done'
+
+    assert await breaker.call(flaky, classify, max_attempts=3) == 'done'
+    # the second retry waited for the longer Retry-After
+    assert calls[2] - calls[1] >= 0.04
+
+    async def broken():
+        raise ValueError('bad request')
+
+    with pytest.raises(ValueError):
+        await breaker.call(broken, lambda error: (False, None, False))
+    assert breaker.state == 'closed'
+
+
+@pytest.mark.asyncio
+async def test_breaker_opens_and_probes():
+    breaker = CircuitBreaker('test', failure_rate=0.5, min_calls=4,
+                             window=10, open_seconds=0.05)
+    for _ in range(4):
+        breaker.record_failure()
+    assert breaker.state == 'open'
+
+    events = []
+
+    async def probe(name):
+        await breaker.before_call()
+        events.append(f'{name} started')
+        await asyncio.sleep(0.01)
+        events.append(f'{name} finished')
+        breaker.record_success()
+
+    started = time.monotonic()
+    await asyncio.gather(probe('first'), probe('second'))
+
+    assert time.monotonic() - started >= 0.05
+    # only one call probes the upstream while the breaker is half open
+    assert events[1] == events[0].replace('started', 'finished')
+    assert breaker.state == 'closed'
+    assert breaker.as_dict()['opened'] == 1
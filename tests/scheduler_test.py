@@ -0,0 +1,76 @@
+import asyncio
+from chatgpt_fastapi.scheduler import JobScheduler
+import pytest
+
+
+@pytest.mark.asyncio
+async def test_scheduler_limits_and_round_robin():
+    scheduler = JobScheduler(workers=2, user_workers=2, set_workers=2)
+    started = []
+    release = asyncio.Event()
+
+    def job(name):
+        async def run():
+            started.append(name)
+            await release.wait()
+            return name
+        return run
+
+    big = [scheduler.submit('big', 'user-1', job(f'big-{i}'))
+           for i in range(4)]
+    small = [scheduler.submit('small', 'user-2', job(f'small-{i}'))
+             for i in range(2)]
+    urgent = scheduler.submit('urgent', 'user-3', job('urgent'), priority=1)
+    await asyncio.sleep(0)
+
+    assert started == ['big-0', 'big-1']
+    assert scheduler.as_dict()['queued'] == 5
+
+    release.set()
+    results = await asyncio.gather(*big, *small, urgent)
+
+    assert started[2] == 'urgent'
+    # sets of equal priority take turns once workers free up
+    assert started[3:5] == ['small-0', 'big-2']
+    assert sorted(results) == sorted(started)
+    assert scheduler.as_dict()['running'] == 0
+
+
+@pytest.mark.asyncio
+async def test_scheduler_cancel_set():
+    scheduler = JobScheduler(workers=1, user_workers=1, set_workers=1)
+    release = asyncio.Event()
+
+    async def job():
+        await release.wait()
+
+    futures = [scheduler.submit(1, 'user', job) for _ in range(3)]
+    await asyncio.sleep(0)
+    scheduler.cancel_set(1)
+    results = await asyncio.gather(*futures, return_exceptions=True)
+
+    assert all(isinstance(result, asyncio.CancelledError)
+               for result in results)
+    assert scheduler.as_dict() == {'workers': 1, 'running': 0, 'queued': 0,
+                                   'completed': 1, 'running_by_user': {},
+                                   'sets': {}}
+
+
+@pytest.mark.asyncio
+async def test_scheduler_cancel_queued_set():
+    scheduler = JobScheduler(workers=1, user_workers=1, set_workers=1)
+    release = asyncio.Event()
+
+    async def job():
+        await release.wait()
+
+    running = scheduler.submit(1, 'user-1', job)
+    queued = [scheduler.submit(2, 'user-2', job) for _ in range(2)]
+    await asyncio.sleep(0)
+    scheduler.cancel_set(2)
+
+    assert all(future.cancelled() for future in queued)
+    assert list(scheduler.as_dict()['sets']) == [1]
+    assert list(scheduler._rotation) == [1]
+    release.set()
+    await running
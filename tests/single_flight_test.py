@@ -0,0 +1,39 @@
+import asyncio
+from chatgpt_fastapi.single_flight import SingleFlight
+import pytest
+
+
+@pytest.mark.asyncio
+async def test_followers_share_the_leader_result():
+    flights = SingleFlight(lambda result: dict(result, shared=True))
+    loop = asyncio.get_running_loop()
+    leader, follower = loop.create_future(), loop.create_future()
+    runs = []
+
+    assert not flights.join('key', leader, lambda: runs.append('leader'))
+    assert flights.join('key', follower, lambda: runs.append('follower'))
+    leader.set_result({'text': 'done'})
+    assert await follower == {'text': 'done', 'shared': True}
+    assert runs == []
+
+    # the key is free again once the leader is done
+    late = loop.create_future()
+    assert not flights.join('key', late, lambda: None)
+
+
+@pytest.mark.asyncio
+async def test_cancelled_leader_hands_over_to_a_follower():
+    flights = SingleFlight()
+    loop = asyncio.get_running_loop()
+    leader, first, second = (loop.create_future() for _ in range(3))
+    runs = []
+
+    flights.join('key', leader, lambda: runs.append('leader'))
+    flights.join('key', first, lambda: runs.append('first'))
+    flights.join('key', second, lambda: runs.append('second'))
+    leader.cancel()
+    await asyncio.sleep(0)
+    assert runs == ['first']
+    first.set_result('text')
+    assert await second == 'text'
+    assert flights.as_dict()['rerun'] == 1
@@ -0,0 +1,68 @@
+from chatgpt_fastapi.task_import import (TaskLineError, iter_task_batches,
+                                         iter_task_file, iter_task_strings)
+import io
+import pytest
+import tempfile
+
+
+def results(tasks):
+    return [(line, str(task) if isinstance(task, TaskLineError) else task)
+            for line, task in tasks]
+
+
+def test_csv_file_is_read_line_by_line():
+    csv_file = io.BytesIO(
+        '﻿task,header\n'
+        'Напиши текст,Заголовок\n'
+        '"Текст в\nдвух строках",Второй\n'
+        '\n'
+        'только задание\n'
+        'задание, \n'.encode())
+    assert results(iter_task_file(csv_file, 'csv')) == [
+        (2, ('Напиши текст', 'Заголовок')),
+        (4, ('Текст в\nдвух строках', 'Второй')),
+        (6, 'expected 2 columns, task and header, got 1'),
+        (7, 'header is empty'),
+    ]
+    # the upload keeps its file
+    assert not csv_file.closed
+
+
+def test_jsonl_file_reports_invalid_lines():
+    jsonl_file = io.BytesIO(
+        b'{"task": "one", "header": "first"}\n'
+        b'{"task": "two"\n'
+        b'["three", "third"]\n'
+        b'{"task": "four", "header": "a\\nb"}\n')
+    tasks = results(iter_task_file(jsonl_file, 'jsonl'))
+    assert tasks[0] == (1, ('one', 'first'))
+    assert tasks[1][0] == 2 and tasks[1][1].startswith('invalid JSON')
+    assert tasks[2:] == [(3, 'expected an object with task and header'),
+                         (4, 'header must be a single line')]
+
+
+@pytest.mark.parametrize('max_size', [0, 1024 * 1024])
+def test_spooled_upload_file(max_size):
+    # starlette keeps uploads in a SpooledTemporaryFile, in memory or on disk
+    with tempfile.SpooledTemporaryFile(max_size=max_size) as upload:
+        upload.write('\ufefftask,header\r\n'
+                     '"Текст в\r\nдвух строках",Первый\r\n'
+                     'Напиши текст,Второй\r\n'.encode())
+        upload.write(b'\xff,broken\r\n')
+        upload.seek(0)
+        assert results(iter_task_file(upload, 'csv'))[:2] == [
+            (3, ('Текст в\r\nдвух строках', 'Первый')),
+            (4, ('Напиши текст', 'Второй')),
+        ]
+        upload.seek(0)
+        assert 'decode' in results(iter_task_file(upload, 'csv'))[2][1]
+        assert not upload.closed
+
+
+@pytest.mark.asyncio
+async def test_task_batches():
+    tasks = iter_task_strings('\n'.join(f'task {line}||header {line}'
+                                        for line in range(5)) + '\nno header')
+    batches = [batch async for batch in iter_task_batches(tasks, 2)]
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+    assert batches[-1] == [(5, ('task 4', 'header 4'))]
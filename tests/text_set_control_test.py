@@ -0,0 +1,302 @@
+import asyncio
+from chatgpt_fastapi import artifacts, near_duplicates, openai_batch, services
+from chatgpt_fastapi.database import async_session_maker
+from chatgpt_fastapi.job_queue import finish_job, get_set_jobs
+from chatgpt_fastapi.models import (OpenAIBatch, Text, TextOutcome,
+                                    TextsParsingSet, User)
+from chatgpt_fastapi.pipeline import Pipeline, Stage
+from chatgpt_fastapi.scheduler import JobScheduler
+from chatgpt_fastapi.single_flight import SingleFlight
+import json
+import pytest
+import pytest_asyncio
+from sqlalchemy import select
+import uuid
+
+
+@pytest_asyncio.fixture
+async def text_sets(database, monkeypatch, tmp_path):
+    # a fresh pipeline and scheduler for the event loop of the test
+    pipeline = Pipeline([Stage(stage.name, stage.handler, stage.workers)
+                         for stage in services.text_pipeline.stages])
+    monkeypatch.setattr(services, 'text_pipeline', pipeline)
+    monkeypatch.setattr(services, 'text_scheduler', JobScheduler())
+    monkeypatch.setattr(services, 'text_flights',
+                        SingleFlight(services.deduplicated_text_data))
+    monkeypatch.setattr(artifacts, 'ARTIFACT_DIR', str(tmp_path))
+    monkeypatch.setattr(near_duplicates, 'NEAR_DUPLICATE_INDEX', False)
+    monkeypatch.setattr(services, 'get_system_usage', lambda: '')
+
+    async def get_text_uniqueness(text):
+        return 90
+
+    monkeypatch.setattr(services, 'get_text_uniqueness', get_text_uniqueness)
+    yield
+    await pipeline.close()
+
+
+async def create_set(lines, generation_mode='online'):
+    async with async_session_maker() as session:
+        user = User(email=f'{uuid.uuid4()}@example.com', hashed_password='-',
+                    is_active=True, is_superuser=False, is_verified=True)
+        session.add(user)
+        await session.flush()
+        text_set = await services.create_text_set(
+            author=user.id, generation_mode=generation_mode,
+            required_uniqueness=50, rewriting_task='rewrite', session=session,
+            set_name='set', task_strings='\n'.join(
+                f'task {line}||header {line}' for line in range(lines)),
+            temperature=1, text_len=0)
+        await session.refresh(text_set)
+        return text_set.id
+
+
+async def run_set(text_set_id):
+    # what a worker does with the job it claimed
+    async with async_session_maker() as session:
+        job = (await get_set_jobs(session, text_set_id))[0]
+        job.locked_by = 'test-worker'
+        job.status = 'running'
+        job_id, parameters = job.id, dict(job.parameters)
+        await session.commit()
+        await services.generate_texts(session=session,
+                                      text_set_id=text_set_id, **parameters)
+    async with async_session_maker() as session:
+        await finish_job(session, job_id, 'test-worker')
+
+
+async def get_state(text_set_id):
+    async with async_session_maker() as session:
+        text_set = await session.get(TextsParsingSet, text_set_id)
+        outcomes = dict((await session.execute(
+            select(TextOutcome.line_no, TextOutcome.status)
+            .where(TextOutcome.parsing_set_id == text_set_id)
+        )).all())
+        return text_set.parsed_amount, text_set.is_complete, outcomes
+
+
+async def cancel_set(text_set_id, run):
+    async with async_session_maker() as session:
+        text_set = await session.get(TextsParsingSet, text_set_id)
+        assert await services.cancel_text_set(session, text_set)
+    # the worker stops its job when it gets the set_cancelled event
+    run.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await run
+
+
+async def wait_until(condition):
+    for _ in range(200):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError('timed out')
+
+
+@pytest.mark.asyncio
+async def test_resume_and_retry_in_pipeline_mode(text_sets, monkeypatch):
+    calls = []
+    failing = {'task 1'}
+    unblocked = asyncio.Event()
+
+    async def get_text_from_openai(task, temperature, max_tokens=None):
+        calls.append(task)
+        if task == 'task 3':
+            await unblocked.wait()
+        if task in failing:
+            failing.discard(task)
+            return {'error_class': 'APIError', 'status': 'boom',
+                    'text': None}
+        return {'status': 'ok', 'text': f'text for {task}'}
+
+    monkeypatch.setattr(services, 'get_text_from_openai',
+                        get_text_from_openai)
+    text_set_id = await create_set(4)
+
+    run = asyncio.create_task(run_set(text_set_id))
+    await wait_until(lambda: len(calls) == 4)
+    await asyncio.sleep(0.1)
+    await cancel_set(text_set_id, run)
+    # the finished lines are kept
+    assert await get_state(text_set_id) == (
+        3, False, {0: 'ok', 1: 'failed', 2: 'ok'})
+
+    unblocked.set()
+    calls.clear()
+    async with async_session_maker() as session:
+        assert await services.resume_text_set(session, text_set_id)
+        assert not await services.resume_text_set(session, text_set_id)
+    await run_set(text_set_id)
+    assert calls == ['task 3']
+    assert await get_state(text_set_id) == (
+        4, True, {0: 'ok', 1: 'failed', 2: 'ok', 3: 'ok'})
+
+    calls.clear()
+    async with async_session_maker() as session:
+        # a finished set is retried, not resumed
+        assert not await services.resume_text_set(session, text_set_id)
+        assert await services.retry_text_set_lines(session,
+                                                   text_set_id) == 1
+    await run_set(text_set_id)
+    assert calls == ['task 1']
+    assert await get_state(text_set_id) == (
+        4, True, {0: 'ok', 1: 'ok', 2: 'ok', 3: 'ok'})
+
+
+@pytest.mark.asyncio
+async def test_usage_and_timings_are_stored(text_sets, monkeypatch):
+    async def get_text_from_openai(task, temperature, max_tokens=None):
+        await asyncio.sleep(0.05)
+        return {'completion_tokens': 20, 'prompt_tokens': 10,
+                'status': 'ok', 'text': f'text for {task}'}
+
+    async def raise_uniqueness(text, rewriting_task):
+        return {'completion_tokens': 7, 'prompt_tokens': 5, 'status': 'ok',
+                'text': f'rewritten {text}'}
+
+    async def get_text_uniqueness(text):
+        # the first text of line 0 is rewritten once
+        return 40 if text == 'text for task 0' else 90
+
+    monkeypatch.setattr(services, 'get_text_from_openai',
+                        get_text_from_openai)
+    monkeypatch.setattr(services, 'raise_uniqueness', raise_uniqueness)
+    monkeypatch.setattr(services, 'get_text_uniqueness', get_text_uniqueness)
+    text_set_id = await create_set(2)
+    await run_set(text_set_id)
+
+    async with async_session_maker() as session:
+        texts = (await session.execute(
+            select(Text).where(Text.parsing_set_id == text_set_id)
+            .order_by(Text.line_no)
+        )).scalars().all()
+        assert [(text.openai_calls, text.prompt_tokens,
+                 text.completion_tokens) for text in texts] == [
+            (2, 15, 27), (1, 10, 20)]
+        assert all(text.generation_seconds >= 0.05 for text in texts)
+        assert all(text.uniqueness_seconds is not None for text in texts)
+        text_set = await session.get(TextsParsingSet, text_set_id)
+        assert (text_set.prompt_tokens, text_set.completion_tokens) == (25,
+                                                                        47)
+        assert text_set.average_generation_seconds == pytest.approx(
+            sum(text.generation_seconds for text in texts) / 2)
+        assert text_set.average_extension_seconds is not None
+        assert text_set.average_uniqueness_seconds is not None
+
+
+class FakeBatchApi:
+    # answers every request of a batch, except the lines in failing
+
+    def __init__(self):
+        self.batches = {}
+        self.files = {}
+        self.failing = set()
+        self.answered_on_cancel = None
+        self.submitted = []
+
+    def answer(self, request):
+        line = int(request['custom_id'].removeprefix('line-'))
+        if line in self.failing:
+            return {'custom_id': request['custom_id'],
+                    'response': {'body': {'error': {'message': 'boom'}},
+                                 'status_code': 500}}
+        return {'custom_id': request['custom_id'],
+                'response': {'body': {'choices': [{
+                    'finish_reason': 'stop',
+                    'message': {'content': f'text for line {line}'}}]},
+                    'status_code': 200}}
+
+    async def call_batch_api(self, method, url, input_file=None, **kwargs):
+        if url == '/files':
+            input_file.seek(0)
+            file_id = f'file-{len(self.files)}'
+            self.files[file_id] = [json.loads(line) for line in input_file]
+            return {'id': file_id}
+        if url == '/batches':
+            requests = self.files[kwargs['json']['input_file_id']]
+            batch_id = f'batch-{len(self.batches)}'
+            self.submitted.append([request['custom_id']
+                                   for request in requests])
+            status = 'completed'
+            if self.answered_on_cancel is not None:
+                # the batch runs until it is cancelled
+                status = 'in_progress'
+                requests = requests[:self.answered_on_cancel]
+            self.files[f'output-{batch_id}'] = [self.answer(request)
+                                                for request in requests]
+            self.batches[batch_id] = {'id': batch_id, 'status': status}
+            return {'id': batch_id, 'status': 'validating'}
+        batch = self.batches[url.split('/')[2]]
+        if url.endswith('/cancel'):
+            batch['status'] = 'cancelled'
+            return dict(batch, status='cancelling')
+        if batch['status'] == 'in_progress':
+            return batch
+        return dict(batch, output_file_id=f"output-{batch['id']}")
+
+    async def iter_batch_file(self, file_id):
+        for batch_line in self.files[file_id]:
+            yield batch_line
+
+
+@pytest.fixture
+def batch_api(text_sets, monkeypatch):
+    batch_api = FakeBatchApi()
+    monkeypatch.setattr(openai_batch, 'OPENAI_BATCH_POLL_INTERVAL', 0.01)
+    monkeypatch.setattr(openai_batch, 'call_batch_api',
+                        batch_api.call_batch_api)
+    monkeypatch.setattr(openai_batch, 'iter_batch_file',
+                        batch_api.iter_batch_file)
+    return batch_api
+
+
+async def get_batch_statuses(text_set_id):
+    async with async_session_maker() as session:
+        return (await session.execute(
+            select(OpenAIBatch.status)
+            .where(OpenAIBatch.parsing_set_id == text_set_id)
+            .order_by(OpenAIBatch.id)
+        )).scalars().all()
+
+
+@pytest.mark.asyncio
+async def test_retry_in_batch_mode_submits_a_new_batch(batch_api):
+    batch_api.failing = {1}
+    text_set_id = await create_set(3, 'batch')
+    await run_set(text_set_id)
+    assert await get_state(text_set_id) == (
+        3, True, {0: 'ok', 1: 'failed', 2: 'ok'})
+
+    batch_api.failing = set()
+    async with async_session_maker() as session:
+        assert await services.retry_text_set_lines(session,
+                                                   text_set_id) == 1
+    await run_set(text_set_id)
+    assert batch_api.submitted == [['line-0', 'line-1', 'line-2'],
+                                   ['line-1']]
+    assert await get_batch_statuses(text_set_id) == ['superseded',
+                                                     'completed']
+    assert await get_state(text_set_id) == (
+        3, True, {0: 'ok', 1: 'ok', 2: 'ok'})
+
+
+@pytest.mark.asyncio
+async def test_resume_in_batch_mode_keeps_the_answered_lines(batch_api):
+    # the batch gets to two of the three lines before it is cancelled
+    batch_api.answered_on_cancel = 2
+    text_set_id = await create_set(3, 'batch')
+    run = asyncio.create_task(run_set(text_set_id))
+    await wait_until(lambda: batch_api.submitted)
+    await cancel_set(text_set_id, run)
+    assert await get_state(text_set_id) == (0, False, {})
+
+    batch_api.answered_on_cancel = None
+    async with async_session_maker() as session:
+        assert await services.resume_text_set(session, text_set_id)
+    await run_set(text_set_id)
+    assert batch_api.submitted == [['line-0', 'line-1', 'line-2'],
+                                   ['line-2']]
+    assert await get_batch_statuses(text_set_id) == ['cancelled',
+                                                     'completed']
+    assert await get_state(text_set_id) == (
+        3, True, {0: 'ok', 1: 'ok', 2: 'ok'})
@@ -0,0 +1,86 @@
+from chatgpt_fastapi.database import async_session_maker
+from chatgpt_fastapi.models import (Text, TextOutcome, TextsParsingSet,
+                                    TextTask, User)
+from chatgpt_fastapi.services import stream_text_set_zip
+from io import BytesIO
+import pytest
+import uuid
+import zipfile
+
+
+async def create_set(**columns):
+    async with async_session_maker() as session:
+        user = User(email=f'{uuid.uuid4()}@example.com', hashed_password='-',
+                    is_active=True, is_superuser=False, is_verified=True)
+        session.add(user)
+        await session.flush()
+        text_set = TextsParsingSet(author=user.id, is_complete=True,
+                                   set_name='set', **columns)
+        session.add(text_set)
+        await session.flush()
+        text_set_id = text_set.id
+        session.add_all([
+            Text(header='header 0', line_no=0, parsing_set_id=text_set_id,
+                 text='text 0', uniqueness=90),
+            Text(header='header 2\r', line_no=2, parsing_set_id=text_set_id,
+                 text='text 2', uniqueness=40)])
+        await session.commit()
+    return text_set_id
+
+
+async def read_zip(text_set_id):
+    chunks = [chunk async for chunk in stream_text_set_zip(text_set_id)]
+    with zipfile.ZipFile(BytesIO(b''.join(chunks))) as archive:
+        assert archive.testzip() is None
+        return {name: archive.read(name).decode()
+                for name in archive.namelist()}
+
+
+@pytest.mark.asyncio
+async def test_zip_of_a_set_with_line_rows(database):
+    text_set_id = await create_set()
+    async with async_session_maker() as session:
+        session.add_all(
+            [TextTask(header=f'header {line}', line_no=line,
+                      parsing_set_id=text_set_id, task=f'task {line}')
+             for line in range(3)]
+            + [TextOutcome(line_no=0, parsing_set_id=text_set_id,
+                           status='ok'),
+               TextOutcome(chat_request='task 1', error_details='boom',
+                           line_no=1, parsing_set_id=text_set_id,
+                           status='failed'),
+               TextOutcome(chat_request='task 2', line_no=2,
+                           parsing_set_id=text_set_id,
+                           status='low_uniqueness', uniqueness=40,
+                           uniqueness_check_status='ok')])
+        await session.commit()
+
+    assert await read_zip(text_set_id) == {
+        'header 0.txt': 'уникальность: 90\n\nheader 0\ntext 0',
+        'header 2.txt': 'уникальность: 40\n\nheader 2\r\ntext 2',
+        'запрос на тексты.txt': ('task 0||header 0\ntask 1||header 1\n'
+                                 'task 2||header 2\n'),
+        'не получились.txt': 'task 1&&boom\n',
+        'тексты с низкой уникальностью.txt': (
+            'task 2||40.0||Была ли получена уникальность текста? - ok\n'),
+    }
+
+
+@pytest.mark.asyncio
+async def test_zip_of_a_legacy_set(database):
+    # sets of earlier versions keep their tasks and failed lines in columns
+    text_set_id = await create_set(
+        failed_texts='task 1&&boom\n',
+        low_uniqueness_texts='task 2||40||Была ли получена уникальность '
+                             'текста? - ok\n',
+        task_strings='task 0||header 0\ntask 1||header 1\ntask 2||header 2')
+
+    assert await read_zip(text_set_id) == {
+        'header 0.txt': 'уникальность: 90\n\nheader 0\ntext 0',
+        'header 2.txt': 'уникальность: 40\n\nheader 2\r\ntext 2',
+        'запрос на тексты.txt': ('task 0||header 0\ntask 1||header 1\n'
+                                 'task 2||header 2'),
+        'не получились.txt': 'task 1&&boom\n',
+        'тексты с низкой уникальностью.txt': (
+            'task 2||40||Была ли получена уникальность текста? - ok\n'),
+    }
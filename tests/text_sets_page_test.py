@@ -0,0 +1,79 @@
+from chatgpt_fastapi.database import async_session_maker
+from chatgpt_fastapi.models import TextsParsingSet, User
+from chatgpt_fastapi.services import get_text_sets_page, remove_text_set
+from datetime import datetime, timedelta
+import pytest
+import uuid
+
+
+async def create_sets(email, count, is_complete=False,
+                      started=datetime(2100, 1, 1)):
+    async with async_session_maker() as session:
+        user = User(email=email, hashed_password='-', is_active=True,
+                    is_superuser=False, is_verified=True)
+        session.add(user)
+        await session.flush()
+        text_sets = [TextsParsingSet(
+            author=user.id, created_at=started + timedelta(minutes=number),
+            is_complete=is_complete, set_name=f'{email} {number}')
+            for number in range(count)]
+        session.add_all(text_sets)
+        await session.flush()
+        text_set_ids = [text_set.id for text_set in text_sets]
+        await session.commit()
+    return text_set_ids
+
+
+async def get_pages(limit=2, **filters):
+    pages, before = [], None
+    async with async_session_maker() as session:
+        while True:
+            text_sets, _, before = await get_text_sets_page(
+                session, before=before, limit=limit, **filters)
+            pages.append([text_set.id for text_set in text_sets])
+            if before is None:
+                return pages
+
+
+@pytest.mark.asyncio
+async def test_pages_and_filters(database):
+    author = f'{uuid.uuid4()}@example.com'
+    other = f'{uuid.uuid4()}@example.com'
+    # newer than the sets of the other tests, so they come first
+    running = await create_sets(author, 5, started=datetime(2200, 1, 1))
+    complete = await create_sets(other, 2, is_complete=True,
+                                 started=datetime(2200, 1, 1))
+
+    assert await get_pages(author_email=author) == [
+        running[:2:-1], running[2:0:-1], running[:1]]
+    assert await get_pages(author_email=other, is_complete=True) == [
+        complete[::-1]]
+    assert await get_pages(author_email=other, is_complete=False) == [[]]
+
+    async with async_session_maker() as session:
+        text_sets, _, before = await get_text_sets_page(session, limit=3)
+        # the newest sets of all authors, created at the same minutes
+        assert [text_set.id for text_set in text_sets] == [
+            running[4], running[3], running[2]]
+        text_sets, _, _ = await get_text_sets_page(
+            session, before=before, limit=2)
+        assert [text_set.id for text_set in text_sets] == [
+            complete[1], running[1]]
+        text_sets, _, _ = await get_text_sets_page(
+            session, author_email=author, is_complete=True)
+        assert text_sets == []
+
+
+@pytest.mark.asyncio
+async def test_deleted_cursor_set(database):
+    author = f'{uuid.uuid4()}@example.com'
+    text_set_ids = await create_sets(author, 4)
+    async with async_session_maker() as session:
+        text_sets, _, before = await get_text_sets_page(
+            session, author_email=author, limit=2)
+        assert before == text_set_ids[2]
+        await remove_text_set(session, before)
+        text_sets, _, before = await get_text_sets_page(
+            session, author_email=author, before=before, limit=2)
+    assert [text_set.id for text_set in text_sets] == text_set_ids[1::-1]
+    assert before is None
@@ -0,0 +1,47 @@
+from chatgpt_fastapi.models import Base, Text, TextOutcome, TextsParsingSet
+from chatgpt_fastapi.text_writer import TextBatchWriter
+import pytest
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import StaticPool
+import uuid
+
+
+def add_line(writer, line):
+    writer.add(outcome={'header': f'header {line}', 'line_no': line,
+                        'status': 'ok'},
+               text={'header': f'header {line}', 'line_no': line,
+                     'text': f'text {line}'})
+
+
+@pytest.mark.asyncio
+async def test_lines_written_by_another_worker_are_skipped():
+    engine = create_async_engine('sqlite+aiosqlite://',
+                                 poolclass=StaticPool)
+    async with engine.begin() as connection:
+        await connection.run_sync(Base.metadata.create_all)
+    session_maker = async_sessionmaker(engine)
+    async with session_maker() as session:
+        text_set = TextsParsingSet(author=uuid.uuid4(), parsed_amount=0,
+                                   set_name='set', total_amount=3)
+        session.add(text_set)
+        await session.flush()
+        text_set_id = text_set.id
+        await session.commit()
+
+    # the first worker lost its lease after writing lines 0 and 1, the
+    # worker that took the set over writes lines 1 and 2
+    for lines in ((0, 1), (1, 2)):
+        async with session_maker() as session:
+            writer = TextBatchWriter(session, text_set_id)
+            for line in lines:
+                add_line(writer, line)
+            await writer.flush()
+
+    async with session_maker() as session:
+        text_set = await session.get(TextsParsingSet, text_set_id)
+        assert text_set.parsed_amount == 3
+        for model in (Text, TextOutcome):
+            assert await session.scalar(
+                select(func.count()).select_from(model)) == 3
+    await engine.dispose()
@@ -0,0 +1,26 @@
+import asyncio
+from chatgpt_fastapi.textru_poller import TextruPoller
+import pytest
+
+
+@pytest.mark.asyncio
+async def test_poller_resolves_each_uid_when_ready():
+    polls = {'fast': 0, 'slow': 0, 'never': 0}
+
+    async def poll(uid):
+        polls[uid] += 1
+        if uid == 'fast' or (uid == 'slow' and polls[uid] >= 3):
+            return {'text_unique': '87.5'}
+        return {'error_code': 181}
+
+    poller = TextruPoller(poll, first_delay=0.01, max_interval=0.02,
+                          backoff=2, timeout=0.2)
+    results = await asyncio.gather(poller.wait_for('fast'),
+                                   poller.wait_for('slow'),
+                                   poller.wait_for('never'))
+
+    assert results == [87.5, 87.5, 0]
+    assert polls['fast'] == 1
+    assert polls['slow'] == 3
+    assert poller.as_dict()['pending'] == 0
+    assert poller.timed_out == 1
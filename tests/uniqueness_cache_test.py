@@ -0,0 +1,20 @@
+from chatgpt_fastapi.database import create_db_and_tables
+from chatgpt_fastapi.uniqueness_cache import UniquenessCache
+import pytest
+
+
+@pytest.mark.asyncio
+async def test_cache_hits_memory_then_database_and_expires():
+    await create_db_and_tables()
+    cache = UniquenessCache(ttl=3600, size=1)
+    assert await cache.get('Первый   текст') is None
+    await cache.put('Первый текст', 93.5, check_seconds=120)
+    assert await cache.get(' Первый\nтекст ') == 93.5
+
+    # pushed out of the memory layer, still found in the table
+    await cache.put('Второй текст', 80.0, check_seconds=60)
+    assert await cache.get('Первый текст') == 93.5
+    assert cache.as_dict()['database_hits'] == 1
+    assert cache.as_dict()['saved_seconds'] == 2 * 90
+
+    assert await UniquenessCache(ttl=0).get('Первый текст') is None
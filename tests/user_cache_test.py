@@ -0,0 +1,66 @@
+from chatgpt_fastapi.models import Base, User
+from chatgpt_fastapi.user_cache import CachedUserDatabase, UserCache
+import pytest
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import StaticPool
+import time
+import uuid
+
+
+def test_user_cache_expires_and_evicts(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    cache = UserCache(ttl=30, size=1)
+    first = User(email='first@example.com', hashed_password='-',
+                 id=uuid.uuid4())
+    cache.put(first)
+    assert cache.get(first.id).email == 'first@example.com'
+    now[0] += 31
+    assert cache.get(first.id) is None
+
+    second = User(email='second@example.com', hashed_password='-',
+                  id=uuid.uuid4())
+    cache.put(first)
+    cache.put(second)
+    assert cache.get(first.id) is None
+    assert cache.as_dict()['evictions'] == 1
+
+
+@pytest.mark.asyncio
+async def test_cached_user_database():
+    engine = create_async_engine('sqlite+aiosqlite://',
+                                 poolclass=StaticPool)
+    async with engine.begin() as connection:
+        await connection.run_sync(Base.metadata.create_all)
+    queries = []
+    event.listen(engine.sync_engine, 'before_cursor_execute',
+                 lambda *args: queries.append(args[2]))
+    session_maker = async_sessionmaker(engine)
+    cache = UserCache(ttl=30)
+
+    async with session_maker() as session:
+        user = await CachedUserDatabase(session, User, cache).create(
+            {'email': 'user@example.com', 'hashed_password': '-'})
+        user_id = user.id
+
+    queries.clear()
+    for _ in range(3):
+        async with session_maker() as session:
+            user = await CachedUserDatabase(session, User, cache).get(
+                user_id)
+            assert user.email == 'user@example.com'
+            assert user in session
+    assert len(queries) == 1
+    assert cache.as_dict()['hits'] == 2
+
+    # an update through the users router is never served stale
+    async with session_maker() as session:
+        user_db = CachedUserDatabase(session, User, cache)
+        await user_db.update(await user_db.get(user_id),
+                             {'is_active': False})
+    async with session_maker() as session:
+        user = await CachedUserDatabase(session, User, cache).get(user_id)
+        assert not user.is_active
+    assert cache.as_dict()['invalidations'] == 1
+    await engine.dispose()
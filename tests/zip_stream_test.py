@@ -0,0 +1,41 @@
+from chatgpt_fastapi.zip_stream import stream_zip
+from io import BytesIO
+import pytest
+import time
+import zipfile
+
+
+@pytest.mark.asyncio
+async def test_stream_zip_is_a_valid_archive():
+    async def files():
+        for number in range(50):
+            yield f'текст {number}.txt', f'уникальность: 90\n\n{number}' * 50
+
+    chunks = [chunk async for chunk in stream_zip(files(), chunk_size=1024)]
+
+    assert len(chunks) > 2
+    with zipfile.ZipFile(BytesIO(b''.join(chunks))) as archive:
+        assert archive.testzip() is None
+        assert len(archive.namelist()) == 50
+        file_info = archive.getinfo('текст 7.txt')
+        # sizes follow the data in a descriptor, not in the local header
+        assert file_info.flag_bits & 0x08
+        assert archive.read(file_info).decode() == (
+            'уникальность: 90\n\n7' * 50)
+
+
+@pytest.mark.asyncio
+async def test_stream_zip_is_reproducible(monkeypatch):
+    async def files():
+        yield 'текст.txt', 'уникальность: 90\n\nтекст'
+
+        async def lines():
+            yield 'задание||заголовок\n'
+        yield 'запрос на тексты.txt', lines()
+
+    first = b''.join([chunk async for chunk in stream_zip(files())])
+    # a rebuild an hour later
+    clock = time.time() + 3600
+    monkeypatch.setattr(time, 'time', lambda: clock)
+    second = b''.join([chunk async for chunk in stream_zip(files())])
+    assert first == second